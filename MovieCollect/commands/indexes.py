@@ -0,0 +1,56 @@
+from scrapy.commands import ScrapyCommand
+from scrapy.exceptions import UsageError
+from scrapy.utils.defer import deferred_from_coro
+
+from MovieCollect.custom.crud_error_catcher import crud_error_catcher
+from MovieCollect.custom.database import SpiderMongo
+
+class Command(ScrapyCommand):
+
+    requires_project = True
+    default_settings = {'LOG_ENABLED': True, 'LOG_FILE': None}
+
+    def syntax(self):
+        return '[create|verify]'
+
+    def short_desc(self):
+        return 'Create the mongo indexes MovieCollect needs or verify the plans of its hot queries'
+
+    def run(self, args, opts):
+        action = args[0] if args else 'create'
+        if action not in ('create', 'verify'):
+            raise UsageError()
+        from twisted.internet import reactor
+
+        spider_mongo = SpiderMongo(self.settings)
+        crud_error_catcher.initial(self)
+        if action == 'create':
+            d = deferred_from_coro(spider_mongo.ensure_indexes())
+            d.addCallback(self._report_failed)
+        else:
+            d = deferred_from_coro(spider_mongo.verify_indexes())
+            d.addCallback(self._report)
+        d.addErrback(self._failed)
+        d.addBoth(lambda _: reactor.stop())
+        reactor.run()
+
+    def _report_failed(self, failed):
+        if failed:
+            self.exitcode = 1
+            for collname, indexname, error in failed:
+                # Usually duplicated documents conflicting with a unique index
+                print(f'FAILED: {collname}.{indexname}: {error}')
+        else:
+            print('All indexes are ready')
+
+    def _report(self, collscans):
+        if collscans:
+            self.exitcode = 1
+            for collname, query in collscans:
+                print(f'COLLSCAN: {collname} {query}')
+        else:
+            print('All hot queries are covered by indexes')
+
+    def _failed(self, failure):
+        self.exitcode = 1
+        print(failure.getTraceback())
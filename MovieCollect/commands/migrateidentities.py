@@ -0,0 +1,64 @@
+from pymongo import UpdateOne
+from pymongo.errors import BulkWriteError
+from scrapy.commands import ScrapyCommand
+from scrapy.utils.defer import deferred_from_coro
+
+from MovieCollect.custom.crud_error_catcher import crud_error_catcher
+from MovieCollect.custom.database import SpiderMongo
+from MovieCollect.custom.utils.misc import hash_movie_identity
+
+class Command(ScrapyCommand):
+
+    requires_project = True
+    default_settings = {'LOG_ENABLED': True, 'LOG_FILE': None}
+
+    def syntax(self):
+        return '[batch_size]'
+
+    def short_desc(self):
+        return 'Rewrite random movie identities into identities derived from spidername and movieurl'
+
+    def run(self, args, opts):
+        from twisted.internet import reactor
+
+        batch_size = int(args[0]) if args else 1000
+        self.spider_mongo = SpiderMongo(self.settings)
+        crud_error_catcher.initial(self)
+        d = deferred_from_coro(self.migrate(batch_size))
+        d.addErrback(self._failed)
+        d.addBoth(lambda _: reactor.stop())
+        reactor.run()
+
+    async def migrate(self, batch_size):
+        scanned = migrated = conflicts = 0
+        error_count = crud_error_catcher.error_count
+        operations = []
+        async for movie in self.spider_mongo.coll_movie_find_iter({}, projection={'movieidentity':1, 'spidername':1, 'movieurl':1}, batch_size=batch_size):
+            scanned += 1
+            if not movie.get('spidername') or not movie.get('movieurl'):
+                continue
+            movie_identity = hash_movie_identity(movie['spidername'], movie['movieurl'])
+            if movie.get('movieidentity') != movie_identity:
+                operations.append(UpdateOne({'_id':movie['_id']}, {'$set':{'movieidentity':movie_identity}}))
+            if len(operations) >= batch_size:
+                m, c = await self._write(operations)
+                migrated, conflicts, operations = migrated+m, conflicts+c, []
+        if operations:
+            m, c = await self._write(operations)
+            migrated, conflicts = migrated+m, conflicts+c
+        print(f'Scanned {scanned} movies, migrated {migrated}, {conflicts} duplicated movies kept their identity')
+        if crud_error_catcher.error_count > error_count:
+            # The scan stops at a failed read, running the command again continues the migration
+            self.exitcode = 1
+            print(f'Migration is incomplete: {crud_error_catcher.error_messages[error_count:]}')
+
+    async def _write(self, operations):
+        try:
+            result = await self.spider_mongo.movie_coll.bulk_write(operations, ordered=False)
+        except BulkWriteError as e:
+            return e.details['nModified'], len(e.details['writeErrors'])
+        return result.modified_count, 0
+
+    def _failed(self, failure):
+        self.exitcode = 1
+        print(failure.getTraceback())
@@ -0,0 +1,67 @@
+import logging
+import time
+
+from twisted.internet import task
+from scrapy.utils.defer import deferred_from_coro
+
+from MovieCollect.custom.database import SpiderMongo
+from MovieCollect.custom.journal import WRITE_TIME_FIELD, JournaledUpdateOne
+from MovieCollect.custom.updatelatency import update_latency_tracker
+from MovieCollect.custom.utils.misc import log_failure
+
+logger = logging.getLogger(__name__)
+
+class MovieBulkWriter:
+    """
+    Write-behind buffer shared by the movie pipelines. $set fields are
+    coalesced per spider and movieidentity, so every movie document gets a
+    single upsert per flush. Pending documents are flushed as one unordered
+    bulk_write when BULK_WRITE_SIZE documents are pending, every
+    BULK_WRITE_INTERVAL seconds and when the spider closes. Both settings
+    are taken from each spider.
+    """
+
+    def __init__(self):
+        self.buffers = {}
+        self.sizes = {}
+        self.tasks = {}
+        self.spider_mongo = None
+
+    def open(self, spider):
+        if spider.name in self.buffers:
+            return
+        if self.spider_mongo is None:
+            self.spider_mongo = SpiderMongo(spider.settings)
+        interval = spider.settings.getfloat('BULK_WRITE_INTERVAL', 1.0)
+        self.buffers[spider.name] = {}
+        self.sizes[spider.name] = spider.settings.getint('BULK_WRITE_SIZE', 100)
+        self.tasks[spider.name] = tl = task.LoopingCall(lambda: deferred_from_coro(self.flush(spider.name)))
+        tl.start(interval, now=False).addErrback(log_failure(f'Bulk writer of spider: {spider.name} stopped unexpectedly', logger))
+
+    async def add(self, spider, movieidentity, fields):
+        pending = self.buffers[spider.name]
+        pending.setdefault(movieidentity, {}).update(fields)
+        if len(pending) >= self.sizes[spider.name]:
+            await self.flush(spider.name)
+
+    async def flush(self, spidername):
+        pending = self.buffers.get(spidername)
+        if not pending:
+            return
+        self.buffers[spidername] = {}
+        write_time = time.time()
+        operations = [JournaledUpdateOne({'movieidentity':movieidentity}, {'$set':dict(fields, **{WRITE_TIME_FIELD:write_time})}, upsert=True) for movieidentity, fields in pending.items()]
+        result = await self.spider_mongo.coll_movie_bulk_write(operations, ordered=False)
+        if result:
+            update_latency_tracker.written(pending)
+            logger.debug(f'Spider: {spidername} flushed {len(operations)} movie documents, upserted: {result.upserted_count}, modified: {result.modified_count}')
+
+    async def close(self, spider):
+        tl = self.tasks.pop(spider.name, None)
+        if tl and tl.running:
+            tl.stop()
+        await self.flush(spider.name)
+        self.buffers.pop(spider.name, None)
+        self.sizes.pop(spider.name, None)
+
+movie_bulk_writer = MovieBulkWriter()
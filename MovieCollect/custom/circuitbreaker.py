@@ -0,0 +1,111 @@
+import logging
+from collections import deque
+
+from pymongo.errors import ConnectionFailure, ExecutionTimeout, WTimeoutError
+from scrapy.utils.defer import deferred_from_coro
+
+from MovieCollect.custom.utils.exceptions import MongoCircuitOpenError
+
+logger = logging.getLogger(__name__)
+
+class CircuitBreaker:
+    """
+    Track the outcome of the last MONGO_BREAKER_WINDOW mongo calls. Calls that
+    fail with a connection or timeout error, or take longer than
+    MONGO_BREAKER_SLOW_CALL seconds, are failures. When the failure rate
+    reaches MONGO_BREAKER_ERROR_RATE the breaker opens: mongo calls are
+    rejected and running crawlers are paused. Mongo is then pinged with an
+    exponential backoff and the crawlers are resumed once it answers, except
+    the ones a user paused meanwhile. Pauses of the breaker and of users are
+    kept apart: the breaker holds paused_crawlers, users set user_paused on
+    the crawler.
+    """
+
+    def __init__(self, settings):
+        self.enabled = settings.getbool('MONGO_BREAKER_ENABLED', False)
+        self.min_calls = settings.getint('MONGO_BREAKER_MIN_CALLS', 20)
+        self.error_rate = settings.getfloat('MONGO_BREAKER_ERROR_RATE', 0.5)
+        self.slow_call = settings.getfloat('MONGO_BREAKER_SLOW_CALL', 5)
+        self.min_probe_delay = settings.getfloat('MONGO_BREAKER_PROBE_DELAY', 1)
+        self.max_probe_delay = settings.getfloat('MONGO_BREAKER_MAX_PROBE_DELAY', 60)
+        self.calls = deque(maxlen=settings.getint('MONGO_BREAKER_WINDOW', 50))
+        self.failures = 0
+        self.probe_delay = self.min_probe_delay
+        self.state = 'closed'
+        self.paused_crawlers = set()
+        self.stats = {'state':self.state, 'opened':0, 'closed':0, 'probes':0, 'rejected':0}
+        self.crawlerprocess = None
+
+    def initial(self, crawlerprocess):
+        self.crawlerprocess = crawlerprocess
+        self.spider_mongo = crawlerprocess.spider_mongo
+
+    def enter(self):
+        if self.state != 'closed':
+            self.stats['rejected'] += 1
+            raise MongoCircuitOpenError(f'Mongo circuit breaker is {self.state}')
+
+    def leave(self, elapsed, exp):
+        if self.state != 'closed' or isinstance(exp, MongoCircuitOpenError):
+            return
+        failed = isinstance(exp, (ConnectionFailure, ExecutionTimeout, WTimeoutError)) or elapsed > self.slow_call
+        if len(self.calls) == self.calls.maxlen:
+            self.failures -= self.calls[0]
+        self.calls.append(failed)
+        self.failures += failed
+        if len(self.calls) >= self.min_calls and self.failures / len(self.calls) >= self.error_rate:
+            self.open()
+
+    def holds(self, spidername):
+        """Whether the crawler of spidername is paused by the breaker"""
+        return spidername in self.paused_crawlers
+
+    def snapshot(self):
+        return dict(self.stats)
+
+    def _transit(self, state):
+        logger.warning(f'Mongo circuit breaker: {self.state} -> {state}')
+        self.state = self.stats['state'] = state
+        if self.crawlerprocess:
+            for crawler in self.crawlerprocess.running_crawlers.values():
+                crawler.stats.set_value('mongo_breaker/state', state)
+                crawler.stats.inc_value(f'mongo_breaker/transition/{state}')
+
+    def open(self):
+        from twisted.internet import reactor
+        self.stats['opened'] += 1
+        self._transit('open')
+        self.calls.clear()
+        self.failures = 0
+        if self.crawlerprocess:
+            for spidername, crawler in self.crawlerprocess.running_crawlers.items():
+                if crawler.crawling and crawler.engine and spidername not in self.paused_crawlers:
+                    self.paused_crawlers.add(spidername)
+                    if not crawler.engine.paused:
+                        crawler.engine.pause()
+                        logger.warning(f'Spider: {spidername} has been paused by mongo circuit breaker')
+        reactor.callLater(self.probe_delay, self.probe)
+
+    def probe(self):
+        self.stats['probes'] += 1
+        self._transit('half_open')
+        d = deferred_from_coro(self.spider_mongo.get_database().command('ping'))
+        d.addCallbacks(lambda _: self.close(), self._probe_failed)
+
+    def _probe_failed(self, failure):
+        from twisted.internet import reactor
+        self.probe_delay = min(self.probe_delay * 2, self.max_probe_delay)
+        logger.warning(f'Mongo circuit breaker probe failed, probe again in {self.probe_delay}s: {failure.getErrorMessage()}')
+        self._transit('open')
+        reactor.callLater(self.probe_delay, self.probe)
+
+    def close(self):
+        self.stats['closed'] += 1
+        self._transit('closed')
+        self.probe_delay = self.min_probe_delay
+        for spidername in self.paused_crawlers:
+            crawler = self.crawlerprocess.running_crawlers.get(spidername)
+            if crawler and crawler.crawling and crawler.engine.paused and not getattr(crawler, 'user_paused', False):
+                crawler.engine.unpause()
+                logger.warning(f'Spider: {spidername} has been resumed by mongo circuit breaker')
+        self.paused_crawlers.clear()
@@ -2,6 +2,7 @@ import logging
 import pprint
 import os
 import sys
+import time
 
 from twisted.internet import defer, task
 from twisted.python.failure import Failure
@@ -13,16 +14,26 @@ from scrapy.signalmanager import SignalManager
 from scrapy.utils.defer import deferred_from_coro
 from scrapy.utils.misc import load_object
 from scrapy.crawler import Crawler, CrawlerProcess
-from scrapy.utils.log import get_scrapy_root_handler, _get_handler
+from scrapy.utils.log import get_scrapy_root_handler
 
 from MovieCollect.custom.database import SpiderMongo
+from MovieCollect.custom.db_importer import forget_code
+from MovieCollect.custom.downloadbudget import DownloadBudget
+from MovieCollect.custom.frontier import frontier_dir
 from MovieCollect.custom.crud_error_catcher import crud_error_catcher
+from MovieCollect.custom.journal import JournalReplayer
 from MovieCollect.custom.statusfinder import StatusFinder
 from MovieCollect.custom.statusperformer import StatusPerformer
+from MovieCollect.custom.statuswatcher import StatusWatcher
 from MovieCollect.custom.movieupdater import MovieUpdater
+from MovieCollect.custom.searchcache import SearchCache
+from MovieCollect.custom.searchfanout import SearchFanout
 from MovieCollect.custom.spiderater import SpiderRater
-from MovieCollect.custom.utils.misc import create_dir
-from MovieCollect.custom.utils.log import RootFilter, SpiderFilter, SpiderLogCounterHandler
+from MovieCollect.custom.spiderlease import SpiderLease
+from MovieCollect.custom.supervisor import SupervisorChannel
+from MovieCollect.custom.updatequeue import UpdateQueue
+from MovieCollect.custom.utils.misc import create_dir, log_failure
+from MovieCollect.custom.utils.log import AsyncSpiderLogHandler, RootFilter, SpiderLogCounterHandler, async_log_writer, get_spider_log_handler, spider_log_router
 
 
 logger = logging.getLogger(__name__)
@@ -39,7 +50,6 @@ class AutoCrawler(Crawler):
         self.settings = settings.copy()
 
         spider_log_handlers = []
-        spider_log_filter = SpiderFilter(self.spidercls)
         spider_log_dir = os.path.join(self.settings.get('SPIDER_LOG_DIR'), self.spidercls.name)
         create_dir(spider_log_dir)
 
@@ -50,24 +60,30 @@ class AutoCrawler(Crawler):
         else:
             self.spidercls.custom_settings = {'LOG_FILE':spider_log}
         self.spidercls.update_settings(self.settings)
-        spider_log_handler = _get_handler(self.settings)
-        spider_log_handler.addFilter(spider_log_filter)
+        spider_log_handler = get_spider_log_handler(self.settings)
         spider_log_handlers.append(spider_log_handler)
-        logging.root.addHandler(spider_log_handler)
 
         if self.settings.get('SPIDER_LOG_ERROR', False):
             spider_error_log = os.path.join(spider_log_dir, 'error.log')
             self.spidercls.custom_settings['LOG_FILE'] = spider_error_log
             self.spidercls.custom_settings['LOG_LEVEL'] = 'ERROR'
             self.spidercls.update_settings(self.settings)
-            spider_error_log_handler = _get_handler(self.settings)
-            spider_error_log_handler.addFilter(spider_log_filter)
+            spider_error_log_handler = get_spider_log_handler(self.settings)
             spider_log_handlers.append(spider_error_log_handler)
-            logging.root.addHandler(spider_error_log_handler)
+
+        if self.settings.getbool('SPIDER_LOG_ASYNC', False):
+            async_log_writer.start(self.settings.getint('SPIDER_LOG_QUEUE_SIZE', 10000))
+            spider_log_handlers = [AsyncSpiderLogHandler(self, handler, async_log_writer) for handler in spider_log_handlers]
+
+        if self.settings.getbool('SPIDER_FRONTIER_ENABLED', False):
+            self.settings.set('JOBDIR', frontier_dir(self.settings, self.spidercls.name), priority='spider')
+            self.settings.set('SCHEDULER', 'MovieCollect.custom.frontier.FrontierScheduler', priority='spider')
+        if self.settings.getbool('SPIDER_BLOOM_DUPEFILTER', False):
+            self.settings.set('DUPEFILTER_CLASS', 'MovieCollect.custom.dupefilter.BloomDupeFilter', priority='spider')
 
         counter_handler = SpiderLogCounterHandler(self, level=self.settings.get('LOG_LEVEL'))
         spider_log_handlers.append(counter_handler)
-        logging.root.addHandler(counter_handler)
+        spider_log_router.register(self.spidercls, spider_log_handlers)
 
         self.signals = SignalManager(self)
         self.stats = load_object(self.settings['STATS_CLASS'])(self)
@@ -77,10 +93,10 @@ class AutoCrawler(Crawler):
                     {'settings': pprint.pformat(d)}, extra={'crawler':self})
 
         def __remove_handler():
+            spider_log_router.unregister(self.spidercls, spider_log_handlers)
             for handler in spider_log_handlers:
-                if isinstance(handler, logging.FileHandler):
+                if isinstance(handler, (logging.FileHandler, AsyncSpiderLogHandler)):
                     handler.close()
-                logging.root.removeHandler(handler)
 
         self.__remove_handler = __remove_handler
         self.signals.connect(self.__remove_handler, signals.engine_stopped)
@@ -94,6 +110,7 @@ class AutoCrawler(Crawler):
         self.spider = None
         self.engine = None
         self.terminate = False
+        self.user_paused = False
 
     @defer.inlineCallbacks
     def stop(self):
@@ -139,24 +156,66 @@ class AutoCrawlerProcess(CrawlerProcess):
         root_handler.addFilter(root_filter)
 
         self.spider_mongo = SpiderMongo(self.settings)
+        self.spider_mongo.circuit_breaker.initial(self)
         self.running_crawlers = {}
+        # Index of this process under a Supervisor, None when it runs alone
+        self.worker_index = self.settings.get('CRAWLER_WORKER_INDEX')
+        self.supervised = self.worker_index is not None
 
         self.status_finder = StatusFinder(self)
         self.status_performer = StatusPerformer(self)
         self._change_spider_status = False
+        self.status_watcher = StatusWatcher(self)
+        self._status_watch = self.settings.getbool('SPIDER_STATUS_WATCH', False)
+        self._status_reconcile_interval = self.settings.get('SPIDER_STATUS_RECONCILE_INTERVAL', 60)
+        self._last_status_poll = 0
 
         self._max_update_movies = self.settings.get('MAX_UPDATE_MOVIES', 50)
         self.update_movies = []
         self.update_movies_num = 0
         self.movie_updater = None
+        self.update_queue = UpdateQueue(self)
+        self._update_queue_watch = self.settings.getbool('UPDATE_QUEUE_WATCH', False)
+        self._update_loop_running = False
+        self._update_loop_pending = False
+        self._update_loop_rerun = None
+        self.search_cache = SearchCache(self) if self.settings.getbool('SEARCH_CACHE_ENABLED', False) else None
+        self.search_fanout = SearchFanout(self.settings, self.search_cache)
 
         self.spider_rater = SpiderRater(self)
+        self.download_budget = DownloadBudget(self)
+        self.spider_lease = SpiderLease(self)
+        self._download_budget_interval = self.settings.getfloat('DOWNLOAD_BUDGET_INTERVAL', 5)
 
         self._auto_crawl_interval = self.settings.get('AUTO_CRAWL_INTERVAL', 60)
 
         crud_error_catcher.initial(self)
+        self.journal_replayer = JournalReplayer(self, crud_error_catcher.journal)
+        self._crud_replay = self.settings.getbool('CRUD_REPLAY_ENABLED', True)
 
     def run_loop(self):
+        if self.supervised:
+            # Spider status is handled by the supervisor, only worker 0 updates movies
+            from twisted.internet import stdio
+            stdio.StandardIO(SupervisorChannel(self))
+            self._status_watch = False
+            self._update_queue_watch = self._update_queue_watch and int(self.worker_index) == 0
+        if self._status_watch:
+            d = deferred_from_coro(self.status_watcher.watch())
+            d.addErrback(log_failure('Spider status watcher stopped unexpectedly', logger))
+        if self.settings.getbool('MONGO_ENSURE_INDEXES', True) and not self.supervised:
+            d = deferred_from_coro(self.spider_mongo.ensure_indexes())
+            d.addErrback(log_failure('Failed to create mongo indexes', logger))
+        if self._update_queue_watch:
+            d = deferred_from_coro(self.update_queue.watch())
+            d.addErrback(log_failure('Update queue watcher stopped unexpectedly', logger))
+        if self.download_budget.enabled:
+            bl = task.LoopingCall(self.download_budget.rebalance)
+            bl.start(self._download_budget_interval).addErrback(log_failure('Download budget stopped unexpectedly', logger))
+        if self.spider_lease.enabled:
+            # Renewed apart from the crawl loop so a long AUTO_CRAWL_INTERVAL cannot let leases expire
+            ll = task.LoopingCall(self._renew_leases)
+            ll.start(self.spider_lease.ttl / 3).addErrback(log_failure('Spider lease renewal stopped unexpectedly', logger))
         tl = task.LoopingCall(self._run_loop)
         tl.start(self._auto_crawl_interval)
 
@@ -168,9 +227,12 @@ class AutoCrawlerProcess(CrawlerProcess):
     @defer.inlineCallbacks
     def _run_spider_loop(self):
         logger.debug('Start to run spider loop to get spiders those are in user status')
-        if self._change_spider_status:
+        if self._change_spider_status or self.supervised:
+            return
+        if self.status_watcher.watching and time.time() - self._last_status_poll < self._status_reconcile_interval:
             return
         self._change_spider_status = True
+        self._last_status_poll = time.time()
         user_status_spiders = yield deferred_from_coro(self.status_finder.get_user_status_spiders())
         self.status_performer.perform(user_status_spiders)
         self._change_spider_status = False
@@ -178,22 +240,61 @@ class AutoCrawlerProcess(CrawlerProcess):
     @defer.inlineCallbacks
     def _run_update_loop(self):
         logger.debug('Start to run update loop to get movies that need to be updated')
-        if not (self.update_movies_num >= self._max_update_movies):
-            update_movies = yield deferred_from_coro(self.spider_mongo.coll_tool_find_one({'name':'movies_to_update'},{'funcfield':1}))
-            self.update_movies = update_movies['funcfield'] if update_movies else self.update_movies
+        if self.supervised and int(self.worker_index) != 0:
+            return
+        if self._update_loop_running:
+            self._update_loop_pending = True
+            return
+        self._update_loop_running = True
+        try:
+            yield deferred_from_coro(self.update_queue.migrate_legacy())
+            if self.movie_updater:
+                yield deferred_from_coro(self.update_queue.renew(self.movie_updater.updating_movies))
+                self.update_movies_num = len(self.movie_updater.updating_movies)
+            else:
+                self.update_movies_num = 0
+            if self.update_movies_num >= self._max_update_movies:
+                return
+            self.update_movies = yield deferred_from_coro(self.update_queue.claim(self._max_update_movies - self.update_movies_num))
             if not self.update_movies:
                 return
-            self.update_movies_num = len(self.update_movies)
             if not self.movie_updater:
                 logger.info('Create new MovieUpdater to handler new requests')
                 self.movie_updater = MovieUpdater(self)
                 yield deferred_from_coro(self.movie_updater.initial())
-        if self.movie_updater:
-            yield deferred_from_coro(self.movie_updater.update_movies(self.update_movies))
+            if self.movie_updater:
+                yield deferred_from_coro(self.movie_updater.update_movies(self.update_movies))
+            else:
+                yield deferred_from_coro(self.update_queue.release(self.update_movies))
+        finally:
+            self._update_loop_running = False
+            if self._update_loop_pending:
+                self._update_loop_pending = False
+                self._update_loop_rerun = self._run_update_loop()
+                self._update_loop_rerun.addErrback(log_failure('Pending update loop failed', logger))
+
+    def forget_spider(self, spidername):
+        """Drop the imported module of a spider which has been deleted by another worker"""
+        spidermodule_name = self.spider_loader.get_spidermodule_name(spidername)
+        sys.modules.pop(spidermodule_name, None)
+        forget_code(spidername)
+
+    def _run_replay_loop(self):
+        if self._crud_replay:
+            d = deferred_from_coro(self.journal_replayer.replay())
+            d.addErrback(log_failure('Failed to replay write journal', logger))
+
+    def _renew_leases(self):
+        logger.debug('Start to renew leases of running spiders')
+        d = deferred_from_coro(self.spider_lease.renew(list(self.running_crawlers)))
+        d.addCallback(lambda _:deferred_from_coro(self.spider_lease.take_over()))
+        d.addErrback(log_failure('Failed to renew spider leases', logger))
+        return d
 
     def _run_change_rate_loop(self):
         logger.debug('Start to run change rate loop to control download concurrentcy')
-        self.spider_rater.change_rate()
+        d = deferred_from_coro(self.spider_rater.change_rate())
+        d.addErrback(log_failure('Failed to change spiders rate', logger))
     
     def stop(self):
         """
@@ -1,6 +1,9 @@
 import logging
 import os
+import time
 
+from MovieCollect.custom.journal import WriteJournal, journal_entries, journaled_collections
+from MovieCollect.custom.utils.exceptions import MongoCircuitOpenError
 from MovieCollect.custom.utils.misc import create_dir
 
 logger = logging.getLogger(__name__)
@@ -9,19 +12,28 @@ class CrudErrorCatcher:
     def __init__(self):
         self.error_count = 0
         self.error_messages = []
+        self.batch_size = 100
 
     def initial(self, crawlerprocess):
         self.crawlerprocess = crawlerprocess
         self.settings = crawlerprocess.settings
 
+        self.batch_size = self.settings.getint('MONGO_CURSOR_BATCH_SIZE', 100)
         self.crud_error_dir = self.settings.get('CRUD_ERROR_DIR')
         create_dir(self.crud_error_dir)
         self.crud_read_file = os.path.join(self.crud_error_dir, 'read-op.txt')
-        self.crud_write_file = os.path.join(self.crud_error_dir, 'write-op.txt')
+        self.crud_write_file = os.path.join(self.crud_error_dir, 'write-op.jsonl')
+        self.journal = WriteJournal(self.crud_write_file)
+        self.journaled_collections = journaled_collections(self.settings)
 
-    def dcatcher(self, func):
+    def dcatcher(self, func, monitors=()):
         async def inner(*args, **kwargs):
+            entered = []
+            start = time.monotonic()
             try:
+                for monitor in monitors:
+                    monitor.enter()
+                    entered.append(monitor)
                 if func.__name__ == 'find' or func.__name__ == 'aggregate':
                     results = []
                     async for result in func(*args, **kwargs):
@@ -29,25 +41,70 @@ class CrudErrorCatcher:
                 else:
                     results = await func(*args, **kwargs)
             except Exception as e:
-                self.error_count += 1
-                self.error_messages.append(str(e))
-                for k,v in vars(self.__class__).items():
-                    if k.startswith('activate_') and callable(v):
-                        getattr(self, k)(e, func, *args, **kwargs)
+                for monitor in entered:
+                    monitor.leave(time.monotonic()-start, e)
+                self.activate(e, func, *args, **kwargs)
             else:
+                for monitor in entered:
+                    monitor.leave(time.monotonic()-start, None)
                 return results
         return inner
 
+    def scatcher(self, func, monitors=()):
+        """
+        Async iterator version of dcatcher for find and aggregate, results are
+        fetched batch_size documents at a time instead of being collected into
+        a list. Monitors are left once the first document arrives. An error
+        ends the iteration early, callers telling a complete read from a
+        partial one compare error_count before and after iterating.
+        """
+        async def inner(*args, batch_size=None, projection=None, **kwargs):
+            entered = []
+            start = time.monotonic()
+            try:
+                for monitor in monitors:
+                    monitor.enter()
+                    entered.append(monitor)
+                if func.__name__ == 'aggregate':
+                    if projection is not None:
+                        args = (list(args[0])+[{'$project':projection}],) + args[1:]
+                    kwargs['batchSize'] = batch_size or self.batch_size
+                else:
+                    if projection is not None:
+                        kwargs['projection'] = projection
+                    kwargs['batch_size'] = batch_size or self.batch_size
+                async for result in func(*args, **kwargs):
+                    while entered:
+                        entered.pop().leave(time.monotonic()-start, None)
+                    yield result
+            except Exception as e:
+                while entered:
+                    entered.pop().leave(time.monotonic()-start, e)
+                self.activate(e, func, *args, **kwargs)
+            else:
+                while entered:
+                    entered.pop().leave(time.monotonic()-start, None)
+        return inner
+
+    def activate(self, exp, func, *args, **kwargs):
+        self.error_count += 1
+        self.error_messages.append(str(exp))
+        for k,v in vars(self.__class__).items():
+            if k.startswith('activate_') and callable(v):
+                getattr(self, k)(exp, func, *args, **kwargs)
+
     def activate_log(self, exp, func, *args, **kwargs):
-        logger.critical(f'CRUD operation: {func.__name__} failed.', exc_info=exp)
+        if isinstance(exp, MongoCircuitOpenError):
+            logger.warning(f'CRUD operation: {func.__name__} rejected, {exp}')
+        else:
+            logger.critical(f'CRUD operation: {func.__name__} failed.', exc_info=exp)
 
     def activate_crud_record(self, exp, func, *args, **kwargs):
-        if func.__name__.startswith('find'):
-            crud_error_file = self.crud_read_file
+        if func.__name__.startswith('find') or func.__name__ == 'aggregate':
+            with open(self.crud_read_file, 'a') as f:
+                 f.write(f'{func.__name__}, {args}, {kwargs}\n')
         else:
-            crud_error_file = self.crud_write_file
-        with open(crud_error_file, 'a') as f:
-             f.write(f'{func.__name__}, {args}, {kwargs}\n')
+            self.journal.record(journal_entries(func, args, kwargs, self.journaled_collections))
 
     def activate_mail(self, exp, func, *args, **kwargs):
         pass
@@ -1,13 +1,55 @@
+import logging
 import time
 
 from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo import ASCENDING, IndexModel
 
+from MovieCollect.custom.circuitbreaker import CircuitBreaker
 from MovieCollect.custom.crud_error_catcher import crud_error_catcher
+from MovieCollect.custom.mongostats import MongoOpStats
 from MovieCollect.custom.utils import exceptions
 from MovieCollect.custom.utils.misc import singleton
 
+logger = logging.getLogger(__name__)
+
 @singleton
 class SpiderMongo:
+    INDEXES = {
+        'movie':[
+            IndexModel([('movieidentity', ASCENDING)], name='movieidentity', unique=True),
+            IndexModel([('spidername', ASCENDING), ('moviename', ASCENDING), ('movieurl', ASCENDING)], name='spidername_moviename_movieurl'),
+            IndexModel([('moviename', ASCENDING)], name='moviename'),
+        ],
+        'spider':[
+            IndexModel([('spidername', ASCENDING)], name='spidername', unique=True),
+            IndexModel([('status', ASCENDING)], name='status'),
+        ],
+        'tool':[
+            IndexModel([('name', ASCENDING)], name='name'),
+        ],
+        'queue':[
+            IndexModel([('moviename', ASCENDING)], name='moviename', unique=True),
+            IndexModel([('status', ASCENDING), ('lease_expire', ASCENDING)], name='status_lease_expire'),
+        ],
+        'search':[
+            IndexModel([('title', ASCENDING), ('spidername', ASCENDING)], name='title_spidername', unique=True),
+            IndexModel([('expire_at', ASCENDING)], name='expire_at', expireAfterSeconds=0),
+        ],
+    }
+
+    # Filters of the hot queries, verify_indexes explains them to catch COLLSCAN
+    CANONICAL_QUERIES = [
+        ('movie', {'movieidentity':''}),
+        ('movie', {'spidername':'', 'moviename':'', 'movieurl':''}),
+        ('movie', {'moviename':{'$in':['']}}),
+        ('movie', {'spidername':''}),
+        ('spider', {'spidername':''}),
+        ('spider', {'status':{'$in':['start']}}),
+        ('tool', {'name':''}),
+        ('queue', {'$or':[{'status':'pending'}, {'status':'claimed', 'lease_expire':{'$lt':0}}]}),
+        ('search', {'title':{'$in':['']}}),
+    ]
+
     def __init__(self, settings):
         username = settings.get('MONGO_USER')
         password = settings.get('MONGO_PASSWORD')
@@ -20,6 +62,8 @@ class SpiderMongo:
         spider_coll = settings.get('SPIDER_COLLECTION')
         movie_coll = settings.get('MOVIE_COLLECTION')
         tool_coll = settings.get('TOOL_COLLECTION')
+        queue_coll = settings.get('UPDATE_QUEUE_COLLECTION', 'movies_to_update')
+        search_coll = settings.get('SEARCH_CACHE_COLLECTION', 'search_cache')
 
         self.conn = AsyncIOMotorClient(host=host, port=port, username=username, password=password, authSource=authenticate_db, maxPoolSize=max_pool_size, minPoolSize=min_pool_size)
 
@@ -27,8 +71,13 @@ class SpiderMongo:
         self.spider_coll = self.spider_db[spider_coll]
         self.movie_coll = self.spider_db[movie_coll]
         self.tool_coll = self.spider_db[tool_coll]
+        self.queue_coll = self.spider_db[queue_coll]
+        self.search_coll = self.spider_db[search_coll]
 
         self.func_cacher = {}
+        self.circuit_breaker = CircuitBreaker(settings)
+        self.monitors = (self.circuit_breaker,) if self.circuit_breaker.enabled else ()
+        self.op_stats = MongoOpStats()
 
     def get_database(self):
         return self.spider_db
@@ -40,8 +89,13 @@ class SpiderMongo:
                 if collname+':'+funcname not in self.func_cacher:
                     if collname+'_coll' in vars(self):
                         coll = vars(self)[collname+'_coll']
-                        func = getattr(coll, funcname)
-                        self.func_cacher[collname+':'+funcname] = crud_error_catcher.dcatcher(func)
+                        monitors = (self.op_stats.monitor(collname, funcname),) + self.monitors
+                        if funcname.endswith('_iter'):
+                            func = getattr(coll, funcname[:-len('_iter')])
+                            self.func_cacher[collname+':'+funcname] = crud_error_catcher.scatcher(func, monitors)
+                        else:
+                            func = getattr(coll, funcname)
+                            self.func_cacher[collname+':'+funcname] = crud_error_catcher.dcatcher(func, monitors)
                     else:
                         raise
                 return self.func_cacher[collname+':'+funcname]
@@ -49,5 +103,46 @@ class SpiderMongo:
         except:
             return super().__getattr__(name)
 
+    async def ensure_indexes(self):
+        """Create the indexes one by one, return (collname, index name, error) of the ones that failed"""
+        failed = []
+        for collname, indexes in self.INDEXES.items():
+            created = []
+            for index in indexes:
+                error_count = crud_error_catcher.error_count
+                result = await getattr(self, f'coll_{collname}_create_indexes')([index])
+                if crud_error_catcher.error_count > error_count:
+                    failed.append((collname, index.document['name'], crud_error_catcher.error_messages[-1]))
+                elif result:
+                    created.extend(result)
+            if created:
+                logger.info(f'Indexes of {collname} collection are ready: {created}')
+        return failed
+
+    async def verify_indexes(self):
+        collscans = []
+        for collname, query in self.CANONICAL_QUERIES:
+            coll = vars(self)[collname+'_coll']
+            plan = await coll.find(query).explain()
+            stages = list(self._iter_stages(plan['queryPlanner']['winningPlan']))
+            if 'COLLSCAN' in stages:
+                collscans.append((collname, query))
+                logger.warning(f'Query {query} on {collname} collection falls back to COLLSCAN, plan stages: {stages}')
+            else:
+                logger.info(f'Query {query} on {collname} collection uses plan stages: {stages}')
+        return collscans
+
+    def _iter_stages(self, plan):
+        if 'stage' in plan:
+            yield plan['stage']
+        for key in ('inputStage', 'queryPlan'):
+            if key in plan:
+                yield from self._iter_stages(plan[key])
+        for input_stage in plan.get('inputStages', []):
+            yield from self._iter_stages(input_stage)
+
+    def snapshot(self):
+        return {'operations':self.op_stats.snapshot(), 'breaker':self.circuit_breaker.snapshot()}
+
     def close(self):
         self.conn.close
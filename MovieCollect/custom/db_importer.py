@@ -1,8 +1,16 @@
 from importlib.abc import MetaPathFinder, SourceLoader
 from importlib.util import spec_from_loader
+import hashlib
+import marshal
 import sys
 
+from MovieCollect.custom.utils.misc import LRUCache
+
 code_cacher = {}
+# spidername -> codehash of the code the spider module is loaded from
+codehash_cacher = {}
+# codehash -> marshalled code object, shared by every spider with the same code
+bytecode_cacher = LRUCache(maxsize=1000)
 
 database_module_prefix = 'database_'
 
@@ -40,6 +48,26 @@ class DBSourceLoader(SourceLoader):
         spidername = self.get_spidername(fullname)
         return self.filename_prefix + spidername
 
+    def get_code(self, fullname):
+        spidername = self.get_spidername(fullname)
+        codehash = codehash_cacher.get(spidername)
+        bytecode = bytecode_cacher.get(codehash) if codehash else None
+        if bytecode is not None:
+            return marshal.loads(bytecode)
+        path = self.get_filename(fullname)
+        code = self.source_to_code(self.get_data(path), path)
+        if codehash:
+            bytecode_cacher[codehash] = marshal.dumps(code)
+        return code
+
+
+def hash_code(code):
+    return hashlib.sha1(bytes(code, 'utf8')).hexdigest()
+
+def forget_code(spidername):
+    code_cacher.pop(spidername, None)
+    codehash_cacher.pop(spidername, None)
+
 
 database_meta_finder = DBMetaFinder(database_module_prefix)
 sys.meta_path.insert(0, database_meta_finder)
@@ -0,0 +1,88 @@
+import logging
+
+logger = logging.getLogger(__name__)
+
+class DownloadBudget:
+    """
+    Share GLOBAL_CONCURRENT_REQUESTS in-flight requests between the running
+    crawlers by setting the total concurrency of their downloaders. The
+    budget is water-filled by weight, the weight field of the spider
+    documents (default 1): crawlers that need less than their share get what
+    they need, and what they leave is split between the busier ones. The
+    update crawler keeps UPDATE_CONCURRENT_REQUESTS reserved whether it is
+    busy or not.
+    """
+
+    def __init__(self, crawlerprocess):
+        self.crawlerprocess = crawlerprocess
+        self.settings = crawlerprocess.settings
+        self.budget = self.settings.getint('GLOBAL_CONCURRENT_REQUESTS', 0)
+        self.update_reserve = self.settings.getint('UPDATE_CONCURRENT_REQUESTS', 0)
+        if self.enabled and self.update_reserve > self.budget:
+            logger.warning(f'UPDATE_CONCURRENT_REQUESTS: {self.update_reserve} is bigger than GLOBAL_CONCURRENT_REQUESTS, reserve {self.budget} for the update crawler')
+            self.update_reserve = self.budget
+        self.weights = {}
+        self.allocation = {}
+
+    @property
+    def enabled(self):
+        return self.budget > 0
+
+    def demand(self, crawler):
+        """Requests a crawler could send right now, downloading or waiting in its scheduler"""
+        engine = crawler.engine
+        if not engine:
+            return 0
+        # Older Scrapy only exposes the scheduler on the engine slot
+        scheduler = getattr(engine, 'scheduler', None)
+        if scheduler is None:
+            slot = getattr(engine, 'slot', None)
+            scheduler = slot.scheduler if slot else None
+        if scheduler is None:
+            return 0
+        return len(engine.downloader.active) + len(scheduler)
+
+    def allocate(self, demands, budget):
+        weights = {spidername:self.weights.get(spidername, 1) for spidername in demands}
+        allocation = dict.fromkeys(demands, 0)
+        # Every crawler keeps one request so it can pick up new work, the busiest ones first when the budget is short
+        for spidername in sorted(demands, key=demands.get, reverse=True)[:budget]:
+            allocation[spidername] = 1
+        budget -= sum(allocation.values())
+        active = {spidername:demand-allocation[spidername] for spidername, demand in demands.items() if demand > allocation[spidername]}
+        while active and budget > 0:
+            unit = budget / sum(weights[spidername] for spidername in active)
+            satisfied = [spidername for spidername, demand in active.items() if demand <= weights[spidername] * unit]
+            if not satisfied:
+                shares = {spidername:weights[spidername] * unit for spidername in active}
+                for spidername, share in shares.items():
+                    allocation[spidername] += int(share)
+                    budget -= int(share)
+                # Requests lost to truncation go to the largest remainders
+                for spidername in sorted(shares, key=lambda spidername:shares[spidername]-int(shares[spidername]), reverse=True)[:budget]:
+                    allocation[spidername] += 1
+                break
+            for spidername in satisfied:
+                allocation[spidername] += active[spidername]
+                budget -= active.pop(spidername)
+        return allocation
+
+    def rebalance(self):
+        running_crawlers = self.crawlerprocess.running_crawlers
+        budget = self.budget
+        reserved = {}
+        movie_updater = self.crawlerprocess.movie_updater
+        if self.update_reserve and movie_updater and movie_updater.crawler in running_crawlers.values():
+            spidername = movie_updater._general_spidercls.name
+            reserved[spidername] = self.update_reserve
+            budget -= self.update_reserve
+        demands = {spidername:self.demand(crawler) for spidername, crawler in running_crawlers.items() if spidername not in reserved}
+        allocation = dict(self.allocate(demands, budget), **reserved)
+        for spidername, concurrency in allocation.items():
+            crawler = running_crawlers[spidername]
+            if not crawler.engine or crawler.engine.downloader.total_concurrency == concurrency:
+                continue
+            crawler.engine.downloader.total_concurrency = concurrency
+            crawler.stats.set_value('download_budget/concurrency', concurrency)
+            logger.debug(f'Spider: {spidername} download budget: {concurrency}, demand: {demands.get(spidername)}')
+        self.allocation = allocation
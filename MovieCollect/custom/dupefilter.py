@@ -0,0 +1,209 @@
+import json
+import logging
+import math
+import mmap
+import os
+
+from scrapy import Request
+from scrapy.dupefilters import BaseDupeFilter
+from scrapy.utils.defer import deferred_from_coro
+from scrapy.utils.request import referer_str
+
+from MovieCollect.custom.crud_error_catcher import crud_error_catcher
+from MovieCollect.custom.database import SpiderMongo
+from MovieCollect.custom.utils.misc import create_dir, log_failure
+
+logger = logging.getLogger(__name__)
+
+def dupefilter_dir(settings, spidername):
+    return os.path.join(settings.get('SPIDER_DUPEFILTER_DIR'), spidername)
+
+
+class BloomFilter:
+    """A fixed size Bloom filter whose bits live in a memory-mapped file"""
+
+    def __init__(self, path, capacity, error_rate, count=0):
+        self.path = path
+        self.capacity = capacity
+        self.error_rate = error_rate
+        self.count = count
+        self.bits = int(math.ceil(capacity * math.log(1/error_rate) / math.log(2)**2 / 8)) * 8
+        self.hashes = int(math.ceil(math.log(1/error_rate, 2)))
+        with open(path, 'a+b') as f:
+            if os.path.getsize(path) < self.bits // 8:
+                f.truncate(self.bits // 8)
+        self.file = open(path, 'r+b')
+        self.mm = mmap.mmap(self.file.fileno(), self.bits // 8)
+
+    def _offsets(self, fingerprint):
+        # Fingerprints are already uniform, double hashing on two halves of them
+        h1 = int.from_bytes(fingerprint[:8], 'big')
+        h2 = int.from_bytes(fingerprint[8:16], 'big') | 1
+        return [(h1 + i * h2) % self.bits for i in range(self.hashes)]
+
+    def __contains__(self, fingerprint):
+        mm = self.mm
+        return all(mm[offset >> 3] & (1 << (offset & 7)) for offset in self._offsets(fingerprint))
+
+    def add(self, fingerprint):
+        mm = self.mm
+        for offset in self._offsets(fingerprint):
+            mm[offset >> 3] |= 1 << (offset & 7)
+        self.count += 1
+
+    @property
+    def full(self):
+        return self.count >= self.capacity
+
+    def flush(self):
+        self.mm.flush()
+
+    def close(self):
+        self.mm.flush()
+        self.mm.close()
+        self.file.close()
+
+
+class ScalableBloomFilter:
+    """
+    Bloom filters chained so the filter grows with the fingerprints added to
+    it: once a slice holds its capacity a new one twice as large is added,
+    with an error rate tightened by RATIO so the overall error rate stays
+    under error_rate. The slices are kept in dirname, described by bloom.json,
+    which also records whether the filter has been fully seeded.
+    """
+
+    GROWTH = 2
+    RATIO = 0.9
+
+    def __init__(self, dirname, capacity, error_rate):
+        self.dirname = dirname
+        self.meta_path = os.path.join(dirname, 'bloom.json')
+        create_dir(dirname)
+        self.created = not os.path.exists(self.meta_path)
+        if self.created:
+            meta = {'capacity':capacity, 'error_rate':error_rate, 'slices':[], 'seeded':False}
+        else:
+            with open(self.meta_path, encoding='utf8') as f:
+                meta = json.load(f)
+        self.capacity = meta['capacity']
+        self.error_rate = meta['error_rate']
+        self.seeded = meta.get('seeded', True)
+        self.slices = [self._slice(index, s['count']) for index, s in enumerate(meta['slices'])]
+        if not self.slices:
+            self.grow()
+
+    def _slice(self, index, count=0):
+        capacity = self.capacity * self.GROWTH ** index
+        error_rate = self.error_rate * (1 - self.RATIO) * self.RATIO ** index
+        return BloomFilter(os.path.join(self.dirname, f'bloom-{index}.bin'), capacity, error_rate, count)
+
+    def grow(self):
+        self.slices.append(self._slice(len(self.slices)))
+        self.save()
+
+    def __contains__(self, fingerprint):
+        return any(fingerprint in s for s in reversed(self.slices))
+
+    def add(self, fingerprint):
+        """Add fingerprint, return True if it was already in the filter"""
+        if fingerprint in self:
+            return True
+        if self.slices[-1].full:
+            self.grow()
+        self.slices[-1].add(fingerprint)
+        return False
+
+    def __len__(self):
+        return sum(s.count for s in self.slices)
+
+    def save(self):
+        meta = {
+            'capacity':self.capacity,
+            'error_rate':self.error_rate,
+            'slices':[{'count':s.count} for s in self.slices],
+            'seeded':self.seeded,
+        }
+        with open(self.meta_path+'.tmp', 'w', encoding='utf8') as f:
+            json.dump(meta, f)
+        os.replace(self.meta_path+'.tmp', self.meta_path)
+
+    def flush(self):
+        """Write the bits of every slice to disk before the counts describing them"""
+        for s in self.slices:
+            s.flush()
+        self.save()
+
+    def close(self):
+        self.save()
+        for s in self.slices:
+            s.close()
+
+
+class BloomDupeFilter(BaseDupeFilter):
+    """
+    Dupefilter keeping request fingerprints in a ScalableBloomFilter under
+    SPIDER_DUPEFILTER_DIR/<spider> instead of a set in memory, so it costs a
+    few bits per request and survives the spider: a start keeps it, only
+    restart and delete wipe it. A filter is seeded with the movieurls the
+    spider already collected until one seeding reads them all. Enabled for a spider by
+    SPIDER_BLOOM_DUPEFILTER, in the settings or its custom_settings.
+    """
+
+    def __init__(self, crawler, dirname, capacity, error_rate, seed=True, debug=False):
+        self.crawler = crawler
+        self.spidername = crawler.spidercls.name
+        self.fingerprinter = crawler.request_fingerprinter
+        self.bloom = ScalableBloomFilter(dirname, capacity, error_rate)
+        self.seed = seed and not self.bloom.seeded
+        self.debug = debug
+        self.logdupes = True
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        settings = crawler.settings
+        return cls(
+            crawler,
+            dupefilter_dir(settings, crawler.spidercls.name),
+            settings.getint('SPIDER_DUPEFILTER_CAPACITY', 1000000),
+            settings.getfloat('SPIDER_DUPEFILTER_ERROR_RATE', 0.001),
+            settings.getbool('SPIDER_DUPEFILTER_SEED', True),
+            settings.getbool('DUPEFILTER_DEBUG'),
+        )
+
+    def request_seen(self, request):
+        return self.bloom.add(self.fingerprinter.fingerprint(request))
+
+    def open(self):
+        if self.seed:
+            d = deferred_from_coro(self.seed_movieurls())
+            d.addErrback(log_failure(f'Failed to seed dupefilter of spider: {self.spidername}', logger))
+            return d
+
+    async def seed_movieurls(self):
+        spider_mongo = SpiderMongo(self.crawler.settings)
+        error_count = crud_error_catcher.error_count
+        async for movie in spider_mongo.coll_movie_find_iter({'spidername':self.spidername}, projection={'_id':0, 'movieurl':1}):
+            if movie.get('movieurl'):
+                self.bloom.add(self.fingerprinter.fingerprint(Request(movie['movieurl'])))
+        if crud_error_catcher.error_count > error_count:
+            logger.warning(f'Seeding dupefilter of spider: {self.spidername} is incomplete, seed it again on next open')
+            return
+        self.bloom.seeded = True
+        self.bloom.flush()
+        logger.info(f'Seeded dupefilter of spider: {self.spidername} with {len(self.bloom)} movieurls')
+
+    def checkpoint(self):
+        self.bloom.flush()
+
+    def close(self, reason):
+        self.crawler.stats.set_value('dupefilter/fingerprints', len(self.bloom))
+        self.bloom.close()
+
+    def log(self, request, spider):
+        if self.debug:
+            logger.debug('Filtered duplicate request: %(request)s (referer: %(referer)s)', {'request':request, 'referer':referer_str(request)}, extra={'spider':spider})
+        elif self.logdupes:
+            logger.debug('Filtered duplicate request: %(request)s - no more duplicates will be shown', {'request':request}, extra={'spider':spider})
+            self.logdupes = False
+        spider.crawler.stats.inc_value('dupefilter/filtered')
@@ -0,0 +1,40 @@
+from twisted.internet import task
+
+from scrapy import signals
+from scrapy.exceptions import NotConfigured
+
+from MovieCollect.custom.database import SpiderMongo
+
+class MongoOpStats:
+    """Copy the process-wide SpiderMongo operation metrics into the crawler stats"""
+
+    def __init__(self, stats, spider_mongo, interval=60.0):
+        self.stats = stats
+        self.spider_mongo = spider_mongo
+        self.interval = interval
+        self.task = None
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        interval = crawler.settings.getfloat('MONGOOPSTATS_INTERVAL')
+        if not interval:
+            raise NotConfigured
+        spider_mongo = SpiderMongo(crawler.settings)
+        o = cls(crawler.stats, spider_mongo, interval)
+        crawler.signals.connect(o.spider_opened, signal=signals.spider_opened)
+        crawler.signals.connect(o.spider_closed, signal=signals.spider_closed)
+        return o
+
+    def record(self):
+        for operation, metrics in self.spider_mongo.snapshot()['operations'].items():
+            for name, value in metrics.items():
+                self.stats.set_value(f'mongo/{operation}/{name}', value)
+
+    def spider_opened(self, spider):
+        self.task = task.LoopingCall(self.record)
+        self.task.start(self.interval)
+
+    def spider_closed(self, spider, reason):
+        if self.task and self.task.running:
+            self.task.stop()
+        self.record()
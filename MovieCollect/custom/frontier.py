@@ -0,0 +1,56 @@
+import logging
+import os
+
+from twisted.internet import task
+from scrapy.core.scheduler import Scheduler
+
+logger = logging.getLogger(__name__)
+
+def frontier_dir(settings, spidername):
+    return os.path.join(settings.get('SPIDER_FRONTIER_DIR'), spidername)
+
+
+class FrontierScheduler(Scheduler):
+    """
+    Scheduler keeping the frontier of a spider under its JOBDIR. Requests go
+    to the disk queues and are only loaded when they are popped, so memory no
+    longer grows with the frontier, and the seen fingerprints are kept in the
+    same directory by the dupefilter. Scrapy only writes the queue state when
+    the spider closes, so it is checkpointed every SPIDER_FRONTIER_CHECKPOINT_INTERVAL
+    seconds as well, a crashed spider then resumes from its last checkpoint.
+    """
+
+    def open(self, spider):
+        d = super().open(spider)
+        interval = spider.crawler.settings.getfloat('SPIDER_FRONTIER_CHECKPOINT_INTERVAL', 30)
+        self.checkpoint_task = task.LoopingCall(self.checkpoint)
+        if self.dqdir and interval > 0:
+            self.checkpoint_task.start(interval, now=False)
+        return d
+
+    def checkpoint(self):
+        # Closing the disk queues flushes their files, they are opened again from the saved state
+        state = self.dqs.close()
+        self._write_dqs_state(self.dqdir, state)
+        self.dqs = self._dq_reopen()
+        if hasattr(self.df, 'checkpoint'):
+            self.df.checkpoint()
+        elif getattr(self.df, 'file', None):
+            self.df.file.flush()
+        self.stats.inc_value('frontier/checkpoints')
+        logger.debug(f'Checkpointed frontier of spider: {self.spider.name}, {len(self.dqs)} requests on disk')
+
+    def _dq_reopen(self):
+        # _dq logs every reopen as a resumed crawl
+        scheduler_logger = logging.getLogger(Scheduler.__module__)
+        level = scheduler_logger.level
+        scheduler_logger.setLevel(logging.WARNING)
+        try:
+            return self._dq()
+        finally:
+            scheduler_logger.setLevel(level)
+
+    def close(self, reason):
+        if self.checkpoint_task.running:
+            self.checkpoint_task.stop()
+        return super().close(reason)
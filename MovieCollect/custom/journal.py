@@ -0,0 +1,260 @@
+import asyncio
+import atexit
+import logging
+import os
+import queue
+import threading
+import time
+
+from bson import json_util
+from bson.errors import InvalidBSON
+from pymongo import InsertOne, ReplaceOne, UpdateMany, UpdateOne
+from pymongo.errors import BulkWriteError, PyMongoError
+
+logger = logging.getLogger(__name__)
+
+UPDATE_OPTIONS = ('upsert', 'collation', 'array_filters', 'hint')
+# Movie documents carry the time of their last write, a replayed entry only applies to older documents
+WRITE_TIME_FIELD = 'updated_time'
+DUPLICATE_KEY_ERROR = 11000
+
+def journaled_collections(settings):
+    """
+    Only movie writes are journaled, they are item upserts that can be applied
+    again as long as no newer write reached the document. Spider status and
+    update queue writes would roll back whatever happened while mongo was down.
+    """
+    return {settings.get('MOVIE_COLLECTION')}
+
+
+class JournaledUpdateOne(UpdateOne):
+    """UpdateOne keeping its arguments, so the request can be journaled if its bulk_write fails"""
+
+    __slots__ = ('journal_entry',)
+
+    def __init__(self, filter, update, upsert=False):
+        super().__init__(filter, update, upsert=upsert)
+        self.journal_entry = {'operation':'update_one', 'filter':filter, 'update':update, 'options':{'upsert':upsert}}
+
+
+def journal_entries(func, args, kwargs, collections):
+    """Turn a failed write call on a motor collection into replayable journal entries"""
+    collection = func.__self__.name
+    operation = func.__name__
+    if collection not in collections:
+        return
+    if operation == 'bulk_write':
+        requests = args[0] if args else kwargs.get('requests', [])
+        for request in requests:
+            entry = getattr(request, 'journal_entry', None)
+            if entry is None:
+                logger.warning(f'{type(request).__name__} on {collection} collection cannot be journaled, skip it')
+                continue
+            yield dict(entry, collection=collection)
+    elif operation in ('update_one', 'update_many', 'replace_one'):
+        yield {'collection':collection, 'operation':operation, 'filter':args[0], 'update':args[1], 'options':kwargs}
+    elif operation == 'insert_one':
+        yield {'collection':collection, 'operation':operation, 'document':args[0]}
+    elif operation == 'insert_many':
+        for document in args[0]:
+            yield {'collection':collection, 'operation':'insert_one', 'document':document}
+    else:
+        logger.warning(f'Operation: {operation} on {collection} collection cannot be replayed, it is not journaled')
+
+def guard_filter(entry):
+    """
+    Filter of an update entry restricted to documents not written after the
+    entry was journaled. A superseded upsert then fails on the unique index
+    instead of reverting the newer document.
+    """
+    filter = entry['filter']
+    if 'journaled_at' not in entry or WRITE_TIME_FIELD in filter:
+        return filter
+    return dict(filter, **{WRITE_TIME_FIELD:{'$not':{'$gt':entry['journaled_at']}}})
+
+def entry_to_request(entry):
+    operation = entry['operation']
+    options = {k:v for k,v in entry.get('options', {}).items() if k in UPDATE_OPTIONS}
+    if operation in ('update_one', 'update_many', 'replace_one'):
+        entry = dict(entry, filter=guard_filter(entry))
+    if operation == 'update_one':
+        return UpdateOne(entry['filter'], entry['update'], **options)
+    elif operation == 'update_many':
+        return UpdateMany(entry['filter'], entry['update'], **options)
+    elif operation == 'replace_one':
+        options.pop('array_filters', None)
+        return ReplaceOne(entry['filter'], entry['update'], **options)
+    elif operation == 'insert_one':
+        return InsertOne(entry['document'])
+
+
+class WriteJournal:
+    """
+    Append-only JSON lines journal of failed write operations. Entries are
+    stamped with journaled_at and serialized on the calling thread, then
+    written, in batches and fsynced, by a background thread.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.queue = queue.Queue()
+        self.thread = threading.Thread(target=self._run, name='WriteJournal', daemon=True)
+        self.thread.start()
+        atexit.register(self.close)
+
+    def record(self, entries):
+        journaled_at = time.time()
+        for entry in entries:
+            try:
+                line = json_util.dumps(dict(entry, journaled_at=journaled_at))
+            except TypeError:
+                logger.error(f'Journal entry of {entry["operation"]} on {entry["collection"]} collection cannot be serialized, skip it', exc_info=True)
+            else:
+                self.queue.put(line)
+
+    def _run(self):
+        while True:
+            lines = [self.queue.get()]
+            while True:
+                try:
+                    lines.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            stop = None in lines
+            lines = [line for line in lines if line is not None]
+            if lines:
+                try:
+                    with self.lock, open(self.path, 'a', encoding='utf8') as f:
+                        f.write('\n'.join(lines)+'\n')
+                        f.flush()
+                        os.fsync(f.fileno())
+                except OSError:
+                    logger.critical(f'Failed to write {len(lines)} entries into journal: {self.path}', exc_info=True)
+            if stop:
+                break
+
+    def compact(self, offset, reset_checkpoint):
+        """
+        Truncate the journal if everything up to its end has been replayed.
+        The checkpoint is reset first, a crash in between replays the
+        idempotent entries again instead of pointing past the end.
+        """
+        with self.lock:
+            if os.path.exists(self.path) and os.path.getsize(self.path) == offset:
+                reset_checkpoint()
+                os.truncate(self.path, 0)
+                return True
+        return False
+
+    def close(self):
+        if self.thread.is_alive():
+            self.queue.put(None)
+            self.thread.join()
+
+
+class JournalReplayer:
+    """
+    Re-apply journaled writes to mongo in unordered bulk batches of
+    CRUD_REPLAY_BATCH_SIZE, limited to CRUD_REPLAY_RATE operations per second.
+    The journal offset is checkpointed after every batch so a replay resumes
+    where the last one stopped. Writes superseded by newer ones are skipped.
+    """
+
+    def __init__(self, crawlerprocess, journal):
+        self.settings = crawlerprocess.settings
+        self.spider_mongo = crawlerprocess.spider_mongo
+        self.journal = journal
+        self.collections = journaled_collections(self.settings)
+        self.checkpoint_file = journal.path + '.checkpoint'
+        self.batch_size = self.settings.getint('CRUD_REPLAY_BATCH_SIZE', 500)
+        self.rate = self.settings.getfloat('CRUD_REPLAY_RATE', 1000)
+        self.replaying = False
+
+    def read_checkpoint(self):
+        try:
+            with open(self.checkpoint_file) as f:
+                offset = int(f.read().strip() or 0)
+        except (OSError, ValueError):
+            return 0
+        if os.path.exists(self.journal.path) and offset > os.path.getsize(self.journal.path):
+            logger.warning(f'Checkpoint {offset} is past the end of journal: {self.journal.path}, replay it from the start')
+            return 0
+        return offset
+
+    def write_checkpoint(self, offset):
+        tmp_file = self.checkpoint_file + '.tmp'
+        with open(tmp_file, 'w') as f:
+            f.write(str(offset))
+        os.replace(tmp_file, self.checkpoint_file)
+
+    async def replay(self):
+        if self.replaying:
+            return
+        offset = self.read_checkpoint()
+        if not os.path.exists(self.journal.path) or os.path.getsize(self.journal.path) <= offset:
+            return
+        self.replaying = True
+        try:
+            await self.spider_mongo.get_database().command('ping')
+            offset = await self._replay(offset)
+            if self.journal.compact(offset, lambda:self.write_checkpoint(0)):
+                logger.info(f'Journal: {self.journal.path} has been replayed completely')
+        except PyMongoError as e:
+            logger.warning(f'Mongo is not healthy, stop replaying journal: {e}')
+        finally:
+            self.replaying = False
+
+    async def _replay(self, offset):
+        db = self.spider_mongo.get_database()
+        with open(self.journal.path, 'rb') as f:
+            f.seek(offset)
+            while True:
+                collection, requests, end = self._read_batch(f, offset)
+                if end == offset:
+                    return offset
+                if requests and collection in self.collections:
+                    try:
+                        await db[collection].bulk_write(requests, ordered=False)
+                    except BulkWriteError as e:
+                        errors = [error for error in e.details['writeErrors'] if error['code'] != DUPLICATE_KEY_ERROR]
+                        superseded = len(e.details['writeErrors']) - len(errors)
+                        if superseded:
+                            logger.info(f'{superseded} journaled writes on {collection} are superseded by newer writes, skip them')
+                        if errors:
+                            logger.error(f'{len(errors)} journaled writes on {collection} cannot be replayed: {errors}')
+                offset = end
+                self.write_checkpoint(offset)
+                logger.info(f'Replayed {len(requests)} journaled writes on {collection}, journal offset: {offset}')
+                await asyncio.sleep(len(requests)/self.rate)
+
+    def _read_batch(self, f, offset):
+        collection = None
+        requests = []
+        while len(requests) < self.batch_size:
+            position = f.tell()
+            line = f.readline()
+            if not line.endswith(b'\n'):
+                f.seek(position)
+                break
+            try:
+                entry = json_util.loads(line)
+                entry_collection = entry['collection']
+            except (ValueError, TypeError, KeyError, InvalidBSON):
+                logger.error(f'Corrupt journal entry at offset {offset} of {self.journal.path}, skip it: {line[:200]!r}')
+                offset += len(line)
+                continue
+            if collection is not None and entry_collection != collection:
+                f.seek(position)
+                break
+            collection = entry_collection
+            offset += len(line)
+            if collection not in self.collections:
+                logger.warning(f'Journaled operation: {entry["operation"]} on {collection} collection is not replayed anymore, skip it')
+                continue
+            request = entry_to_request(entry)
+            if request is None:
+                logger.error(f'Journaled operation: {entry["operation"]} cannot be replayed, skip it')
+            else:
+                requests.append(request)
+        return collection, requests, offset
@@ -9,7 +9,7 @@ from scrapy.interfaces import ISpiderLoader
 from scrapy.utils.spider import iter_spider_classes
 
 from MovieCollect.custom.database import SpiderMongo
-from MovieCollect.custom.db_importer import code_cacher, database_module_prefix
+from MovieCollect.custom.db_importer import bytecode_cacher, code_cacher, codehash_cacher, database_module_prefix, hash_code
 from MovieCollect.custom.utils.exceptions import SpiderNotFoundError
 
 logger = logging.getLogger(__name__)
@@ -24,19 +24,33 @@ class SpiderLoader:
 
     def __init__(self, settings):
         self.spider_mongo = SpiderMongo(settings)
+        self.codehash_maintained = settings.getbool('SPIDER_CODEHASH_MAINTAINED', False)
         self._spiders = {}
 
     def get_spidermodule_name(self, spidername):
         return database_module_prefix + spidername
 
-    async def update_code_cacher(self, spidername):
-        spider_code = await self.spider_mongo.coll_spider_find_one({'spidername':spidername},{'code':1})
-        code_cacher[spidername] = spider_code['code']
+    async def update_code_cacher(self, spidernames):
+        """
+        Fetch the code of spidernames with one query, return {spidername:changed}
+        where changed tells if the code differs from the code its module was
+        imported from. The hash is always taken from the fetched code.
+        """
+        fetched = {}
+        async for spider_code in self.spider_mongo.coll_spider_find_iter({'spidername':{'$in':list(spidernames)}}, projection={'_id':0, 'spidername':1, 'code':1}):
+            spidername = spider_code['spidername']
+            codehash = hash_code(spider_code['code'])
+            loaded = self.get_spidermodule_name(spidername) in sys.modules
+            code_cacher[spidername] = spider_code['code']
+            fetched[spidername] = codehash != codehash_cacher.get(spidername) or not loaded
+            codehash_cacher[spidername] = codehash
+        return fetched
 
-    async def preload(self, spidername):
-        await self.update_code_cacher(spidername)
+    def _load_module(self, spidername, reload=True):
         spidermodule_name = self.get_spidermodule_name(spidername)
         if spidermodule_name in sys.modules:
+            if not reload:
+                return
             imreload(sys.modules[spidermodule_name])
         else:
             import_module(spidermodule_name)
@@ -44,6 +58,46 @@ class SpiderLoader:
         spider = getattr(spidermodule, spidername)
         assert (spider in iter_spider_classes(spidermodule) and spider.name == spidername)
 
+    async def preload(self, spidername):
+        await self.preload_many([spidername])
+
+    async def preload_many(self, spidernames):
+        """
+        Import the spider modules of spidernames, with one query for all of
+        them. Modules whose code hash did not change are left as they are, and
+        code already compiled under the same hash is not compiled again. The
+        code is only left unfetched when SPIDER_CODEHASH_MAINTAINED says every
+        writer of spider code keeps the codehash field of the document up to
+        date, otherwise it is fetched and hashed on every call.
+        """
+        if not spidernames:
+            return
+        found = set()
+        changed = set()
+        fetch = list(spidernames)
+        if self.codehash_maintained:
+            fetch = []
+            async for spider in self.spider_mongo.coll_spider_find_iter({'spidername':{'$in':list(spidernames)}}, projection={'_id':0, 'spidername':1, 'codehash':1}):
+                spidername, codehash = spider['spidername'], spider.get('codehash')
+                found.add(spidername)
+                loaded = self.get_spidermodule_name(spidername) in sys.modules
+                if codehash and codehash == codehash_cacher.get(spidername) and loaded:
+                    continue
+                if codehash and codehash in bytecode_cacher:
+                    codehash_cacher[spidername] = codehash
+                    changed.add(spidername)
+                else:
+                    fetch.append(spidername)
+        if fetch:
+            fetched = await self.update_code_cacher(fetch)
+            found.update(fetched)
+            changed.update(spidername for spidername, code_changed in fetched.items() if code_changed)
+        missing = set(spidernames) - found
+        if missing:
+            raise SpiderNotFoundError(f'Spiders: {sorted(missing)} can not be found in database')
+        for spidername in spidernames:
+            self._load_module(spidername, reload=spidername in changed)
+
     @classmethod
     def from_settings(cls, settings):
         return cls(settings)
@@ -0,0 +1,55 @@
+from bisect import bisect_left
+
+LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5)
+
+class OperationMetrics:
+    """Call, error and in-flight counts plus a latency histogram of one accessor"""
+
+    def __init__(self):
+        self.calls = 0
+        self.errors = 0
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.total_latency = 0.0
+        self.histogram = [0] * (len(LATENCY_BUCKETS)+1)
+
+    def enter(self):
+        self.calls += 1
+        self.in_flight += 1
+        if self.in_flight > self.max_in_flight:
+            self.max_in_flight = self.in_flight
+
+    def leave(self, elapsed, exp):
+        self.in_flight -= 1
+        if exp is not None:
+            self.errors += 1
+        self.total_latency += elapsed
+        self.histogram[bisect_left(LATENCY_BUCKETS, elapsed)] += 1
+
+    def snapshot(self):
+        finished = self.calls - self.in_flight
+        snapshot = {
+            'calls':self.calls,
+            'errors':self.errors,
+            'in_flight':self.in_flight,
+            'max_in_flight':self.max_in_flight,
+            'avg_latency':self.total_latency/finished if finished else 0.0,
+        }
+        for bucket, count in zip(LATENCY_BUCKETS+('inf',), self.histogram):
+            snapshot[f'latency_le_{bucket}'] = count
+        return snapshot
+
+class MongoOpStats:
+    """Metrics of every coll_<collection>_<operation> accessor of SpiderMongo"""
+
+    def __init__(self):
+        self.operations = {}
+
+    def monitor(self, collname, funcname):
+        key = collname+'/'+funcname
+        if key not in self.operations:
+            self.operations[key] = OperationMetrics()
+        return self.operations[key]
+
+    def snapshot(self):
+        return {key:metrics.snapshot() for key, metrics in self.operations.items()}
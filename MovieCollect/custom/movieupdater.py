@@ -1,16 +1,32 @@
+import asyncio
 import inspect
 import logging
 import importlib
 import sys
+import time
   
-from twisted.internet import defer
+from twisted.internet import defer, task
 from twisted.python.failure import Failure
-from scrapy.http import Request, Response
+from scrapy import signals
+from scrapy.exceptions import DontCloseSpider
 from scrapy.utils.defer import deferred_from_coro
 
+from MovieCollect.custom.crud_error_catcher import crud_error_catcher
+from MovieCollect.custom.updatelatency import update_latency_tracker
+from MovieCollect.custom.updateplanner import UpdatePlanner
+from MovieCollect.custom.updatetracker import UpdateTracker
+from MovieCollect.custom.utils.misc import log_failure
+
 logger = logging.getLogger(__name__)
 
 class MovieUpdater:
+    """
+    Keep one update crawler open for the whole process. Movies claimed while
+    the crawler bootstraps are buffered, later movies are fed to the running
+    crawler, and every movie is removed from the update queue as soon as its
+    own requests are finished.
+    """
+
     def __init__(self, crawlerprocess):
         self.crawlerprocess = crawlerprocess
         self.settings = crawlerprocess.settings
@@ -19,22 +35,47 @@ class MovieUpdater:
 
         self.creating_crawler = False
         self.ready = False
-        self.finished_spiders = []
+        self.finished_spiders = set()
+        self.feed_chunk = self.settings.getint('UPDATE_FEED_CHUNK', 100)
+        self.request_priority = self.settings.getint('UPDATE_REQUEST_PRIORITY', 100)
+        self.concurrent_requests = self.settings.getint('UPDATE_CONCURRENT_REQUESTS', 0)
         self.spider_cacher = {}
         self.searchable_spiders_cacher = {}
         self.updating_movies = set()
+        self.buffered_movies = set()
+        self.spiders_refresh_interval = self.settings.getfloat('UPDATE_SPIDERS_REFRESH_INTERVAL', 600)
+        self._last_spiders_refresh = 0
+        self.search_cache = crawlerprocess.search_cache
+        self.search_fanout = crawlerprocess.search_fanout if self.settings.getbool('UPDATE_SEARCH_FANOUT', False) else None
+        self.update_tracker = UpdateTracker(self.settings, self.search_fanout)
+        self.check_task = None
         self._general_spidercls = None
         self.crawler = None
 
     async def initial(self):
         self._general_spidercls = self._get_general_spidercls()
-        finished_spiders = await self.spider_mongo.coll_spider_find({'status':'finished'}, {'spidername':1})
-        if not finished_spiders:
+        await self.refresh_spiders()
+        if not self.finished_spiders:
             self.crawlerprocess.movie_updater = None
             logger.info('No finished spider found, destroy movieupdater')
+
+    async def refresh_spiders(self):
+        """
+        Reload finished and searchable spiders, the sets are updated in place
+        as planners and search fanout share them. A failed read keeps them.
+        """
+        self._last_spiders_refresh = time.time()
+        finished_spiders = set()
+        error_count = crud_error_catcher.error_count
+        async for fs in self.spider_mongo.coll_spider_find_iter({'status':'finished'}, projection={'_id':0, 'spidername':1}):
+            finished_spiders.add(fs['spidername'])
+        if crud_error_catcher.error_count > error_count:
+            logger.warning('Failed to reload finished spiders, keep the current ones')
             return
-        for fs in finished_spiders:
-            self.finished_spiders.append(fs['spidername'])
+        for spidername in self.finished_spiders - finished_spiders:
+            self.spider_cacher.pop(spidername, None)
+        self.finished_spiders.intersection_update(finished_spiders)
+        self.finished_spiders.update(finished_spiders)
         await self.get_searchable_spiders()
 
     def _get_general_spidercls(self):
@@ -55,49 +96,122 @@ class MovieUpdater:
         return spidercls
 
     async def get_movie_spider(self, spidername):
-        if spidername not in self.spider_cacher:
-            await self.spider_loader.preload(spidername)
-            spidercls =  self.spider_loader.load(spidername)
-            self.spider_cacher[spidername] = spidercls(spider_mongo=self.spider_mongo)
-        return self.spider_cacher[spidername]
+        spiders = await self.get_movie_spiders([spidername])
+        return spiders[spidername]
+
+    async def get_movie_spiders(self, spidernames):
+        """Spider instances of spidernames, the ones not cached yet are preloaded with one query"""
+        missing = [spidername for spidername in spidernames if spidername not in self.spider_cacher]
+        if missing:
+            await self.spider_loader.preload_many(missing)
+            for spidername in missing:
+                spidercls =  self.spider_loader.load(spidername)
+                self.spider_cacher[spidername] = spidercls(spider_mongo=self.spider_mongo)
+        return {spidername:self.spider_cacher[spidername] for spidername in spidernames}
     
     def get_new_movies(self, movies):
         new_movies = set(movies) - self.updating_movies
-        self.updating_movies = set(movies)
+        self.updating_movies |= new_movies
         return new_movies
 
     async def get_searchable_spiders(self):
-        spider_entries = await self.spider_mongo.coll_spider_find({'status':'finished', 'searchable':True}, {'_id':0,'spidername':1})
-        for se in spider_entries:
-            spider = await self.get_movie_spider(se['spidername'])
-            self.searchable_spiders_cacher[se['spidername']] = spider
+        searchable_spiders = set()
+        error_count = crud_error_catcher.error_count
+        async for se in self.spider_mongo.coll_spider_find_iter({'status':'finished', 'searchable':True}, projection={'_id':0,'spidername':1}):
+            searchable_spiders.add(se['spidername'])
+        if crud_error_catcher.error_count > error_count:
+            logger.warning('Failed to reload searchable spiders, keep the current ones')
+            return
+        self.searchable_spiders_cacher.update(await self.get_movie_spiders(list(searchable_spiders)))
+        for spidername in set(self.searchable_spiders_cacher) - searchable_spiders:
+            del self.searchable_spiders_cacher[spidername]
 
     async def update_movies(self, movies):
-        if not self.creating_crawler:
-            new_movies = self.get_new_movies(movies)
-            if not new_movies:
-                return
-            self.creating_crawler = True
-            update_requests = await self.get_update_requests(new_movies)
-            self._general_spidercls.update_requests = update_requests
-            logger.info(f'Create crawler to scrape new requests: {update_requests}')
-            self._crawl()
-        elif self.ready == False or not self.crawler.engine.slot or self.crawler.engine.spider_is_idle(self.crawler.spider):
-            logger.info('Ignore requests because MovieUpdater is not ready or crawler is idle')
+        new_movies = self.get_new_movies(movies)
+        if not new_movies:
             return
-        else:
-            new_movies = self.get_new_movies(movies)
-            if not new_movies:
-                return
-            update_requests = await self.get_update_requests(new_movies)
-            logger.info(f'Use crawler which is already exists to scrape new requests: {update_requests}')
-            for ur in update_requests:
-                self.crawler.engine.crawl(ur, self.crawler.spider)
+        if not self.ready:
+            self.buffered_movies |= new_movies
+            logger.info(f'Buffer movies until update crawler is ready: {new_movies}')
+            if not self.creating_crawler:
+                self.creating_crawler = True
+                self._crawl()
+            return
+        await self.feed_movies(new_movies)
+
+    async def feed_movies(self, movies):
+        update_requests = await self.get_update_requests(movies)
+        self.update_tracker.start(movies)
+        logger.info(f'Feed update crawler with requests of movies: {movies}')
+        for i, ur in enumerate(update_requests, 1):
+            ur.priority = max(ur.priority, self.request_priority)
+            self.crawler.engine.crawl(ur, self.crawler.spider)
+            if i % self.feed_chunk == 0:
+                await asyncio.sleep(0)
+
+    def _spider_opened(self, spider):
+        self.ready = True
+        update_latency_tracker.open(self.crawler)
+        self.check_task = task.LoopingCall(self._check_movies)
+        self.check_task.start(self.update_tracker.grace, now=False).addErrback(log_failure('Checking updated movies failed', logger))
+        buffered_movies, self.buffered_movies = self.buffered_movies, set()
+        if buffered_movies:
+            d = deferred_from_coro(self.feed_movies(buffered_movies))
+            d.addErrback(log_failure(f'Failed to feed buffered movies: {buffered_movies}', logger))
+
+    def _check_movies(self):
+        finished_movies = self.update_tracker.pop_finished()
+        if finished_movies:
+            self.updating_movies.difference_update(finished_movies)
+            if self.search_fanout:
+                for moviename in finished_movies:
+                    self.search_fanout.finish(moviename)
+            self.crawler.stats.inc_value('update/movies_finished', len(finished_movies))
+            logger.debug(f'Movies have been updated: {finished_movies}')
+            d = deferred_from_coro(self.crawlerprocess.update_queue.done(finished_movies))
+            d.addErrback(log_failure(f'Failed to remove updated movies from update queue: {finished_movies}', logger))
+        if time.time() - self._last_spiders_refresh >= self.spiders_refresh_interval:
+            d = deferred_from_coro(self.refresh_spiders())
+            d.addErrback(log_failure('Failed to refresh finished spiders', logger))
+
+    def crawler_settings(self):
+        # Update requests are handed out again by the update queue, they are never resumed from a frontier.
+        # The crawler lives as long as the process and a movie requested again has to be fetched again,
+        # so it keeps no dupefilter at all, neither the persistent one nor Scrapy's in-memory set
+        custom_settings = dict(
+            self._general_spidercls.custom_settings or {},
+            SPIDER_FRONTIER_ENABLED=False,
+            SPIDER_BLOOM_DUPEFILTER=False,
+            DUPEFILTER_CLASS='scrapy.dupefilters.BaseDupeFilter',
+        )
+        if self.concurrent_requests:
+            # Capacity reserved for update requests, apart from the bulk crawlers
+            custom_settings.update(
+                CONCURRENT_REQUESTS=self.concurrent_requests,
+                CONCURRENT_REQUESTS_PER_DOMAIN=self.concurrent_requests,
+            )
+        return custom_settings
 
     def _crawl(self):
         from MovieCollect.custom.crawler import AutoCrawler
         spidername = self._general_spidercls.name
+        self._general_spidercls.search_fanout = self.search_fanout
+        self._general_spidercls.search_cache = self.search_cache
+        self._general_spidercls.update_tracker = self.update_tracker
+        self._general_spidercls.custom_settings = self.crawler_settings()
         self.crawler = crawler = AutoCrawler(self._general_spidercls, self.settings)
+        crawler.signals.connect(self._spider_opened, signal=signals.spider_opened)
+        crawler.signals.connect(self._spider_idle, signal=signals.spider_idle)
+        crawler.signals.connect(self.update_tracker.request_scheduled, signal=signals.request_scheduled)
+        crawler.signals.connect(self.update_tracker.request_left, signal=signals.request_left_downloader)
+        crawler.signals.connect(self.update_tracker.request_left, signal=signals.request_dropped)
+        crawler.signals.connect(self.update_tracker.response_received, signal=signals.response_received)
+        crawler.signals.connect(self.update_tracker.spider_error, signal=signals.spider_error)
+        crawler.signals.connect(self.update_tracker.item_left, signal=signals.item_scraped)
+        crawler.signals.connect(self.update_tracker.item_left, signal=signals.item_dropped)
+        crawler.signals.connect(self.update_tracker.item_left, signal=signals.item_error)
+        if self.search_fanout:
+            crawler.signals.connect(self.search_fanout.item_scraped, signal=signals.item_scraped)
         crawl_defer = crawler.crawl()
 
         @defer.inlineCallbacks
@@ -116,59 +230,46 @@ class MovieUpdater:
                 LEVEL = logging.INFO
             del self.crawlerprocess.running_crawlers[spidername]
             self.crawlerprocess._active.discard(crawl_defer)
-            yield deferred_from_coro(self.spider_mongo.coll_tool_update_one({'name':'movies_to_update'}, {'$pullAll':{'funcfield':list(self.updating_movies)}}))
+            if self.search_fanout:
+                self.search_fanout.close()
+            if self.search_cache:
+                self.search_cache.close()
+            update_latency_tracker.close()
+            if self.check_task and self.check_task.running:
+                self.check_task.stop()
+            self._check_movies()
+            # Movies whose requests are not finished go back to the queue
+            yield deferred_from_coro(self.crawlerprocess.update_queue.release(self.updating_movies))
             logger.log(LEVEL, message)
             self.crawlerprocess.movie_updater = None
             return result
 
         if getattr(crawl_defer, 'result', None) is not None and issubclass(crawl_defer.result.type, Exception):
-            self.crawlerprocess.movieupdater = None
+            self.crawlerprocess.movie_updater = None
             logger.error(f'Spider: {spidername} bootstrap failed, error msg: {crawl_defer.result.getTraceback()}')
+            d = deferred_from_coro(self.crawlerprocess.update_queue.release(self.updating_movies))
+            d.addErrback(log_failure(f'Failed to release movies: {self.updating_movies}', logger))
         else:
-            self.ready = True
             message = f'Running spider: {spidername}.'
             self.crawlerprocess.running_crawlers[spidername] = crawler
             self.crawlerprocess._active.add(crawl_defer)
+            if self.search_fanout:
+                self.search_fanout.open(crawler, self.searchable_spiders_cacher)
+            if self.search_cache:
+                self.search_cache.open(crawler)
             logger.info(message)
             crawl_defer.addBoth(_done)
 
+    def _spider_idle(self, spider):
+        # The update crawler waits for more movies instead of closing
+        raise DontCloseSpider
+
     async def get_update_requests(self, movies):
         movies = list(movies)
-        movie_entries = await self.spider_mongo.coll_movie_aggregate([{'$match':{'moviename':{'$in':movies}}},{'$group':{'_id':'$moviename', 'info':{'$push':{'spidername':'$spidername','movieidentity':'$movieidentity', 'movieurl':'$movieurl'}}}}])
-        update_requests = []
-
-        for me in movie_entries:
-            moviename = me['_id']
-            moviebriefs = me['info']
-
-            spider_used = []
-            for mb in moviebriefs:
-                spidername = mb['spidername']
-                movieidentity = mb['movieidentity']
-                movieurl = mb['movieurl']
-                if spidername in self.finished_spiders:
-                    spider = await self.get_movie_spider(spidername)
-                    spider_used.append(spidername)
-                    request = Request(movieurl, callback=spider.parse_movie, dont_filter=False, meta={'movie_identity':movieidentity})
-                    update_requests.append(request)
-            for sname, sspider in self.searchable_spiders_cacher.items():
-                if sname not in spider_used:
-                    if hasattr(sspider, 'get_search_request'):
-                        srequest = sspider.get_search_request(moviename)
-                        update_requests.append(srequest)
-                    else:
-                        logger.error(f'Spider: {sname} is searchable but lack of get_search_requests method')
-            movies.remove(moviename)
-
-        for movie in movies:
-            for sname, sspider in self.searchable_spiders_cacher.items():
-                if hasattr(sspider, 'get_search_request'):
-                    srequest = sspider.get_search_request(movie)
-                    update_requests.append(srequest)
-                else:
-                    logger.error(f'Spider: {sname} is searchable but lack of get_search_requests method')
-
-        return update_requests
-
-
-
+        planner = UpdatePlanner(self.finished_spiders, self.searchable_spiders_cacher, self.search_fanout, self.search_cache)
+        if self.search_cache:
+            await self.search_cache.preload(movies, self.searchable_spiders_cacher)
+        async for me in self.spider_mongo.coll_movie_aggregate_iter([{'$match':{'moviename':{'$in':movies}}},{'$group':{'_id':'$moviename', 'info':{'$push':{'spidername':'$spidername','movieidentity':'$movieidentity', 'movieurl':'$movieurl'}}}}]):
+            planner.add(me['_id'], me['info'])
+        movie_spiders = await self.get_movie_spiders(list(planner.spidernames))
+        return planner.iter_requests(movies, movie_spiders)
@@ -7,7 +7,9 @@ from twisted.python.failure import Failure
 from twisted.internet import defer
 from scrapy.utils.defer import deferred_from_coro
 
-from MovieCollect.custom.db_importer import code_cacher
+from MovieCollect.custom.db_importer import forget_code
+from MovieCollect.custom.dupefilter import dupefilter_dir
+from MovieCollect.custom.frontier import frontier_dir
 from MovieCollect.custom.utils.exceptions import SpiderExistError, SpiderNotRunningError
 from MovieCollect.custom.utils.misc import delete_dir
 
@@ -35,6 +37,11 @@ class CheckCrawlerRunningMixin:
 
 
 class start(Worker):
+    # A fresh run drops the frontier left by the last one, the dupefilter is
+    # kept so requests seen by earlier runs stay filtered
+    clear_frontier = True
+    clear_dupefilter = False
+
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
         self.spiderloader = self.crawlerprocess.spider_loader
@@ -45,6 +52,7 @@ class start(Worker):
         spidermodule_name = self.spiderloader.get_spidermodule_name(spidername)
         if spidermodule_name in sys.modules or spidername in self.crawlerprocess.running_crawlers:
             raise SpiderExistError(f'Spider :{spidername} is already imported or running.')
+        yield deferred_from_coro(self.crawlerprocess.spider_lease.acquire(spidername))
         yield deferred_from_coro(self.spiderloader.preload(spidername))
 
 
@@ -52,6 +60,10 @@ class start(Worker):
     def change_status(self, spidername):
         from MovieCollect.custom.crawler import AutoCrawler
 
+        if self.clear_frontier and self.settings.get('SPIDER_FRONTIER_DIR'):
+            delete_dir(frontier_dir(self.settings, spidername))
+        if self.clear_dupefilter and self.settings.get('SPIDER_DUPEFILTER_DIR'):
+            delete_dir(dupefilter_dir(self.settings, spidername))
         spider = self.spiderloader.load(spidername)
         crawler = AutoCrawler(spider, self.settings)
         crawl_defer = crawler.crawl()
@@ -73,12 +85,17 @@ class start(Worker):
             del self.crawlerprocess.running_crawlers[spidername]
             self.crawlerprocess._active.discard(crawl_defer)
             logger.log(LEVEL, message)
+            if getattr(crawler, 'lease_lost', False):
+                # The spider belongs to another node now, leave its status alone
+                return result
             yield deferred_from_coro(self.spider_mongo.coll_spider_update_one({'spidername':spidername}, {'$set':{'status':status, 'comment':message}}, upsert=False))
+            yield deferred_from_coro(self.crawlerprocess.spider_lease.release(spidername))
             return result
 
         if getattr(crawl_defer, 'result', None) is not None and issubclass(crawl_defer.result.type, Exception):
             logger.error(f'Error occured when try to start spider: {spidername}, error msg: crawl_defer.result.getTraceback()')
             yield deferred_from_coro(self.spider_mongo.coll_spider_update_one({'spidername':spidername}, {'$set':{'status':'error', 'comment':crawl_defer.result.getTraceback()}}, upsert=False))
+            yield deferred_from_coro(self.crawlerprocess.spider_lease.release(spidername))
         else:
             message = f'Running spider: {spidername}.'
             self.crawlerprocess.running_crawlers[spidername] = crawler
@@ -99,36 +116,49 @@ class terminate(CheckCrawlerRunningMixin, Worker):
 
 
 class pause(CheckCrawlerRunningMixin, Worker):
+    """
+    Record that the user paused the crawler. It is idempotent, a status write
+    rejected while mongo is down is simply performed again.
+    """
+
     def check_status(self, spidername):
         self.check_crawler_running(spidername)
-        if self.crawlerprocess.running_crawlers[spidername].engine.paused:
-            raise SpiderNotRunningError(f'Spider :{spidername} is paused')
 
     async def change_status(self, spidername):
         message = f'Spider: {spidername} has been paused'
-        self.crawlerprocess.running_crawlers[spidername].engine.pause()
+        crawler = self.crawlerprocess.running_crawlers[spidername]
+        crawler.user_paused = True
+        if not crawler.engine.paused:
+            crawler.engine.pause()
         logger.info(message)
         await self.spider_mongo.coll_spider_update_one({'spidername':spidername}, {'$set':{'status':'has_paused', 'comment':message}}, upsert=False)
 
 
 class resume(CheckCrawlerRunningMixin, Worker):
+    """Clear the pause of the user, the crawler stays paused while the mongo circuit breaker holds it"""
+
     def check_status(self, spidername):
         super().check_crawler_running(spidername)
-        if not self.crawlerprocess.running_crawlers[spidername].engine.paused:
-            raise SpiderNotRunningError(f'Spider :{spidername} is not paused')
 
     async def change_status(self, spidername):
         message = f'Spider: {spidername} has been resumed'
-        self.crawlerprocess.running_crawlers[spidername].engine.unpause()
+        crawler = self.crawlerprocess.running_crawlers[spidername]
+        crawler.user_paused = False
+        if not self.spider_mongo.circuit_breaker.holds(spidername):
+            crawler.engine.unpause()
         logger.info(message)
         await self.spider_mongo.coll_spider_update_one({'spidername':spidername}, {'$set':{'status':'running', 'comment':message}}, upsert=False)
 
 
 class restart(start):
+    # The movies are deleted, so are the fingerprints of their requests
+    clear_dupefilter = True
+
     @defer.inlineCallbacks
     def check_status(self, spidername):
         if spidername in self.crawlerprocess.running_crawlers:
             raise SpiderExistError('Spider :{spidername} is running.')
+        yield deferred_from_coro(self.crawlerprocess.spider_lease.acquire(spidername))
         yield deferred_from_coro(self.spiderloader.preload(spidername))
     
     @defer.inlineCallbacks
@@ -142,28 +172,39 @@ class restart(start):
         yield super().change_status(spidername)
 
 
+class resume_from_frontier(start):
+    """Start a spider from the requests and fingerprints its last run left in the frontier"""
+    clear_frontier = False
+
+
 class delete(Worker):
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
         self.spiderloader = self.crawlerprocess.spider_loader
         self.settings = self.crawlerprocess.settings
 
-    def check_status(self, spidername):
+    async def check_status(self, spidername):
         if spidername in self.crawlerprocess.running_crawlers:
             raise SpiderExistError('Spider :{spidername} is running.')
+        await self.crawlerprocess.spider_lease.acquire(spidername)
 
     async def change_status(self, spidername):
         message = f'Spider: {spidername} has been deleted'
         spidermodule_name = self.spiderloader.get_spidermodule_name(spidername)
         if spidermodule_name in sys.modules:
             del sys.modules[spidermodule_name]
-        code_cacher.pop(spidername, None)
+        forget_code(spidername)
         spider_log_dir = os.path.join(self.settings.get('SPIDER_LOG_DIR'), spidername)
         spider_post_dir = os.path.join(self.settings.get('IMAGES_STORE'), spidername)
         delete_dir(spider_log_dir)
         delete_dir(spider_post_dir)
+        if self.settings.get('SPIDER_FRONTIER_DIR'):
+            delete_dir(frontier_dir(self.settings, spidername))
+        if self.settings.get('SPIDER_DUPEFILTER_DIR'):
+            delete_dir(dupefilter_dir(self.settings, spidername))
         await self.spider_mongo.coll_movie_delete_many({'spidername':spidername})
         logger.info(message)
         await self.spider_mongo.coll_spider_update_one({'spidername':spidername}, {'$set':{'status':'has_deleted', 'comment':message}}, upsert=False)
+        await self.crawlerprocess.spider_lease.release(spidername)
         
 
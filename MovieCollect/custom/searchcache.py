@@ -0,0 +1,184 @@
+import logging
+import time
+from datetime import datetime, timezone
+
+from scrapy.http import Request
+from scrapy.utils.defer import deferred_from_coro
+
+from MovieCollect.custom.utils.misc import LRUCache, hash_movie_identity, normalize_moviename
+from MovieCollect.items import MovieItem
+
+logger = logging.getLogger(__name__)
+
+class SearchCache:
+    """
+    Cache of search results, (spidername, normalized moviename) -> urls of
+    the movie pages the search resolved, an empty list is a negative result
+    the spider reported explicitly.
+    Entries live in the search collection where a TTL index on expire_at
+    drops them, with an in-process LRU in front. The movieidentity of every
+    cached url is resolved by preload, movies stored before identities were
+    derived from the url keep their random identity.
+    """
+
+    def __init__(self, crawlerprocess):
+        self.settings = crawlerprocess.settings
+        self.spider_mongo = crawlerprocess.spider_mongo
+        self.ttl = self.settings.getfloat('SEARCH_CACHE_TTL', 7*24*3600)
+        self.negative_ttl = self.settings.getfloat('SEARCH_CACHE_NEGATIVE_TTL', 24*3600)
+        self.cacher = LRUCache(self.settings.getint('SEARCH_CACHE_SIZE', 100000))
+        self.identities = LRUCache(self.settings.getint('SEARCH_CACHE_SIZE', 100000))
+        self.crawler = None
+
+    def open(self, crawler):
+        self.crawler = crawler
+
+    def close(self):
+        self.crawler = None
+
+    def _get(self, key, now):
+        cached = self.cacher.get(key)
+        if cached is None:
+            return None
+        urls, expire_at = cached
+        if expire_at <= now:
+            del self.cacher[key]
+            return None
+        return urls
+
+    async def preload(self, movies, spidernames):
+        """Load the entries of a batch of movies that are not in the LRU with a single query"""
+        now = time.time()
+        all_titles = {normalize_moviename(moviename) for moviename in movies}
+        titles = [title for title in all_titles if any(self._get((sname, title), now) is None for sname in spidernames)]
+        if titles:
+            query = {'title':{'$in':titles}, 'spidername':{'$in':list(spidernames)}, 'expire_at':{'$gt':datetime.now(timezone.utc)}}
+            async for entry in self.spider_mongo.coll_search_find_iter(query, projection={'_id':0, 'spidername':1, 'title':1, 'urls':1, 'expire_at':1}):
+                expire_at = entry['expire_at'].replace(tzinfo=timezone.utc).timestamp()
+                self.cacher[(entry['spidername'], entry['title'])] = (entry['urls'], expire_at)
+        unresolved = {(sname, url) for sname in spidernames for title in all_titles for url in self._get((sname, title), now) or () if self.identities.get((sname, url)) is None}
+        if unresolved:
+            await self.resolve_identities(unresolved)
+
+    async def resolve_identities(self, movies):
+        """Resolve (spidername, url) pairs to the movieidentity stored in the movie collection, new movies get the derived one"""
+        hashed = {hash_movie_identity(sname, url):(sname, url) for sname, url in movies}
+        query = {'$or':[
+            {'movieidentity':{'$in':list(hashed)}},
+            {'spidername':{'$in':list({sname for sname, _ in movies})}, 'movieurl':{'$in':list({url for _, url in movies})}},
+        ]}
+        resolved = {}
+        async for movie in self.spider_mongo.coll_movie_find_iter(query, projection={'_id':0, 'movieidentity':1, 'spidername':1, 'movieurl':1}):
+            movie_key = (movie.get('spidername'), movie.get('movieurl'))
+            if movie_key in movies:
+                resolved[movie_key] = movie['movieidentity']
+            elif movie['movieidentity'] in hashed:
+                resolved[hashed[movie['movieidentity']]] = movie['movieidentity']
+        for movie_identity, movie_key in hashed.items():
+            self.identities[movie_key] = resolved.get(movie_key, movie_identity)
+
+    def get_requests(self, sname, sspider, moviename):
+        """Requests that update a movie from a searchable spider, cached results skip the search"""
+        urls = self._get((sname, normalize_moviename(moviename)), time.time())
+        if urls is None:
+            self.inc_stats('search_cache/miss')
+            return self._search_request(sname, sspider, moviename)
+        if not urls:
+            self.inc_stats('search_cache/negative_hit')
+            return []
+        identities = [self.identities.get((sname, url)) for url in urls]
+        if None in identities:
+            # Not resolved by preload, searching again is safer than guessing the identity
+            self.inc_stats('search_cache/unresolved')
+            return self._search_request(sname, sspider, moviename)
+        self.inc_stats('search_cache/hit')
+        return [Request(url, callback=sspider.parse_movie, dont_filter=False, meta={'movie_identity':movie_identity}) for url, movie_identity in zip(urls, identities)]
+
+    def _search_request(self, sname, sspider, moviename):
+        request = sspider.get_search_request(moviename)
+        request.meta['search_title'] = moviename
+        request.meta['search_spider'] = sname
+        return [request]
+
+    def record_found(self, sname, moviename, url, movie_identity=None):
+        """Add a movie page the search of moviename led to, a negative result it replaces is dropped"""
+        title = normalize_moviename(moviename)
+        now = time.time()
+        urls = self._get((sname, title), now) or []
+        if movie_identity:
+            self.identities[(sname, url)] = movie_identity
+        if url in urls:
+            return
+        expire_at = now + self.ttl
+        self.cacher[(sname, title)] = (urls+[url], expire_at)
+        self.inc_stats('search_cache/record')
+        return deferred_from_coro(self.spider_mongo.coll_search_update_one(
+            {'title':title, 'spidername':sname},
+            {'$addToSet':{'urls':url}, '$set':{'expire_at':datetime.fromtimestamp(expire_at, timezone.utc)}},
+            upsert=True,
+        ))
+
+    def record_not_found(self, sname, moviename):
+        """Cache a search the spider reported as having no results"""
+        title = normalize_moviename(moviename)
+        expire_at = time.time() + self.negative_ttl
+        self.cacher[(sname, title)] = ([], expire_at)
+        self.inc_stats('search_cache/record_negative')
+        return deferred_from_coro(self.spider_mongo.coll_search_update_one(
+            {'title':title, 'spidername':sname},
+            {'$set':{'urls':[], 'expire_at':datetime.fromtimestamp(expire_at, timezone.utc)}},
+            upsert=True,
+        ))
+
+    def inc_stats(self, key, count=1):
+        if self.crawler:
+            self.crawler.stats.inc_value(key, count)
+
+
+class SearchCacheMiddleware:
+    """
+    Record what a search resolved into the search cache. Requests yielded
+    along a search, results pages, pagination and movie pages alike, carry
+    meta['search_cache_spider'] and meta['search_cache_title'], and every
+    MovieItem scraped along the way records its movieurl. A search is only
+    cached as negative when its callback sets
+    response.meta['search_no_results'] = True, an empty output proves nothing.
+    """
+
+    def _search(self, response, spider):
+        if not getattr(spider, 'search_cache', None):
+            return None
+        meta = response.meta
+        if 'search_cache_spider' in meta:
+            return meta['search_cache_spider'], meta['search_cache_title']
+        if 'search_spider' in meta:
+            return meta['search_spider'], meta['search_title']
+        return None
+
+    def _follow(self, search, r, spider):
+        if search is None:
+            return
+        sname, moviename = search
+        if isinstance(r, Request):
+            r.meta.setdefault('search_cache_spider', sname)
+            r.meta.setdefault('search_cache_title', moviename)
+        elif isinstance(r, MovieItem) and r.get('movieurl'):
+            spider.search_cache.record_found(sname, moviename, r['movieurl'], r.get('movieidentity'))
+
+    def _finish(self, search, response, spider):
+        if search is not None and response.meta.get('search_no_results'):
+            spider.search_cache.record_not_found(*search)
+
+    def process_spider_output(self, response, result, spider):
+        search = self._search(response, spider)
+        for r in result:
+            self._follow(search, r, spider)
+            yield r
+        self._finish(search, response, spider)
+
+    async def process_spider_output_async(self, response, result, spider):
+        search = self._search(response, spider)
+        async for r in result:
+            self._follow(search, r, spider)
+            yield r
+        self._finish(search, response, spider)
@@ -0,0 +1,170 @@
+import logging
+import time
+from collections import deque
+
+from twisted.internet import task
+from scrapy.exceptions import IgnoreRequest
+
+from MovieCollect.items import MovieItem
+from MovieCollect.custom.utils.misc import log_failure, normalize_moviename
+
+logger = logging.getLogger(__name__)
+
+class SearchFanout:
+    """
+    Send the search requests of a movie in waves of UPDATE_SEARCH_WAVE_SIZE
+    searchable spiders, best ranked first by historical hit rate and latency.
+    A new wave is sent every UPDATE_SEARCH_WAVE_DELAY seconds until
+    UPDATE_SEARCH_ENOUGH_SOURCES spiders have produced a MovieItem for the
+    movie, then the remaining waves are dropped and scheduled searches of the
+    movie are ignored by SearchFanoutMiddleware. Items are matched to the
+    movie by meta['update_title'] of their response, or by normalized title.
+    """
+
+    def __init__(self, settings, search_cache=None):
+        self.search_cache = search_cache
+        self.wave_size = settings.getint('UPDATE_SEARCH_WAVE_SIZE', 2)
+        self.wave_delay = settings.getfloat('UPDATE_SEARCH_WAVE_DELAY', 30)
+        self.enough_sources = settings.getint('UPDATE_SEARCH_ENOUGH_SOURCES', 1)
+        self.spider_stats = {}
+        self.titles = {}
+        self.normalized_titles = {}
+        self.satisfied = set()
+        self.crawler = None
+        self.task = None
+
+    def get_spider_stats(self, spidername):
+        if spidername not in self.spider_stats:
+            self.spider_stats[spidername] = {'searches':0, 'hits':0, 'latency':self.wave_delay}
+        return self.spider_stats[spidername]
+
+    def score(self, spidername):
+        stats = self.get_spider_stats(spidername)
+        return (stats['hits']+1) / (stats['searches']+2) / (1+stats['latency'])
+
+    def start(self, moviename, spider_used, searchable_spiders):
+        """Rank the searchable spiders for a movie and return the requests of the first wave"""
+        candidates = sorted((sname for sname in searchable_spiders if sname not in spider_used), key=self.score, reverse=True)
+        waves = deque([candidates[i:i+self.wave_size] for i in range(0, len(candidates), self.wave_size)])
+        self.titles[moviename] = {'sources':set(), 'waves':waves, 'searched':{}, 'next_wave':0}
+        self.normalized_titles[normalize_moviename(moviename)] = moviename
+        return self.next_wave(moviename, searchable_spiders)
+
+    def next_wave(self, moviename, searchable_spiders):
+        title = self.titles[moviename]
+        title['next_wave'] = time.time() + self.wave_delay
+        if not title['waves'] or moviename in self.satisfied:
+            return []
+        requests = []
+        for sname in title['waves'].popleft():
+            sspider = searchable_spiders.get(sname)
+            if sspider is None:
+                # The spider is not searchable anymore since the movie was ranked
+                logger.debug(f'Spider: {sname} is not searchable anymore, skip searching movie: {moviename}')
+                continue
+            if not hasattr(sspider, 'get_search_request'):
+                logger.error(f'Spider: {sname} is searchable but lack of get_search_requests method')
+                continue
+            if self.search_cache:
+                cached_requests = self.search_cache.get_requests(sname, sspider, moviename)
+                requests.extend(cached_requests)
+                if not any('search_spider' in request.meta for request in cached_requests):
+                    # Served from the search cache, it is not a search of the spider
+                    continue
+            else:
+                request = sspider.get_search_request(moviename)
+                request.meta['search_title'] = moviename
+                request.meta['search_spider'] = sname
+                requests.append(request)
+            title['searched'][sname] = time.time()
+            self.get_spider_stats(sname)['searches'] += 1
+            self.inc_stats('search_fanout/searches')
+        for request in requests:
+            request.meta['update_title'] = moviename
+        return requests
+
+    def open(self, crawler, searchable_spiders):
+        self.crawler = crawler
+        self.searchable_spiders = searchable_spiders
+        self.task = task.LoopingCall(self.dispatch)
+        self.task.start(1, now=False).addErrback(log_failure('Search fanout dispatch stopped unexpectedly', logger))
+
+    def close(self):
+        if self.task and self.task.running:
+            self.task.stop()
+        self.titles.clear()
+        self.normalized_titles.clear()
+        self.satisfied.clear()
+        self.crawler = None
+
+    def dispatch(self):
+        now = time.time()
+        for moviename, title in list(self.titles.items()):
+            if title['next_wave'] > now:
+                continue
+            if not title['waves'] or moviename in self.satisfied:
+                self._drop(moviename)
+                continue
+            for request in self.next_wave(moviename, self.searchable_spiders):
+                self.crawler.engine.crawl(request, self.crawler.spider)
+
+    def has_pending(self, moviename):
+        title = self.titles.get(moviename)
+        return bool(title and title['waves']) and moviename not in self.satisfied
+
+    def _drop(self, moviename):
+        self.titles.pop(moviename, None)
+        normalized = normalize_moviename(moviename)
+        if self.normalized_titles.get(normalized) == moviename:
+            del self.normalized_titles[normalized]
+
+    def finish(self, moviename):
+        self._drop(moviename)
+        self.satisfied.discard(moviename)
+
+    def match_title(self, item, response):
+        """The requested title an item belongs to, sites rarely return it verbatim"""
+        meta = getattr(response, 'meta', None)
+        if meta and meta.get('update_title') in self.titles:
+            return meta['update_title']
+        return self.normalized_titles.get(normalize_moviename(item.get('moviename') or ''))
+
+    def item_scraped(self, item, response, spider):
+        if not isinstance(item, MovieItem):
+            return
+        moviename = self.match_title(item, response)
+        title = self.titles.get(moviename)
+        if title is None:
+            return
+        sname = item.get('spidername')
+        if sname in title['searched'] and sname not in title['sources']:
+            stats = self.get_spider_stats(sname)
+            stats['hits'] += 1
+            stats['latency'] = 0.8*stats['latency'] + 0.2*(time.time()-title['searched'][sname])
+            self.inc_stats('search_fanout/hits')
+        title['sources'].add(sname)
+        if len(title['sources']) >= self.enough_sources and moviename not in self.satisfied:
+            self.satisfied.add(moviename)
+            cancelled = sum(len(wave) for wave in title['waves'])
+            title['waves'].clear()
+            self.inc_stats('search_fanout/cancelled', cancelled)
+            logger.debug(f'Movie: {moviename} has enough sources, {cancelled} searches are cancelled')
+
+    def inc_stats(self, key, count=1):
+        if self.crawler:
+            self.crawler.stats.inc_value(key, count)
+
+
+class SearchFanoutMiddleware:
+    """Ignore scheduled search requests of movies which already have enough sources"""
+
+    def process_request(self, request, spider):
+        search_fanout = getattr(spider, 'search_fanout', None)
+        title = request.meta.get('search_title')
+        if search_fanout and title in search_fanout.satisfied:
+            search_fanout.inc_stats('search_fanout/cancelled')
+            # Cancelled requests never leave the downloader, release them from the tracker here
+            update_tracker = getattr(spider, 'update_tracker', None)
+            if update_tracker:
+                update_tracker.request_left(request)
+            raise IgnoreRequest(f'Movie: {title} already has enough sources')
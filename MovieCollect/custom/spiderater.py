@@ -1,11 +1,57 @@
 import logging
 
-from twisted.internet import defer
-from scrapy.utils.defer import deferred_from_coro
+from scrapy import signals
 
 logger = logging.getLogger(__name__)
 
+class SlotMonitor:
+    """Downloads, failures, 5xx responses and latency per download slot of a crawler since the last collect"""
+
+    def __init__(self, crawler):
+        self.crawler = crawler
+        self.slots = {}
+        self.retries = crawler.stats.get_value('retry/count', 0)
+        crawler.signals.connect(self.request_left_downloader, signal=signals.request_left_downloader)
+        crawler.signals.connect(self.response_received, signal=signals.response_received)
+
+    def _slot(self, request):
+        key = request.meta.get('download_slot')
+        if key not in self.slots:
+            self.slots[key] = {'requests':0, 'responses':0, 'server_errors':0, 'latency':0.0}
+        return self.slots[key]
+
+    def request_left_downloader(self, request, spider):
+        self._slot(request)['requests'] += 1
+
+    def response_received(self, response, request, spider):
+        slot = self._slot(request)
+        slot['responses'] += 1
+        slot['latency'] += request.meta.get('download_latency', 0)
+        if response.status >= 500:
+            slot['server_errors'] += 1
+
+    def collect(self):
+        slots, self.slots = self.slots, {}
+        retries = self.crawler.stats.get_value('retry/count', 0)
+        retries, self.retries = retries - self.retries, retries
+        return slots, retries
+
+
 class SpiderRater:
+    """
+    Set the download concurrency of running spiders. The autorate of the
+    spider document decides, without it a manual rate wins over
+    SPIDER_AUTORATE_ENABLED: a spider with a rate gets that rate on every
+    slot. Otherwise, with autorate on the document or SPIDER_AUTORATE_ENABLED
+    and no rate, every slot is tuned with AIMD each loop: the concurrency is
+    multiplied by
+    SPIDER_AUTORATE_DECREASE when the slot failed (timeouts, connection
+    errors, 5xx) or the crawler retried at SPIDER_AUTORATE_ERROR_RATE or more,
+    when its mean latency reached SPIDER_AUTORATE_TARGET_LATENCY or when
+    SPIDER_AUTORATE_MAX_BACKLOG responses wait in the item pipelines, and
+    raised by SPIDER_AUTORATE_INCREASE otherwise. New slots start from the
+    mean concurrency of the tuned ones.
+    """
 
     def __init__(self, crawlerprocess):
         self.crawlerprocess = crawlerprocess
@@ -13,23 +59,92 @@ class SpiderRater:
         self.spider_mongo = crawlerprocess.spider_mongo
         self.min_rate = self.settings.get('SPIDER_MIN_CONCURRENTCY')
         self.max_rate = self.settings.get('SPIDER_MAX_CONCURRENTCY')
+        self.autorate = self.settings.getbool('SPIDER_AUTORATE_ENABLED', False)
+        self.increase = self.settings.getint('SPIDER_AUTORATE_INCREASE', 1)
+        self.decrease = self.settings.getfloat('SPIDER_AUTORATE_DECREASE', 0.5)
+        self.error_rate = self.settings.getfloat('SPIDER_AUTORATE_ERROR_RATE', 0.1)
+        self.target_latency = self.settings.getfloat('SPIDER_AUTORATE_TARGET_LATENCY', 3)
+        self.max_backlog = self.settings.getint('SPIDER_AUTORATE_MAX_BACKLOG', 100)
+        self.slot_monitors = {}
 
-    @defer.inlineCallbacks
-    def change_rate(self):
+    async def change_rate(self):
         running_spiders = list(self.crawlerprocess.running_crawlers.keys())
-        running_spiders_rate = yield deferred_from_coro(self.spider_mongo.coll_spider_find({'spidername':{'$in':running_spiders}, 'status':'running'},{'spidername':1,'rate':1}))
-        for spider in running_spiders_rate:
+        for spidername in set(self.slot_monitors) - set(running_spiders):
+            del self.slot_monitors[spidername]
+        running_spiders_rate = self.spider_mongo.coll_spider_find_iter({'spidername':{'$in':running_spiders}, 'status':'running'}, projection={'_id':0,'spidername':1,'rate':1,'autorate':1,'weight':1})
+        async for spider in running_spiders_rate:
             spidername = spider['spidername']
+            crawler = self.crawlerprocess.running_crawlers.get(spidername)
+            if not crawler or not crawler.engine:
+                continue
+            self.crawlerprocess.download_budget.weights[spidername] = float(spider.get('weight', 1))
+            autorate = spider.get('autorate')
+            if autorate is None:
+                autorate = self.autorate and 'rate' not in spider
+            if autorate:
+                self.auto_rate(spidername, crawler)
+                continue
+            if 'rate' not in spider:
+                continue
             rate = int(spider['rate'])
             if not self.min_rate <= rate <= self.max_rate:
                 logger.error(f'Cannot change Spider: {spidername} concurrency lower than {self.min_rate} or bigger than {self.max_rate}')
-            elif spidername in self.crawlerprocess.running_crawlers:
-                downloader = self.crawlerprocess.running_crawlers[spidername].engine.downloader
-                if downloader.ip_concurrency != rate:
+            else:
+                self.slot_monitors.pop(spidername, None)
+                downloader = crawler.engine.downloader
+                if downloader.ip_concurrency != rate or any(slot.concurrency != rate for slot in downloader.slots.values()):
                     downloader.ip_concurrency = rate
                     for slot in downloader.slots.values():
                         slot.concurrency = rate
+                    crawler.stats.set_value('rate/concurrency', rate)
                     logger.info(f'Change Spider: {spidername} concurrency to {rate}')
 
+    def get_slot_monitor(self, spidername, crawler):
+        monitor = self.slot_monitors.get(spidername)
+        if monitor is None or monitor.crawler is not crawler:
+            monitor = self.slot_monitors[spidername] = SlotMonitor(crawler)
+        return monitor
 
-
+    def auto_rate(self, spidername, crawler):
+        slots, retries = self.get_slot_monitor(spidername, crawler).collect()
+        downloader = crawler.engine.downloader
+        scraper_slot = crawler.engine.scraper.slot
+        backlog = len(scraper_slot.queue) + len(scraper_slot.active) if scraper_slot else 0
+        requests = sum(s['requests'] for s in slots.values())
+        retry_rate = retries / requests if requests else 0
+        rates = []
+        for key, slot in downloader.slots.items():
+            s = slots.get(key)
+            if not s or not s['requests']:
+                rates.append(slot.concurrency)
+                continue
+            error_rate = (max(s['requests'] - s['responses'], 0) + s['server_errors']) / s['requests']
+            latency = s['latency'] / s['responses'] if s['responses'] else None
+            if backlog >= self.max_backlog:
+                reason = f'pipeline backlog {backlog}'
+            elif retry_rate >= self.error_rate:
+                reason = f'retry rate {retry_rate:.2f}'
+            elif error_rate >= self.error_rate:
+                reason = f'error rate {error_rate:.2f}'
+            elif latency is None or latency >= self.target_latency:
+                reason = f'latency {latency or 0:.2f}s'
+            else:
+                reason = None
+            old_rate = slot.concurrency
+            if reason:
+                rate = max(self.min_rate, int(old_rate * self.decrease))
+            else:
+                rate = min(self.max_rate, old_rate + self.increase)
+            rates.append(rate)
+            if rate == old_rate:
+                continue
+            slot.concurrency = rate
+            if reason:
+                crawler.stats.inc_value('autorate/decrease')
+                logger.info(f'Decrease Spider: {spidername} slot: {key} concurrency from {old_rate} to {rate}, {reason}')
+            else:
+                crawler.stats.inc_value('autorate/increase')
+                logger.info(f'Increase Spider: {spidername} slot: {key} concurrency from {old_rate} to {rate}, {s["requests"]} requests at latency {latency:.2f}s')
+        if rates:
+            downloader.ip_concurrency = round(sum(rates) / len(rates))
+            crawler.stats.set_value('autorate/concurrency', downloader.ip_concurrency)
@@ -0,0 +1,104 @@
+import logging
+import os
+import socket
+
+from pymongo import ReturnDocument
+
+from MovieCollect.custom.utils.exceptions import SpiderLeaseError
+
+logger = logging.getLogger(__name__)
+
+class SpiderLease:
+    """
+    Ownership of spiders between nodes sharing one database. A node claims a
+    spider by writing {'owner':NODE_ID, 'expire':..., 'heartbeat':...} into
+    the lease field of its document with a single find_one_and_update, which
+    only matches when the spider has no lease, an expired one, or one that
+    is already ours. Expire and heartbeat are dates taken from the clock of
+    the mongo server ($$NOW), and leases are compared against it as well, so
+    clock skew between nodes cannot steal or keep a lease. Leases of running
+    crawlers are renewed every third of SPIDER_LEASE_TTL, spiders left running behind an expired
+    lease are set back to start so a surviving node takes them over, paused
+    ones only lose their lease and stay paused.
+    """
+
+    def __init__(self, crawlerprocess):
+        self.crawlerprocess = crawlerprocess
+        self.settings = crawlerprocess.settings
+        self.spider_mongo = crawlerprocess.spider_mongo
+        self.enabled = self.settings.getbool('SPIDER_LEASE_ENABLED', False)
+        self.ttl = self.settings.getfloat('SPIDER_LEASE_TTL', 60)
+        self.node_id = self.settings.get('NODE_ID') or f'{socket.gethostname()}:{os.getpid()}'
+
+    def _expire(self):
+        return {'$add':['$$NOW', int(self.ttl*1000)]}
+
+    def _lease(self):
+        return {'owner':{'$literal':self.node_id}, 'expire':self._expire(), 'heartbeat':'$$NOW'}
+
+    @staticmethod
+    def _expired():
+        return {'lease.expire':{'$exists':True}, '$expr':{'$lt':['$lease.expire', '$$NOW']}}
+
+    async def acquire(self, spidername):
+        if not self.enabled:
+            return
+        spider = await self.spider_mongo.coll_spider_find_one_and_update(
+            {'spidername':spidername, '$or':[{'lease':None}, self._expired(), {'lease.owner':self.node_id}]},
+            [{'$set':{'lease':self._lease()}}],
+            projection={'_id':0, 'spidername':1},
+            return_document=ReturnDocument.AFTER,
+        )
+        if not spider:
+            raise SpiderLeaseError(f'Spider: {spidername} is owned by another node')
+        logger.debug(f'Node: {self.node_id} acquired lease of spider: {spidername}')
+
+    async def release(self, spidername):
+        if self.enabled:
+            await self.spider_mongo.coll_spider_update_one({'spidername':spidername, 'lease.owner':self.node_id}, {'$unset':{'lease':''}})
+
+    async def owned_by_other(self, spidername):
+        if not self.enabled:
+            return False
+        spider = await self.spider_mongo.coll_spider_find_one({'spidername':spidername, 'lease.owner':{'$ne':self.node_id}, '$expr':{'$gte':['$lease.expire', '$$NOW']}}, {'_id':0, 'spidername':1})
+        return bool(spider)
+
+    async def renew(self, spidernames):
+        """Renew the leases of our running crawlers, crawlers whose lease has been taken are stopped"""
+        if not self.enabled or not spidernames:
+            return
+        await self.spider_mongo.coll_spider_update_many({'spidername':{'$in':spidernames}, 'lease.owner':self.node_id}, [{'$set':{'lease.expire':self._expire(), 'lease.heartbeat':'$$NOW'}}])
+        async for spider in self.spider_mongo.coll_spider_find_iter({'spidername':{'$in':spidernames}, 'lease.owner':{'$ne':self.node_id}}, projection={'_id':0, 'spidername':1, 'lease':1}):
+            spidername = spider['spidername']
+            crawler = self.crawlerprocess.running_crawlers.get(spidername)
+            if crawler:
+                owner = spider.get('lease', {}).get('owner')
+                logger.error(f'Lease of spider: {spidername} has been lost to node: {owner}, stop it')
+                crawler.lease_lost = True
+                crawler.stop()
+
+    async def take_over(self):
+        """
+        Set running spiders whose owner stopped renewing its lease back to
+        start, paused ones keep their status and only lose the lease
+        """
+        if not self.enabled:
+            return
+        while True:
+            spider = await self.spider_mongo.coll_spider_find_one_and_update(
+                {'status':'running', **self._expired()},
+                {'$set':{'status':'start', 'comment':f'Lease expired, taken over by node: {self.node_id}'}, '$unset':{'lease':''}},
+                projection={'_id':0, 'spidername':1, 'lease':1},
+            )
+            if not spider:
+                break
+            logger.warning(f'Lease of spider: {spider["spidername"]} owned by node: {spider["lease"]["owner"]} expired, set it back to start')
+        while True:
+            spider = await self.spider_mongo.coll_spider_find_one_and_update(
+                {'status':'has_paused', **self._expired()},
+                {'$unset':{'lease':''}},
+                projection={'_id':0, 'spidername':1, 'lease':1},
+            )
+            if not spider:
+                break
+            logger.warning(f'Lease of paused spider: {spider["spidername"]} owned by node: {spider["lease"]["owner"]} expired, release it')
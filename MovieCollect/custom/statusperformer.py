@@ -6,6 +6,7 @@ from scrapy.utils.defer import deferred_from_coro, maybeDeferred_coro
 from scrapy.utils.log import failure_to_exc_info
 
 from MovieCollect.custom import performer
+from MovieCollect.custom.utils.exceptions import SpiderLeaseError, SpiderNotRunningError
 
 logger = logging.getLogger(__name__)
 
@@ -27,6 +28,14 @@ class StatusPerformer:
 
         @defer.inlineCallbacks
         def deal_with_error(failure, spidername, status):
+            if failure.check(SpiderLeaseError):
+                logger.info(f'Skip changing spider: {spidername} status to {status}: {failure.value}')
+                return
+            if failure.check(SpiderNotRunningError):
+                owned_by_other = yield deferred_from_coro(self.crawlerprocess.spider_lease.owned_by_other(spidername))
+                if owned_by_other:
+                    logger.info(f'Skip changing spider: {spidername} status to {status}, it is running on another node')
+                    return
             logger.error(f'Failed to change spider: {spidername} status to {status}', exc_info=failure_to_exc_info(failure))
             yield deferred_from_coro(self.spider_mongo.coll_spider_update_one({'spidername':spidername}, {'$set':{'status':'error', 'comment':failure.getTraceback()}}, upsert=False))
             return failure
@@ -45,24 +54,28 @@ class StatusPerformer:
         d.addErrback(deal_with_error, spidername, status)
         return d
 
-    def perform(self, spider_status):
+    def perform_one(self, spidername, status):
 
-        def perform_log(result, spidername, status):
+        def perform_log(result):
             if isinstance(result, Failure):
                 logger.error(f'StatusPerformer failed to perform {spidername} status to {status}')
             else:
                 logger.info(f'StatusPerformer finished performing {spidername} status to {status}')
+            return result
+
+        logger.info(f'StatusPerformer start to perform {spidername} status to {status}')
+        d = self.dispatch(status, spidername)
+        d.addBoth(perform_log)
+        return d
 
+    def perform(self, spider_status):
+        # A failed status query leaves nothing to perform
+        if not spider_status:
+            return
         for spider in spider_status:
             spidername = spider['spidername']
             if spidername not in self.spiders_in_processing:
                 self.spiders_in_processing.add(spidername)
-                status = spider['status']
-                logger.info(f'StatusPerformer start to perform {spidername} status to {status}')
-                d = self.dispatch(status, spidername)
-                d.addBoth(perform_log, spidername, status)
-                d.addBoth(lambda _:self.spiders_in_processing.discard(spidername))
-            
-
-        
-
+                d = self.perform_one(spidername, spider['status'])
+                d.addErrback(lambda _:None)
+                d.addBoth(lambda _, spidername=spidername:self.spiders_in_processing.discard(spidername))
@@ -0,0 +1,72 @@
+import asyncio
+import logging
+
+from pymongo.errors import OperationFailure, PyMongoError
+
+logger = logging.getLogger(__name__)
+
+# The $changeStream stage is only supported on replica sets / unrecognized stage
+CHANGE_STREAM_UNSUPPORTED = (40573, 40324)
+# The resume token is no longer in the oplog
+CHANGE_STREAM_HISTORY_LOST = (280, 286, 136)
+
+class StatusWatcher:
+    """
+    Subscribe to a change stream on the spider collection and hand every
+    change into a user status straight to StatusPerformer. While the stream
+    is not established ``watching`` is False and the spider loop keeps polling.
+    """
+
+    def __init__(self, crawlerprocess):
+        self.settings = crawlerprocess.settings
+        self.spider_mongo = crawlerprocess.spider_mongo
+        self.status_performer = crawlerprocess.status_performer
+        self.user_status = self.settings.get('SPIDER_USER_STATUS', [])
+        self.reconnect_delay = self.settings.getfloat('SPIDER_STATUS_WATCH_RECONNECT_DELAY', 5)
+        self.watching = False
+
+    async def get_resume_token(self):
+        resume_token = await self.spider_mongo.coll_tool_find_one({'name':'spider_status_resume_token'}, {'funcfield':1})
+        return resume_token['funcfield'] if resume_token else None
+
+    async def save_resume_token(self, resume_token):
+        await self.spider_mongo.coll_tool_update_one({'name':'spider_status_resume_token'}, {'$set':{'funcfield':resume_token}}, upsert=True)
+
+    async def watch(self):
+        pipeline = [{'$match':{'operationType':{'$in':['insert', 'update', 'replace']}, 'fullDocument.status':{'$in':self.user_status}}}]
+        resume_token = await self.get_resume_token()
+        try:
+            while True:
+                try:
+                    async with self.spider_mongo.spider_coll.watch(pipeline, full_document='updateLookup', resume_after=resume_token) as stream:
+                        self.watching = True
+                        logger.info('Start to watch spider collection for user status changes')
+                        async for change in stream:
+                            self.handle_change(change)
+                            resume_token = stream.resume_token
+                            await self.save_resume_token(resume_token)
+                except OperationFailure as e:
+                    self.watching = False
+                    if e.code in CHANGE_STREAM_UNSUPPORTED:
+                        logger.warning(f'Change streams are not available, fall back to polling spider status: {e}')
+                        return
+                    if e.code in CHANGE_STREAM_HISTORY_LOST:
+                        logger.warning('Resume token of spider status watcher is lost, watch from now on')
+                        resume_token = None
+                    else:
+                        logger.error('Spider status watcher failed, reconnect later', exc_info=True)
+                        await asyncio.sleep(self.reconnect_delay)
+                except PyMongoError:
+                    self.watching = False
+                    logger.error('Spider status watcher disconnected, reconnect later', exc_info=True)
+                    await asyncio.sleep(self.reconnect_delay)
+        finally:
+            # Whatever stops the watcher, the spider loop has to go back to polling
+            self.watching = False
+
+    def handle_change(self, change):
+        try:
+            spider = change['fullDocument']
+            self.status_performer.perform([{'spidername':spider['spidername'], 'status':spider['status']}])
+        except Exception:
+            logger.error(f'Failed to handle spider status change: {change.get("documentKey")}', exc_info=True)
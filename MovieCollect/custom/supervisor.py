@@ -0,0 +1,271 @@
+import json
+import logging
+import os
+import sys
+import time
+
+from twisted.internet import defer, protocol, task
+from twisted.internet.error import ReactorNotRunning
+from twisted.protocols.basic import LineReceiver
+from twisted.python.failure import Failure
+from scrapy.crawler import CrawlerProcess
+from scrapy.utils.defer import deferred_from_coro
+
+from MovieCollect.custom.database import SpiderMongo
+from MovieCollect.custom.crud_error_catcher import crud_error_catcher
+from MovieCollect.custom.journal import JournalReplayer
+from MovieCollect.custom.statusfinder import StatusFinder
+from MovieCollect.custom.statusperformer import StatusPerformer
+from MovieCollect.custom.spiderlease import SpiderLease
+from MovieCollect.custom.statuswatcher import StatusWatcher
+from MovieCollect.custom.utils.exceptions import SpiderException
+from MovieCollect.custom.utils.misc import log_failure
+
+logger = logging.getLogger(__name__)
+
+# Status changes that create a crawler, they go to the least loaded worker
+START_STATUS = ('start', 'restart', 'resume_from_frontier')
+
+REPORT_FD = 3
+
+class CrawlerWorker(protocol.ProcessProtocol):
+    """
+    A worker process running its own AutoCrawlerProcess. Status changes are
+    sent as JSON lines on its stdin, it reports finished status changes and
+    its running crawlers as JSON lines on REPORT_FD.
+    """
+
+    def __init__(self, supervisor, index):
+        self.supervisor = supervisor
+        self.index = index
+        self.running = set()
+        self.assigned = set()
+        self.pending = {}
+        self.buffer = b''
+        self.ended = defer.Deferred()
+
+    @property
+    def load(self):
+        return len(self.running | self.assigned)
+
+    def spawn(self):
+        from twisted.internet import reactor
+        args = [sys.executable, '-m', 'MovieCollect.execute', str(self.index)]
+        reactor.spawnProcess(self, sys.executable, args, env=dict(os.environ), path=os.getcwd(), childFDs={0:'w', 1:1, 2:2, REPORT_FD:'r'})
+
+    def connectionMade(self):
+        logger.info(f'Crawler worker {self.index} started, pid: {self.transport.pid}')
+
+    def send(self, message):
+        self.transport.write(json.dumps(message).encode('utf8')+b'\n')
+
+    def forward(self, spidername, status):
+        if spidername in self.pending:
+            return self.pending[spidername]
+        if status in START_STATUS:
+            self.assigned.add(spidername)
+        d = self.pending[spidername] = defer.Deferred()
+        self.send({'spidername':spidername, 'status':status})
+        return d
+
+    def childDataReceived(self, childFD, data):
+        if childFD != REPORT_FD:
+            return
+        *lines, self.buffer = (self.buffer+data).split(b'\n')
+        for line in lines:
+            if line.strip():
+                self.report(json.loads(line))
+
+    def report(self, message):
+        self.running = set(message.get('running', self.running))
+        if message.get('type') == 'done':
+            spidername = message['spidername']
+            self.assigned.discard(spidername)
+            d = self.pending.pop(spidername, None)
+            if d is not None:
+                if message['ok']:
+                    d.callback(None)
+                else:
+                    d.errback(SpiderException(f'Worker {self.index} failed to perform {spidername} status to {message["status"]}'))
+
+    def processEnded(self, reason):
+        logger.error(f'Crawler worker {self.index} exited: {reason.getErrorMessage()}')
+        pending, self.pending = self.pending, {}
+        for spidername, d in pending.items():
+            d.errback(SpiderException(f'Worker {self.index} exited while performing spider: {spidername}'))
+        self.ended.callback(self.running)
+
+
+class ForwardingPerformer(StatusPerformer):
+    """Perform status changes by forwarding them to the worker that owns the spider"""
+
+    def __init__(self, supervisor):
+        super().__init__(supervisor)
+        self.supervisor = supervisor
+
+    def perform_one(self, spidername, status):
+        worker = self.supervisor.route(spidername, status)
+        if worker is None:
+            return deferred_from_coro(self._not_running(spidername))
+        logger.info(f'Forward {spidername} status {status} to crawler worker {worker.index}')
+        d = worker.forward(spidername, status)
+        if status == 'delete':
+            d.addCallback(lambda _:self.supervisor.broadcast({'command':'forget', 'spidername':spidername}, exclude=worker))
+        return d
+
+    async def _not_running(self, spidername):
+        if await self.supervisor.spider_lease.owned_by_other(spidername):
+            logger.info(f'Spider: {spidername} is running on another node')
+            return
+        message = f'Spider: {spidername} is not running in any crawler worker'
+        logger.error(message)
+        await self.spider_mongo.coll_spider_update_one({'spidername':spidername}, {'$set':{'status':'error', 'comment':message}}, upsert=False)
+
+
+class Supervisor(CrawlerProcess):
+    """
+    Run CRAWLER_WORKERS worker processes, each with its own
+    AutoCrawlerProcess, so crawling scales with the cores of the host. The
+    supervisor owns the spider status loop: new crawlers go to the least
+    loaded worker and pause/resume/terminate go to the worker running the
+    spider. Worker 0 also runs the movie update loop. Workers that exit are
+    spawned again after SUPERVISOR_RESPAWN_DELAY seconds.
+    """
+
+    def __init__(self, settings=None, install_root_handler=True):
+        super().__init__(settings, install_root_handler)
+        self.spider_mongo = SpiderMongo(self.settings)
+        self.spider_mongo.circuit_breaker.initial(self)
+        self.running_crawlers = {}
+        self.movie_updater = None
+        self.spider_lease = SpiderLease(self)
+
+        self.status_finder = StatusFinder(self)
+        self.status_performer = ForwardingPerformer(self)
+        self._change_spider_status = False
+        self.status_watcher = StatusWatcher(self)
+        self._status_watch = self.settings.getbool('SPIDER_STATUS_WATCH', False)
+        self._status_reconcile_interval = self.settings.get('SPIDER_STATUS_RECONCILE_INTERVAL', 60)
+        self._last_status_poll = 0
+
+        self._auto_crawl_interval = self.settings.get('AUTO_CRAWL_INTERVAL', 60)
+        self._respawn_delay = self.settings.getfloat('SUPERVISOR_RESPAWN_DELAY', 5)
+        self.workers = [CrawlerWorker(self, index) for index in range(self.settings.getint('CRAWLER_WORKERS', 1))]
+        self.stopping = False
+
+        crud_error_catcher.initial(self)
+        self.journal_replayer = JournalReplayer(self, crud_error_catcher.journal)
+        self._crud_replay = self.settings.getbool('CRUD_REPLAY_ENABLED', True)
+
+    def route(self, spidername, status):
+        for worker in self.workers:
+            if spidername in worker.running or spidername in worker.assigned:
+                return worker
+        if status in START_STATUS or status == 'delete':
+            return min(self.workers, key=lambda worker:worker.load)
+        return None
+
+    def broadcast(self, message, exclude=None):
+        for worker in self.workers:
+            if worker is not exclude and worker.transport:
+                worker.send(message)
+
+    def spawn(self, index):
+        if self.stopping:
+            return
+        worker = self.workers[index] = CrawlerWorker(self, index)
+        worker.ended.addCallback(self._worker_ended, index)
+        worker.spawn()
+
+    @defer.inlineCallbacks
+    def _worker_ended(self, running, index):
+        from twisted.internet import reactor
+        if self.stopping:
+            return
+        for spidername in running:
+            message = f'Crawler worker {index} exited while running spider: {spidername}'
+            yield deferred_from_coro(self.spider_mongo.coll_spider_update_one({'spidername':spidername, 'status':{'$in':['running', 'has_paused']}}, {'$set':{'status':'error', 'comment':message}}, upsert=False))
+        reactor.callLater(self._respawn_delay, self.spawn, index)
+
+    def stop_workers(self):
+        self.stopping = True
+        ended = []
+        for worker in self.workers:
+            if worker.transport and worker.transport.pid:
+                worker.transport.signalProcess('TERM')
+                ended.append(worker.ended)
+        return defer.DeferredList(ended)
+
+    def run_loop(self):
+        from twisted.internet import reactor
+        for index in range(len(self.workers)):
+            self.spawn(index)
+        reactor.addSystemEventTrigger('before', 'shutdown', self.stop_workers)
+        if self._status_watch:
+            d = deferred_from_coro(self.status_watcher.watch())
+            d.addErrback(log_failure('Spider status watcher stopped unexpectedly', logger))
+        if self.settings.getbool('MONGO_ENSURE_INDEXES', True):
+            d = deferred_from_coro(self.spider_mongo.ensure_indexes())
+            d.addErrback(log_failure('Failed to create mongo indexes', logger))
+        tl = task.LoopingCall(self._run_loop)
+        tl.start(self._auto_crawl_interval)
+
+    @defer.inlineCallbacks
+    def _run_loop(self):
+        if self._crud_replay:
+            d = deferred_from_coro(self.journal_replayer.replay())
+            d.addErrback(log_failure('Failed to replay write journal', logger))
+        if self._change_spider_status:
+            return
+        if self.status_watcher.watching and time.time() - self._last_status_poll < self._status_reconcile_interval:
+            return
+        self._change_spider_status = True
+        self._last_status_poll = time.time()
+        try:
+            user_status_spiders = yield deferred_from_coro(self.status_finder.get_user_status_spiders())
+            self.status_performer.perform(user_status_spiders or [])
+        finally:
+            self._change_spider_status = False
+
+
+class SupervisorChannel(LineReceiver):
+    """Worker side of the supervisor IPC, status changes come in on stdin and reports go out on REPORT_FD"""
+
+    delimiter = b'\n'
+
+    def __init__(self, crawlerprocess):
+        self.crawlerprocess = crawlerprocess
+        self.report_interval = crawlerprocess.settings.getfloat('SUPERVISOR_REPORT_INTERVAL', 5)
+        self.report_task = task.LoopingCall(self.report)
+
+    def connectionMade(self):
+        self.report_task.start(self.report_interval)
+
+    def lineReceived(self, line):
+        message = json.loads(line)
+        spidername = message['spidername']
+        if message.get('command') == 'forget':
+            self.crawlerprocess.forget_spider(spidername)
+            return
+        status = message['status']
+        d = defer.maybeDeferred(self.crawlerprocess.status_performer.perform_one, spidername, status)
+        d.addBoth(lambda result:self.report('done', spidername=spidername, status=status, ok=not isinstance(result, Failure)))
+
+    def report(self, kind='report', **kwargs):
+        message = dict(kwargs, type=kind, running=list(self.crawlerprocess.running_crawlers))
+        os.write(REPORT_FD, json.dumps(message).encode('utf8')+b'\n')
+
+    def connectionLost(self, reason):
+        from twisted.internet import reactor
+        if self.report_task.running:
+            self.report_task.stop()
+        logger.warning('Supervisor is gone, stop crawler worker')
+        def stop_reactor(_):
+            try:
+                reactor.stop()
+            except ReactorNotRunning:
+                pass
+
+        if reactor.running:
+            d = self.crawlerprocess.stop()
+            d.addBoth(stop_reactor)
@@ -0,0 +1,63 @@
+import logging
+import math
+import time
+from collections import deque
+
+from MovieCollect.custom.utils.misc import LRUCache
+
+logger = logging.getLogger(__name__)
+
+class UpdateLatencyTracker:
+    """
+    End-to-end latency of requested movies, from their enqueue time in the
+    update queue to the first write of one of their items by the movie
+    pipelines. Items are bound to their movie by UpdateTitleMiddleware and
+    the bulk writer reports the identities it has written. Percentiles cover
+    the last UPDATE_LATENCY_WINDOW movies.
+    """
+
+    def __init__(self):
+        self.enqueued = LRUCache(100000)
+        self.identities = LRUCache(100000)
+        self.latencies = deque(maxlen=1000)
+        self.crawler = None
+
+    def open(self, crawler):
+        self.crawler = crawler
+        self.latencies = deque(self.latencies, maxlen=crawler.settings.getint('UPDATE_LATENCY_WINDOW', 1000))
+
+    def close(self):
+        self.crawler = None
+
+    def enqueue(self, moviename, enqueued_time):
+        if enqueued_time and moviename not in self.enqueued:
+            self.enqueued[moviename] = enqueued_time
+
+    def bind(self, movieidentity, moviename):
+        if moviename in self.enqueued:
+            self.identities[movieidentity] = moviename
+
+    def written(self, movieidentities):
+        if not self.identities:
+            return
+        now = time.time()
+        recorded = False
+        for movieidentity in movieidentities:
+            moviename = self.identities.pop(movieidentity, None)
+            enqueued_time = self.enqueued.pop(moviename, None)
+            if enqueued_time is None:
+                continue
+            self.latencies.append(now - enqueued_time)
+            recorded = True
+        if recorded and self.crawler:
+            for key, value in self.snapshot().items():
+                self.crawler.stats.set_value(f'update_latency/{key}', value)
+
+    def snapshot(self):
+        latencies = sorted(self.latencies)
+        if not latencies:
+            return {'count':0}
+        percentile = lambda q: latencies[max(math.ceil(q*len(latencies))-1, 0)]
+        return {'count':len(latencies), 'p50':percentile(0.5), 'p95':percentile(0.95), 'p99':percentile(0.99)}
+
+update_latency_tracker = UpdateLatencyTracker()
@@ -0,0 +1,54 @@
+import logging
+
+from scrapy.http import Request
+
+logger = logging.getLogger(__name__)
+
+class UpdatePlanner:
+    """
+    Plan the requests that update a batch of movies. Movie entries are
+    indexed by moviename as they stream in from the aggregate, requests are
+    then yielded lazily so they can be fed to the crawler as it has room.
+    With a search_fanout only its first wave of searches is yielded, with a
+    search_cache cached search results replace the searches.
+    """
+
+    def __init__(self, finished_spiders, searchable_spiders, search_fanout=None, search_cache=None):
+        self.finished_spiders = finished_spiders
+        self.searchable_spiders = searchable_spiders
+        self.search_fanout = search_fanout
+        self.search_cache = search_cache
+        self.movie_briefs = {}
+        self.spidernames = set()
+
+    def add(self, moviename, moviebriefs):
+        briefs = self.movie_briefs.setdefault(moviename, [])
+        for mb in moviebriefs:
+            spidername = mb['spidername']
+            if spidername in self.finished_spiders:
+                briefs.append((spidername, mb['movieidentity'], mb['movieurl']))
+                self.spidernames.add(spidername)
+
+    def iter_requests(self, movies, movie_spiders):
+        for moviename in movies:
+            for request in self.iter_movie_requests(moviename, movie_spiders):
+                request.meta['update_title'] = moviename
+                yield request
+
+    def iter_movie_requests(self, moviename, movie_spiders):
+        spider_used = set()
+        for spidername, movieidentity, movieurl in self.movie_briefs.get(moviename, ()):
+            spider_used.add(spidername)
+            yield Request(movieurl, callback=movie_spiders[spidername].parse_movie, dont_filter=False, meta={'movie_identity':movieidentity})
+        if self.search_fanout:
+            yield from self.search_fanout.start(moviename, spider_used, self.searchable_spiders)
+            return
+        for sname, sspider in self.searchable_spiders.items():
+            if sname in spider_used:
+                continue
+            if not hasattr(sspider, 'get_search_request'):
+                logger.error(f'Spider: {sname} is searchable but lack of get_search_requests method')
+            elif self.search_cache:
+                yield from self.search_cache.get_requests(sname, sspider, moviename)
+            else:
+                yield sspider.get_search_request(moviename)
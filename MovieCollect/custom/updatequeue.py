@@ -0,0 +1,95 @@
+import asyncio
+import logging
+import time
+
+from pymongo import ReturnDocument, UpdateOne
+from pymongo.errors import OperationFailure, PyMongoError
+
+from MovieCollect.custom.statuswatcher import CHANGE_STREAM_UNSUPPORTED
+from MovieCollect.custom.updatelatency import update_latency_tracker
+
+logger = logging.getLogger(__name__)
+
+class UpdateQueue:
+    """
+    Queue of movies to update, one document per requested moviename:
+    {'moviename':..., 'status':'pending'|'claimed', 'enqueued_time':..., 'lease_expire':...}
+
+    Movies are claimed atomically with find_one_and_update and held for
+    UPDATE_QUEUE_LEASE seconds, claims that are not renewed in time can be
+    claimed again. Movies are removed from the queue once they are updated.
+    """
+
+    def __init__(self, crawlerprocess):
+        self.crawlerprocess = crawlerprocess
+        self.settings = crawlerprocess.settings
+        self.spider_mongo = crawlerprocess.spider_mongo
+        self.lease = self.settings.getfloat('UPDATE_QUEUE_LEASE', 600)
+        self.reconnect_delay = self.settings.getfloat('UPDATE_QUEUE_WATCH_RECONNECT_DELAY', 5)
+
+    async def push(self, movies):
+        enqueued_time = time.time()
+        operations = [UpdateOne({'moviename':moviename}, {'$setOnInsert':{'status':'pending', 'enqueued_time':enqueued_time, 'lease_expire':0}}, upsert=True) for moviename in movies]
+        if operations:
+            return await self.spider_mongo.coll_queue_bulk_write(operations, ordered=False)
+
+    async def migrate_legacy(self):
+        """
+        Move the movies pushed to the legacy tool document into the queue.
+        Producers still write there, so it is drained on every loop, at the
+        cost of one find_one and one $pullAll.
+        """
+        legacy_movies = await self.spider_mongo.coll_tool_find_one({'name':'movies_to_update'}, {'funcfield':1})
+        movies = legacy_movies.get('funcfield') if legacy_movies else None
+        if not movies:
+            return
+        if await self.push(movies):
+            await self.spider_mongo.coll_tool_update_one({'name':'movies_to_update'}, {'$pullAll':{'funcfield':movies}})
+            logger.info(f'Moved {len(movies)} movies from tool collection into update queue')
+
+    async def claim(self, limit):
+        movies = []
+        while len(movies) < limit:
+            now = time.time()
+            movie = await self.spider_mongo.coll_queue_find_one_and_update(
+                {'$or':[{'status':'pending'}, {'status':'claimed', 'lease_expire':{'$lt':now}}]},
+                {'$set':{'status':'claimed', 'lease_expire':now+self.lease}},
+                projection={'moviename':1, 'enqueued_time':1},
+                sort=[('enqueued_time', 1)],
+                return_document=ReturnDocument.AFTER,
+            )
+            if not movie:
+                break
+            movies.append(movie['moviename'])
+            update_latency_tracker.enqueue(movie['moviename'], movie.get('enqueued_time'))
+        return movies
+
+    async def renew(self, movies):
+        if movies:
+            await self.spider_mongo.coll_queue_update_many({'moviename':{'$in':list(movies)}, 'status':'claimed'}, {'$set':{'lease_expire':time.time()+self.lease}})
+
+    async def release(self, movies):
+        if movies:
+            await self.spider_mongo.coll_queue_update_many({'moviename':{'$in':list(movies)}, 'status':'claimed'}, {'$set':{'status':'pending', 'lease_expire':0}})
+
+    async def done(self, movies):
+        if movies:
+            await self.spider_mongo.coll_queue_delete_many({'moviename':{'$in':list(movies)}})
+
+    async def watch(self):
+        pipeline = [{'$match':{'operationType':'insert'}}]
+        while True:
+            try:
+                async with self.spider_mongo.queue_coll.watch(pipeline) as stream:
+                    logger.info('Start to watch update queue for new movies')
+                    async for _ in stream:
+                        self.crawlerprocess._run_update_loop()
+            except OperationFailure as e:
+                if e.code in CHANGE_STREAM_UNSUPPORTED:
+                    logger.warning(f'Change streams are not available, update queue is polled every loop: {e}')
+                    return
+                logger.error('Update queue watcher failed, reconnect later', exc_info=True)
+                await asyncio.sleep(self.reconnect_delay)
+            except PyMongoError:
+                logger.error('Update queue watcher disconnected, reconnect later', exc_info=True)
+                await asyncio.sleep(self.reconnect_delay)
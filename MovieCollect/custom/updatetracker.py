@@ -0,0 +1,141 @@
+import logging
+import time
+
+from scrapy.http import Request
+
+from MovieCollect.items import MovieItem, MovieLinkItem
+from MovieCollect.custom.updatelatency import update_latency_tracker
+
+logger = logging.getLogger(__name__)
+
+class UpdateTracker:
+    """
+    Count the outstanding work of every movie the update crawler works on:
+    requests until they leave the downloader, responses from
+    response_received until their callback output is consumed or fails, and
+    items until they leave the item pipelines. Requests carry the movie in
+    meta['update_title'], UpdateTitleMiddleware passes it on to the requests
+    that follow. A movie is finished once nothing of it has been outstanding
+    for UPDATE_TITLE_GRACE seconds. Movies still running after
+    UPDATE_TITLE_TIMEOUT seconds are finished anyway.
+    """
+
+    def __init__(self, settings, search_fanout=None):
+        self.grace = settings.getfloat('UPDATE_TITLE_GRACE', 5)
+        self.timeout = settings.getfloat('UPDATE_TITLE_TIMEOUT', 1800)
+        self.search_fanout = search_fanout
+        self.pending = {}
+        self.started = {}
+        self.idle_since = {}
+
+    def start(self, movies):
+        now = time.time()
+        for moviename in movies:
+            self.pending.setdefault(moviename, 0)
+            self.started.setdefault(moviename, now)
+            self.idle_since.setdefault(moviename, now)
+
+    def _enter(self, moviename):
+        if moviename in self.pending:
+            self.pending[moviename] += 1
+            self.idle_since.pop(moviename, None)
+            return True
+        return False
+
+    def _leave(self, moviename):
+        if self.pending.get(moviename, 0) > 0:
+            self.pending[moviename] -= 1
+            if not self.pending[moviename]:
+                self.idle_since[moviename] = time.time()
+
+    def request_scheduled(self, request, spider):
+        self._enter(request.meta.get('update_title'))
+
+    def request_left(self, request, spider=None):
+        self._leave(request.meta.get('update_title'))
+
+    def response_received(self, response, request, spider):
+        # The response waits in the scraper until its callback output is consumed
+        if self._enter(request.meta.get('update_title')):
+            request.meta['update_scraping'] = True
+
+    def response_scraped(self, response):
+        meta = getattr(response, 'meta', None)
+        if meta and meta.pop('update_scraping', False):
+            self._leave(meta.get('update_title'))
+
+    def spider_error(self, failure, response, spider):
+        self.response_scraped(response)
+
+    def item_yielded(self, response):
+        self._enter(response.meta.get('update_title'))
+
+    def item_left(self, item, response, spider):
+        meta = getattr(response, 'meta', None)
+        if meta:
+            self._leave(meta.get('update_title'))
+
+    def pop_finished(self):
+        now = time.time()
+        finished = []
+        for moviename, started in list(self.started.items()):
+            if now - started >= self.timeout:
+                logger.warning(f'Movie: {moviename} is still updating after {self.timeout}s, {self.pending[moviename]} requests are left behind')
+            elif (
+                moviename not in self.idle_since
+                or now - self.idle_since[moviename] < self.grace
+                or (self.search_fanout and self.search_fanout.has_pending(moviename))
+            ):
+                continue
+            del self.pending[moviename], self.started[moviename]
+            self.idle_since.pop(moviename, None)
+            finished.append(moviename)
+        return finished
+
+
+class UpdateTitleMiddleware:
+    """
+    Pass meta['update_title'] of a response on to the requests its callback
+    yields, at no less than UPDATE_REQUEST_PRIORITY, and bind the items it
+    yields to the movie for update latency tracking. The update tracker of
+    the spider is told about every item and about the end of the output.
+    """
+
+    def __init__(self, priority):
+        self.priority = priority
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        return cls(crawler.settings.getint('UPDATE_REQUEST_PRIORITY', 100))
+
+    def _tag(self, response, r, tracker):
+        moviename = response.meta.get('update_title')
+        if moviename is None:
+            return r
+        if isinstance(r, Request):
+            r.meta.setdefault('update_title', moviename)
+            r.priority = max(r.priority, self.priority)
+        else:
+            if tracker:
+                tracker.item_yielded(response)
+            if isinstance(r, (MovieItem, MovieLinkItem)) and r.get('movieidentity'):
+                update_latency_tracker.bind(r['movieidentity'], moviename)
+        return r
+
+    def process_spider_output(self, response, result, spider):
+        tracker = getattr(spider, 'update_tracker', None)
+        try:
+            for r in result:
+                yield self._tag(response, r, tracker)
+        finally:
+            if tracker:
+                tracker.response_scraped(response)
+
+    async def process_spider_output_async(self, response, result, spider):
+        tracker = getattr(spider, 'update_tracker', None)
+        try:
+            async for r in result:
+                yield self._tag(response, r, tracker)
+        finally:
+            if tracker:
+                tracker.response_scraped(response)
@@ -21,3 +21,12 @@ class SpiderNotRunningError(SpiderException):
 
 class MongoUpsertError(SpiderException):
     pass
+
+class MongoCircuitOpenError(SpiderException):
+    pass
+
+class MongoReadError(SpiderException):
+    pass
+
+class SpiderLeaseError(SpiderException):
+    pass
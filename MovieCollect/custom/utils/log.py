@@ -1,19 +1,48 @@
+import atexit
+import gzip
 import logging
+import os
+import queue
+import shutil
+import threading
+from logging.handlers import QueueHandler, RotatingFileHandler
+
+from scrapy.utils.log import _get_handler
 
 class RootFilter(logging.Filter):
     def filter(self, record):
         if not getattr(record, 'spider', None) and not getattr(record, 'crawler', None):
             return True
 
-class SpiderFilter(logging.Filter):
-    def __init__(self, spidercls, *args, **kwargs):
+class SpiderLogRouter(logging.Handler):
+    """
+    Single root handler that dispatches spider and crawler records to the
+    handlers registered for their spider class with one dict lookup.
+    """
+
+    def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
-        self.spidercls = spidercls
+        self.routes = {}
 
-    def filter(self, record):
-        if (getattr(record, 'spider', None) and record.spider.__class__ is self.spidercls) or \
-        (getattr(record, 'crawler', None) and record.crawler.spidercls is self.spidercls):
-            return True
+    def register(self, spidercls, handlers):
+        if self not in logging.root.handlers:
+            logging.root.addHandler(self)
+        self.routes[spidercls] = handlers
+
+    def unregister(self, spidercls, handlers):
+        if self.routes.get(spidercls) is handlers:
+            del self.routes[spidercls]
+
+    def emit(self, record):
+        if getattr(record, 'spider', None):
+            spidercls = record.spider.__class__
+        elif getattr(record, 'crawler', None):
+            spidercls = record.crawler.spidercls
+        else:
+            return
+        for handler in self.routes.get(spidercls, ()):
+            if record.levelno >= handler.level:
+                handler.handle(record)
 
 class SpiderLogCounterHandler(logging.Handler):
     """Record log levels count into a crawler stats"""
@@ -23,7 +52,106 @@ class SpiderLogCounterHandler(logging.Handler):
         self.crawler = crawler
 
     def emit(self, record):
-        if (getattr(record, 'spider', None) and record.spider.__class__ is self.crawler.spidercls) or \
-        (getattr(record, 'crawler', None) and record.crawler is self.crawler):
-            sname = f'log_count/{record.levelname}'
-            self.crawler.stats.inc_value(sname)
+        sname = f'log_count/{record.levelname}'
+        self.crawler.stats.inc_value(sname)
+
+class AsyncLogWriter:
+    """Background thread that performs the file I/O of spider log handlers"""
+
+    def __init__(self):
+        self.queue = None
+        self.thread = None
+
+    def start(self, maxsize=0):
+        if self.thread:
+            return
+        self.queue = queue.Queue(maxsize)
+        self.thread = threading.Thread(target=self._run, name='SpiderLogWriter', daemon=True)
+        self.thread.start()
+        atexit.register(self.stop)
+
+    def _run(self):
+        while True:
+            handler, record = self.queue.get()
+            if handler is None:
+                break
+            try:
+                if record is None:
+                    handler.close()
+                else:
+                    handler.handle(record)
+            except Exception:
+                handler.handleError(record)
+
+    def close_handler(self, handler):
+        # Called on the reactor thread, which must not block on a full queue.
+        # The handler is closed after its queued records in either case.
+        try:
+            self.queue.put_nowait((handler, None))
+        except queue.Full:
+            threading.Thread(target=self.queue.put, args=((handler, None),), name='SpiderLogCloser', daemon=True).start()
+
+    def stop(self):
+        if self.thread and self.thread.is_alive():
+            self.queue.put((None, None))
+            self.thread.join()
+
+class AsyncSpiderLogHandler(QueueHandler):
+    """
+    Enqueue records for a spider log handler which is run by AsyncLogWriter.
+    Records are dropped when the queue is full, dropped records are counted
+    into the crawler stats. The queue backlog is sampled into the stats
+    every BACKLOG_SAMPLE records.
+    """
+
+    BACKLOG_SAMPLE = 100
+
+    def __init__(self, crawler, handler, writer):
+        super().__init__(writer.queue)
+        self.crawler = crawler
+        self.handler = handler
+        self.writer = writer
+        self.setLevel(handler.level)
+        self.enqueued = 0
+
+    def enqueue(self, record):
+        self.enqueued += 1
+        if self.enqueued % self.BACKLOG_SAMPLE == 0:
+            backlog = self.queue.qsize()
+            self.crawler.stats.set_value('log_queue/backlog', backlog)
+            self.crawler.stats.max_value('log_queue/backlog_max', backlog)
+        try:
+            self.queue.put_nowait((self.handler, record))
+        except queue.Full:
+            self.crawler.stats.inc_value('log_queue/dropped')
+
+    def close(self):
+        self.writer.close_handler(self.handler)
+        super().close()
+
+def gzip_namer(name):
+    return name + '.gz'
+
+def gzip_rotator(source, dest):
+    with open(source, 'rb') as sf, gzip.open(dest, 'wb') as df:
+        shutil.copyfileobj(sf, df)
+    os.remove(source)
+
+def get_spider_log_handler(settings):
+    """Return the handler of LOG_FILE, rotated by size and gzipped when SPIDER_LOG_MAX_BYTES is set"""
+    handler = _get_handler(settings)
+    max_bytes = settings.getint('SPIDER_LOG_MAX_BYTES', 0)
+    if max_bytes and isinstance(handler, logging.FileHandler):
+        handler.close()
+        rotating_handler = RotatingFileHandler(handler.baseFilename, maxBytes=max_bytes, backupCount=settings.getint('SPIDER_LOG_BACKUP_COUNT', 5), encoding=handler.encoding)
+        rotating_handler.namer = gzip_namer
+        rotating_handler.rotator = gzip_rotator
+        rotating_handler.setFormatter(handler.formatter)
+        rotating_handler.setLevel(handler.level)
+        for log_filter in handler.filters:
+            rotating_handler.addFilter(log_filter)
+        handler = rotating_handler
+    return handler
+
+spider_log_router = SpiderLogRouter()
+async_log_writer = AsyncLogWriter()
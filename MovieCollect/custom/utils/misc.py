@@ -2,7 +2,10 @@ import hashlib
 import os
 import time
 import random
+import re
 import shutil
+import unicodedata
+from collections import OrderedDict
 
 from scrapy.utils.python import to_bytes
 from scrapy.utils.log import failure_to_exc_info
@@ -29,6 +32,31 @@ def hash_with_timestamp_random(string_to_hash):
 
     return hashlib.sha1(to_bytes(string_to_hash+nstime+random_string)).hexdigest()
 
+def hash_movie_identity(spidername, movie_url):
+    return hashlib.sha1(to_bytes(spidername+'\n'+movie_url)).hexdigest()
+
+def normalize_moviename(moviename):
+    moviename = unicodedata.normalize('NFKC', moviename).lower()
+    return re.sub(r'[\W_]+', ' ', moviename).strip()
+
+
+class LRUCache(OrderedDict):
+    def __init__(self, maxsize=10000):
+        super().__init__()
+        self.maxsize = maxsize
+
+    def get(self, key, default=None):
+        if key in self:
+            self.move_to_end(key)
+            return self[key]
+        return default
+
+    def __setitem__(self, key, value):
+        super().__setitem__(key, value)
+        self.move_to_end(key)
+        if len(self) > self.maxsize:
+            self.popitem(last=False)
+
 
 def create_dir(dirname):
     if not os.path.exists(dirname):
@@ -1,10 +1,51 @@
+import os
+import sys
+
 from scrapy.utils.project import get_project_settings
 
 from MovieCollect.custom.crawler import AutoCrawlerProcess
+from MovieCollect.custom.supervisor import Supervisor
 
 def execute():
     settings = get_project_settings()
+    if settings.getint('CRAWLER_WORKERS', 1) > 1:
+        settings.set('CRUD_ERROR_DIR', os.path.join(settings.get('CRUD_ERROR_DIR'), 'supervisor'))
+        supervisor = Supervisor(settings)
+        supervisor.run_loop()
+        supervisor.start(stop_after_crawl=False)
+        return
+    autocp = AutoCrawlerProcess(settings)
+    autocp.run_loop()
+    autocp.start(stop_after_crawl=False)
+
+def split_download_budget(settings, index):
+    """
+    GLOBAL_CONCURRENT_REQUESTS is for the whole host, every worker gets an
+    even share of what is left after UPDATE_CONCURRENT_REQUESTS, and worker 0,
+    the only one updating movies, gets the update reserve on top of it.
+    """
+    budget = settings.getint('GLOBAL_CONCURRENT_REQUESTS', 0)
+    if not budget:
+        return
+    workers = settings.getint('CRAWLER_WORKERS', 1)
+    update_reserve = min(settings.getint('UPDATE_CONCURRENT_REQUESTS', 0), budget)
+    shared = budget - update_reserve
+    share = shared // workers + (1 if index < shared % workers else 0)
+    reserve = update_reserve if index == 0 else 0
+    settings.set('GLOBAL_CONCURRENT_REQUESTS', max(share + reserve, 1))
+    settings.set('UPDATE_CONCURRENT_REQUESTS', reserve)
+
+def execute_worker(index):
+    settings = get_project_settings()
+    settings.set('CRAWLER_WORKER_INDEX', index)
+    split_download_budget(settings, index)
+    # Every worker keeps its own root log and write journal
+    log_file, ext = os.path.splitext(settings.get('LOG_FILE'))
+    settings.set('LOG_FILE', f'{log_file}-worker{index}{ext}')
+    settings.set('CRUD_ERROR_DIR', os.path.join(settings.get('CRUD_ERROR_DIR'), f'worker{index}'))
     autocp = AutoCrawlerProcess(settings)
     autocp.run_loop()
     autocp.start(stop_after_crawl=False)
 
+if __name__ == '__main__':
+    execute_worker(int(sys.argv[1]))
@@ -12,14 +12,16 @@ import hashlib
 import os
 import time
 from itemadapter import ItemAdapter
+from twisted.internet import defer
 
+from scrapy.utils.defer import deferred_from_coro
 from scrapy.utils.python import to_bytes
 from scrapy.pipelines.images import ImagesPipeline
 from scrapy.exceptions import DropItem
 
 from MovieCollect.items import MovieItem, MovieLinkItem
 
-from MovieCollect.custom.database import SpiderMongo
+from MovieCollect.custom.bulkwriter import movie_bulk_writer
 
 
 logger = logging.getLogger(__name__)
@@ -45,12 +47,16 @@ class MovieImagesPipeline(ImagesPipeline):
 class MoviePipeline:
 
     def open_spider(self, spider):
-        self.spider_mongo = SpiderMongo(spider.settings)
+        movie_bulk_writer.open(spider)
+
+    @defer.inlineCallbacks
+    def close_spider(self, spider):
+        yield deferred_from_coro(movie_bulk_writer.close(spider))
 
     async def process_item(self, item, spider):
         if isinstance(item, MovieItem):
             movieidentity, spidername, moviename, movieurl, post = item['movieidentity'], spider.name, item['moviename'], item['movieurl'], item['images']
-            result = await self.spider_mongo.coll_movie_update_one({'movieidentity':movieidentity}, {'$set':{'spidername':spidername, 'moviename':moviename, 'movieurl':movieurl, 'post':post, 'created_time':time.time()}}, upsert=True)
+            await movie_bulk_writer.add(spider, movieidentity, {'spidername':spidername, 'moviename':moviename, 'movieurl':movieurl, 'post':post, 'created_time':time.time()})
         return item
 
 
@@ -60,6 +66,6 @@ class MovieLinkPipeline(MoviePipeline):
         if isinstance(item, MovieLinkItem):
             movieidentity, playername, linkname, linkurl, valid = item['movieidentity'], item['playername'], item['linkname'], item['linkurl'], item['valid']
             playerfield = 'player'+'.'+playername+'.'+linkname
-            result = await self.spider_mongo.coll_movie_update_one({'movieidentity':movieidentity}, {'$set':{playerfield:{'linkurl':linkurl, 'valid':valid}}}, upsert=True)
+            await movie_bulk_writer.add(spider, movieidentity, {playerfield:{'linkurl':linkurl, 'valid':valid}})
         return item
 
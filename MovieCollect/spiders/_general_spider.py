@@ -2,8 +2,19 @@ from scrapy import Spider
 
 class _general_spider(Spider):
     update_requests = []
+    search_fanout = None
+    search_cache = None
+    update_tracker = None
 
-    custom_settings = {}
+    custom_settings = {
+        'DOWNLOADER_MIDDLEWARES': {
+            'MovieCollect.custom.searchfanout.SearchFanoutMiddleware': 50,
+        },
+        'SPIDER_MIDDLEWARES': {
+            'MovieCollect.custom.updatetracker.UpdateTitleMiddleware': 40,
+            'MovieCollect.custom.searchcache.SearchCacheMiddleware': 50,
+        },
+    }
 
     def start_requests(self):
         for ur in self.update_requests:
@@ -1,26 +1,70 @@
 from scrapy import Spider as OriginSpider
 
-from MovieCollect.custom.utils.misc import hash_with_timestamp_random
+from MovieCollect.custom.crud_error_catcher import crud_error_catcher
+from MovieCollect.custom.utils.exceptions import MongoReadError
+from MovieCollect.custom.utils.misc import LRUCache, hash_movie_identity, hash_with_timestamp_random
 
 class Spider(OriginSpider):
+    movie_identity_cache_size = 100000
+
     def __init__(self, name=None, **kwargs):
         if kwargs.get('spider_mongo', None):
             self.spider_mongo = kwargs.pop('spider_mongo')
         super().__init__(name, **kwargs)
+        self.movie_identity_cacher = LRUCache(self.movie_identity_cache_size)
 
     def hash_with_timestamp_random(self, movie_url):
         return hash_with_timestamp_random(movie_url)
 
-    async def get_movie_identity_with_check(movie_name, movie_url):
-        movie = await self.spider_mongo.coll_movie_find_one({'spidername':self.name, 'moviename':movie_name, 'movieurl':movie_url},{'movieidentity':1})
-        if movie:
-            exist = True
-            movie_identity = movie['movieidentity']
-        else:
-            exist = False
-            movie_identity = self.hash_with_timestamp_random(movie_url)
-        return exist, movie_identity
+    def hash_movie_identity(self, movie_url):
+        return hash_movie_identity(self.name, movie_url)
+
+    async def get_movie_identity_with_check(self, movie_name, movie_url):
+        movie_identities = await self.get_movie_identities_with_check([(movie_name, movie_url)])
+        return movie_identities[0]
+
+    async def get_movie_identities_with_check(self, movies):
+        """
+        Resolve a page of (movie_name, movie_url) pairs with a single query,
+        return (exist, movie_identity) pairs in input order. Only movies found
+        in the database are cached, a movie missing now may be written by the
+        pipeline. A failed query raises MongoReadError instead of minting
+        identities for movies that may already exist.
+        """
+        movies = list(movies)
+        resolved = {}
+        missing = {}
+        for movie in movies:
+            cached = self.movie_identity_cacher.get(movie)
+            if cached:
+                resolved[movie] = cached
+            else:
+                missing[movie] = self.hash_movie_identity(movie[1])
+
+        if missing:
+            # Movies stored before identities were derived from the url still carry a random identity
+            query = {'$or':[
+                {'movieidentity':{'$in':list(missing.values())}},
+                {'spidername':self.name, 'moviename':{'$in':list({name for name, _ in missing})}, 'movieurl':{'$in':list({url for _, url in missing})}},
+            ]}
+            found_identities = set()
+            legacy_identities = {}
+            error_count = crud_error_catcher.error_count
+            async for movie in self.spider_mongo.coll_movie_find_iter(query, projection={'_id':0, 'movieidentity':1, 'spidername':1, 'moviename':1, 'movieurl':1}):
+                found_identities.add(movie['movieidentity'])
+                if movie.get('spidername') == self.name:
+                    legacy_identities[(movie.get('moviename'), movie.get('movieurl'))] = movie['movieidentity']
+            if crud_error_catcher.error_count > error_count:
+                raise MongoReadError(f'Failed to check identities of movies: {list(missing)}')
+            for movie, movie_identity in missing.items():
+                if movie_identity in found_identities:
+                    resolved[movie] = self.movie_identity_cacher[movie] = (True, movie_identity)
+                elif movie in legacy_identities:
+                    resolved[movie] = self.movie_identity_cacher[movie] = (True, legacy_identities[movie])
+                else:
+                    resolved[movie] = (False, movie_identity)
 
+        return [resolved[movie] for movie in movies]
 
     def parse_movie(self, response):
         raise NotImplementedError(f'spider: {self.name} does not implement parse_movie method')
@@ -0,0 +1,52 @@
+#!/usr/bin/env python3
+"""
+Time MovieUpdater planning (index the aggregate results, then build every
+request) for growing batches of movies. Planning time per movie should stay
+roughly flat from 50 to 50,000 movies.
+
+    python -m benchmarks.update_planner
+"""
+import time
+
+from scrapy.http import Request
+
+from MovieCollect.custom.updateplanner import UpdatePlanner
+
+SPIDERS = 20
+SEARCHABLE_SPIDERS = 5
+SPIDERS_PER_MOVIE = 3
+
+class FakeSpider:
+    def __init__(self, name):
+        self.name = name
+
+    def parse_movie(self, response):
+        pass
+
+    def get_search_request(self, moviename):
+        return Request(f'https://{self.name}.example.com/search?q={moviename}', callback=self.parse_movie)
+
+def aggregate_results(movies):
+    for i, moviename in enumerate(movies):
+        yield {'_id':moviename, 'info':[
+            {'spidername':f'spider{(i+j)%SPIDERS}', 'movieidentity':f'{i}-{j}', 'movieurl':f'https://spider{(i+j)%SPIDERS}.example.com/movie/{i}'}
+            for j in range(SPIDERS_PER_MOVIE)
+        ]}
+
+def plan(count):
+    movies = [f'movie {i}' for i in range(count)]
+    spiders = {f'spider{i}':FakeSpider(f'spider{i}') for i in range(SPIDERS)}
+    searchable_spiders = {name:spiders[name] for name in list(spiders)[:SEARCHABLE_SPIDERS]}
+    start = time.perf_counter()
+    planner = UpdatePlanner(set(spiders), searchable_spiders)
+    # Movies without any stored entry only get search requests
+    for me in aggregate_results(movies[:count*4//5]):
+        planner.add(me['_id'], me['info'])
+    requests = sum(1 for _ in planner.iter_requests(movies, spiders))
+    return requests, time.perf_counter() - start
+
+if __name__ == '__main__':
+    print(f'{"movies":>8} {"requests":>9} {"seconds":>9} {"us/movie":>9}')
+    for count in (50, 500, 5000, 50000):
+        requests, elapsed = plan(count)
+        print(f'{count:>8} {requests:>9} {elapsed:>9.3f} {elapsed/count*1e6:>9.1f}')
@@ -0,0 +1,3 @@
+# Deferreds made from coroutines need an installed reactor, the default one
+# runs them synchronously as long as they only await fakes
+from twisted.internet import reactor  # noqa: F401
@@ -0,0 +1,50 @@
+import asyncio
+from types import SimpleNamespace
+
+from scrapy.settings import Settings
+
+from MovieCollect.custom.bulkwriter import MovieBulkWriter
+from MovieCollect.custom.journal import WRITE_TIME_FIELD
+
+
+class FakeSpiderMongo:
+    def __init__(self):
+        self.bulks = []
+
+    async def coll_movie_bulk_write(self, operations, ordered=True):
+        self.bulks.append(operations)
+        return SimpleNamespace(upserted_count=len(operations), modified_count=0)
+
+
+def make_spider(name, size):
+    return SimpleNamespace(name=name, settings=Settings({'BULK_WRITE_SIZE':size, 'BULK_WRITE_INTERVAL':3600}))
+
+
+def test_fields_are_coalesced_per_movie_and_flushed_by_spider_size():
+    writer = MovieBulkWriter()
+    writer.spider_mongo = spider_mongo = FakeSpiderMongo()
+    small, large = make_spider('small', 2), make_spider('large', 100)
+    writer.open(small)
+    writer.open(large)
+
+    async def write():
+        await writer.add(small, '1', {'moviename':'movie'})
+        await writer.add(small, '1', {'player.a.1':{'linkurl':'u', 'valid':True}})
+        await writer.add(large, '3', {'moviename':'other'})
+        await writer.add(large, '4', {'moviename':'another'})
+        assert not spider_mongo.bulks
+        await writer.add(small, '2', {'moviename':'second'})
+        assert len(spider_mongo.bulks) == 1
+        await writer.close(small)
+        await writer.close(large)
+    asyncio.run(write())
+
+    assert len(spider_mongo.bulks) == 2
+    first = spider_mongo.bulks[0]
+    assert [operation._filter for operation in first] == [{'movieidentity':'1'}, {'movieidentity':'2'}]
+    fields = first[0]._doc['$set']
+    assert fields['moviename'] == 'movie' and fields['player.a.1'] == {'linkurl':'u', 'valid':True}
+    assert WRITE_TIME_FIELD in fields
+    assert all(operation._upsert for operation in first)
+    assert [operation._filter for operation in spider_mongo.bulks[1]] == [{'movieidentity':'3'}, {'movieidentity':'4'}]
+    assert not writer.buffers and not writer.sizes and not writer.tasks
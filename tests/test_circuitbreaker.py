@@ -0,0 +1,98 @@
+import asyncio
+from types import SimpleNamespace
+
+import pytest
+from pymongo.errors import AutoReconnect
+from scrapy.settings import Settings
+
+from MovieCollect.custom import performer
+from MovieCollect.custom.circuitbreaker import CircuitBreaker
+from MovieCollect.custom.utils.exceptions import MongoCircuitOpenError
+
+
+class FakeEngine:
+    def __init__(self):
+        self.paused = False
+
+    def pause(self):
+        self.paused = True
+
+    def unpause(self):
+        self.paused = False
+
+
+class FakeStats:
+    def set_value(self, key, value):
+        pass
+
+    def inc_value(self, key, count=1):
+        pass
+
+
+class FakeSpiderMongo:
+    def __init__(self, circuit_breaker):
+        self.circuit_breaker = circuit_breaker
+        self.updates = []
+
+    async def coll_spider_update_one(self, filter, update, upsert=False):
+        self.updates.append(update['$set']['status'])
+
+
+def make_process(*spidernames):
+    breaker = CircuitBreaker(Settings({'MONGO_BREAKER_ENABLED':True, 'MONGO_BREAKER_MIN_CALLS':4, 'MONGO_BREAKER_WINDOW':4}))
+    crawlers = {spidername:SimpleNamespace(crawling=True, terminate=False, user_paused=False, engine=FakeEngine(), stats=FakeStats()) for spidername in spidernames}
+    crawlerprocess = SimpleNamespace(running_crawlers=crawlers, spider_mongo=FakeSpiderMongo(breaker))
+    breaker.initial(crawlerprocess)
+    return breaker, crawlerprocess
+
+
+def change_status(crawlerprocess, status, spidername):
+    worker = getattr(performer, status)(crawlerprocess)
+    worker.check_status(spidername)
+    asyncio.run(worker.change_status(spidername))
+
+
+def test_breaker_opens_at_error_rate_and_rejects_calls():
+    breaker, crawlerprocess = make_process('a')
+    for exp in (None, None, AutoReconnect(), None):
+        breaker.leave(0.1, exp)
+    assert breaker.state == 'closed'
+    breaker.leave(0.1, AutoReconnect())
+    assert breaker.state == 'open'
+    assert crawlerprocess.running_crawlers['a'].engine.paused
+    with pytest.raises(MongoCircuitOpenError):
+        breaker.enter()
+    breaker.close()
+    assert not crawlerprocess.running_crawlers['a'].engine.paused
+    breaker.enter()
+
+
+def test_user_pause_while_open_survives_close():
+    breaker, crawlerprocess = make_process('a', 'b')
+    breaker.open()
+    change_status(crawlerprocess, 'pause', 'a')
+    assert crawlerprocess.spider_mongo.updates == ['has_paused']
+    breaker.close()
+    assert crawlerprocess.running_crawlers['a'].engine.paused
+    assert not crawlerprocess.running_crawlers['b'].engine.paused
+
+
+def test_user_resume_while_open_waits_for_close():
+    breaker, crawlerprocess = make_process('a')
+    change_status(crawlerprocess, 'pause', 'a')
+    breaker.open()
+    change_status(crawlerprocess, 'resume', 'a')
+    assert crawlerprocess.running_crawlers['a'].engine.paused
+    breaker.close()
+    assert not crawlerprocess.running_crawlers['a'].engine.paused
+
+
+def test_pause_and_resume_are_idempotent():
+    _, crawlerprocess = make_process('a')
+    change_status(crawlerprocess, 'pause', 'a')
+    change_status(crawlerprocess, 'pause', 'a')
+    assert crawlerprocess.running_crawlers['a'].engine.paused
+    change_status(crawlerprocess, 'resume', 'a')
+    change_status(crawlerprocess, 'resume', 'a')
+    assert not crawlerprocess.running_crawlers['a'].engine.paused
+    assert crawlerprocess.spider_mongo.updates == ['has_paused', 'has_paused', 'running', 'running']
@@ -0,0 +1,29 @@
+from types import SimpleNamespace
+
+from scrapy.settings import Settings
+
+from MovieCollect.custom.downloadbudget import DownloadBudget
+
+
+def make_budget(budget):
+    crawlerprocess = SimpleNamespace(settings=Settings({'GLOBAL_CONCURRENT_REQUESTS':budget}))
+    return DownloadBudget(crawlerprocess)
+
+
+def test_truncated_requests_are_handed_out():
+    download_budget = make_budget(10)
+    assert download_budget.allocate({'a':100, 'b':100, 'c':100}, 10) == {'a':4, 'b':3, 'c':3}
+
+
+def test_idle_crawlers_leave_their_share():
+    download_budget = make_budget(20)
+    download_budget.weights = {'a':3}
+    assert download_budget.allocate({'a':100, 'b':100, 'c':2, 'd':0}, 20) == {'a':12, 'b':5, 'c':2, 'd':1}
+
+
+def test_allocation_never_exceeds_budget():
+    download_budget = make_budget(2)
+    allocation = download_budget.allocate({'a':0, 'b':5, 'c':1}, 2)
+    assert allocation == {'a':0, 'b':1, 'c':1}
+    for budget in range(0, 30):
+        assert sum(download_budget.allocate({'a':7, 'b':100, 'c':0, 'd':13}, budget).values()) <= budget
@@ -0,0 +1,85 @@
+import hashlib
+import json
+import os
+
+from MovieCollect.custom.dupefilter import BloomFilter, ScalableBloomFilter
+
+
+def fingerprint(i):
+    return hashlib.sha1(str(i).encode()).digest()
+
+
+def test_bloom_filter_sizing(tmp_path):
+    bloom = BloomFilter(str(tmp_path / 'bloom.bin'), 1000, 0.01)
+    try:
+        # m = -n ln(p) / ln(2)^2 rounded up to whole bytes, k = log2(1/p)
+        assert bloom.bits == 9592
+        assert bloom.hashes == 7
+        assert os.path.getsize(tmp_path / 'bloom.bin') == bloom.bits // 8
+    finally:
+        bloom.close()
+
+
+def test_bloom_filter_error_rate(tmp_path):
+    bloom = BloomFilter(str(tmp_path / 'bloom.bin'), 10000, 0.01)
+    try:
+        for i in range(10000):
+            bloom.add(fingerprint(i))
+        assert all(fingerprint(i) in bloom for i in range(10000))
+        false_positives = sum(fingerprint(i) in bloom for i in range(10000, 30000))
+        assert false_positives / 20000 < 0.02
+        assert bloom.full
+    finally:
+        bloom.close()
+
+
+def test_scalable_bloom_filter_grows(tmp_path):
+    bloom = ScalableBloomFilter(str(tmp_path), 100, 0.01)
+    try:
+        # False positives are not added, they are allowed by the error rate
+        added = sum(not bloom.add(fingerprint(i)) for i in range(350))
+        assert added >= 340
+        assert [s.capacity for s in bloom.slices] == [100, 200, 400]
+        assert bloom.slices[1].error_rate < bloom.slices[0].error_rate
+        assert len(bloom) == added
+        assert bloom.add(fingerprint(0))
+    finally:
+        bloom.close()
+
+
+def test_scalable_bloom_filter_persists(tmp_path):
+    bloom = ScalableBloomFilter(str(tmp_path), 100, 0.01)
+    assert bloom.created
+    for i in range(150):
+        bloom.add(fingerprint(i))
+    bloom.flush()
+    with open(tmp_path / 'bloom.json', encoding='utf8') as f:
+        assert json.load(f)['slices'] == [{'count':100}, {'count':50}]
+    bloom.close()
+
+    # Settings of a reopened filter come from bloom.json
+    bloom = ScalableBloomFilter(str(tmp_path), 1000, 0.1)
+    try:
+        assert not bloom.created
+        assert bloom.capacity == 100 and bloom.error_rate == 0.01
+        assert len(bloom) == 150
+        assert all(fingerprint(i) in bloom for i in range(150))
+    finally:
+        bloom.close()
+
+
+def test_scalable_bloom_filter_seeded_state_persists(tmp_path):
+    bloom = ScalableBloomFilter(str(tmp_path), 100, 0.01)
+    assert not bloom.seeded
+    bloom.close()
+    # The meta is saved by the first slice, an unseeded filter is seeded again on reopen
+    bloom = ScalableBloomFilter(str(tmp_path), 100, 0.01)
+    assert not bloom.created and not bloom.seeded
+    bloom.seeded = True
+    bloom.flush()
+    bloom.close()
+    bloom = ScalableBloomFilter(str(tmp_path), 100, 0.01)
+    try:
+        assert bloom.seeded
+    finally:
+        bloom.close()
@@ -0,0 +1,21 @@
+from scrapy.settings import Settings
+
+from MovieCollect.execute import split_download_budget
+
+
+def worker_settings(index, **settings):
+    settings = Settings(dict({'CRAWLER_WORKERS':3}, **settings))
+    split_download_budget(settings, index)
+    return settings
+
+
+def test_budget_is_split_between_workers():
+    budgets = [worker_settings(index, GLOBAL_CONCURRENT_REQUESTS=100, UPDATE_CONCURRENT_REQUESTS=10) for index in range(3)]
+    assert [settings.getint('GLOBAL_CONCURRENT_REQUESTS') for settings in budgets] == [40, 30, 30]
+    assert [settings.getint('UPDATE_CONCURRENT_REQUESTS') for settings in budgets] == [10, 0, 0]
+
+
+def test_unlimited_budget_is_left_alone():
+    settings = worker_settings(1, GLOBAL_CONCURRENT_REQUESTS=0, UPDATE_CONCURRENT_REQUESTS=10)
+    assert settings.getint('GLOBAL_CONCURRENT_REQUESTS') == 0
+    assert settings.getint('UPDATE_CONCURRENT_REQUESTS') == 10
@@ -0,0 +1,72 @@
+import asyncio
+
+import pytest
+
+from MovieCollect.custom.crud_error_catcher import crud_error_catcher
+from MovieCollect.custom.utils.exceptions import MongoReadError
+from MovieCollect.custom.utils.misc import hash_movie_identity
+from MovieCollect.spiders.generic import Spider
+
+
+class FakeSpiderMongo:
+    def __init__(self, movies):
+        self.movies = movies
+        self.queries = []
+        self.failing = False
+
+    async def coll_movie_find_iter(self, query, projection=None):
+        self.queries.append(query)
+        identities = set(query['$or'][0]['movieidentity']['$in'])
+        legacy = query['$or'][1]
+        for movie in self.movies:
+            if movie['movieidentity'] in identities or (
+                movie['spidername'] == legacy['spidername']
+                and movie['moviename'] in legacy['moviename']['$in']
+                and movie['movieurl'] in legacy['movieurl']['$in']
+            ):
+                yield movie
+        if self.failing:
+            crud_error_catcher.error_count += 1
+
+
+def make_spider(movies):
+    spider_mongo = FakeSpiderMongo(movies)
+    return Spider('spider', spider_mongo=spider_mongo), spider_mongo
+
+
+def test_identities_resolved_with_one_query_in_input_order():
+    known = {'spidername':'spider', 'moviename':'known', 'movieurl':'http://example.com/1', 'movieidentity':hash_movie_identity('spider', 'http://example.com/1')}
+    spider, spider_mongo = make_spider([known])
+    resolved = asyncio.run(spider.get_movie_identities_with_check([('new', 'http://example.com/2'), ('known', 'http://example.com/1')]))
+    assert resolved == [(False, hash_movie_identity('spider', 'http://example.com/2')), (True, known['movieidentity'])]
+    assert len(spider_mongo.queries) == 1
+
+
+def test_only_found_identities_are_cached():
+    known = {'spidername':'spider', 'moviename':'known', 'movieurl':'http://example.com/1', 'movieidentity':hash_movie_identity('spider', 'http://example.com/1')}
+    spider, spider_mongo = make_spider([known])
+    movies = [('known', 'http://example.com/1'), ('new', 'http://example.com/2')]
+    asyncio.run(spider.get_movie_identities_with_check(movies))
+    assert ('known', 'http://example.com/1') in spider.movie_identity_cacher
+    assert ('new', 'http://example.com/2') not in spider.movie_identity_cacher
+
+    # The missing movie is written by the pipeline, the next lookup finds it
+    spider_mongo.movies.append({'spidername':'spider', 'moviename':'new', 'movieurl':'http://example.com/2', 'movieidentity':hash_movie_identity('spider', 'http://example.com/2')})
+    resolved = asyncio.run(spider.get_movie_identities_with_check(movies))
+    assert resolved == [(True, known['movieidentity']), (True, hash_movie_identity('spider', 'http://example.com/2'))]
+    assert len(spider_mongo.queries) == 2
+    assert spider_mongo.queries[1]['$or'][0]['movieidentity']['$in'] == [hash_movie_identity('spider', 'http://example.com/2')]
+
+
+def test_legacy_random_identity_is_kept():
+    legacy = {'spidername':'spider', 'moviename':'old', 'movieurl':'http://example.com/3', 'movieidentity':'random-identity'}
+    spider, _ = make_spider([legacy])
+    assert asyncio.run(spider.get_movie_identity_with_check('old', 'http://example.com/3')) == (True, 'random-identity')
+
+
+def test_failed_query_raises_instead_of_minting_identities():
+    spider, spider_mongo = make_spider([])
+    spider_mongo.failing = True
+    with pytest.raises(MongoReadError):
+        asyncio.run(spider.get_movie_identities_with_check([('new', 'http://example.com/2')]))
+    assert ('new', 'http://example.com/2') not in spider.movie_identity_cacher
@@ -0,0 +1,72 @@
+import asyncio
+import logging
+from types import SimpleNamespace
+
+from bson import json_util
+from pymongo import UpdateOne
+from pymongo.errors import BulkWriteError
+from scrapy.settings import Settings
+
+from MovieCollect.custom.journal import WRITE_TIME_FIELD, JournaledUpdateOne, JournalReplayer, WriteJournal, entry_to_request, journal_entries
+
+
+class FakeCollection:
+    def __init__(self, name, write_errors=()):
+        self.name = name
+        self.write_errors = list(write_errors)
+        self.requests = []
+
+    async def bulk_write(self, requests, ordered=True):
+        self.requests.extend(requests)
+        if self.write_errors:
+            raise BulkWriteError({'writeErrors':self.write_errors})
+
+
+class FakeDatabase(dict):
+    async def command(self, command):
+        return {'ok':1}
+
+
+class FakeSpiderMongo:
+    def __init__(self, collection):
+        self.database = FakeDatabase({collection.name:collection})
+
+    def get_database(self):
+        return self.database
+
+
+def journal_movie_writes(path, operations):
+    journal = WriteJournal(str(path))
+    journal.record(journal_entries(FakeCollection('movie').bulk_write, (operations,), {}, {'movie'}))
+    journal.close()
+    return journal
+
+
+def test_entries_are_stamped_and_guarded(tmp_path):
+    journal = journal_movie_writes(tmp_path / 'write-op.jsonl', [JournaledUpdateOne({'movieidentity':'1'}, {'$set':{'moviename':'movie', WRITE_TIME_FIELD:10.0}}, upsert=True)])
+    with open(journal.path, encoding='utf8') as f:
+        entry = json_util.loads(f.readline())
+    request = entry_to_request(entry)
+    assert isinstance(request, UpdateOne)
+    assert request._filter == {'movieidentity':'1', WRITE_TIME_FIELD:{'$not':{'$gt':entry['journaled_at']}}}
+    assert request._upsert
+
+    # Entries journaled before the stamp are replayed unguarded
+    del entry['journaled_at']
+    assert entry_to_request(entry)._filter == {'movieidentity':'1'}
+
+
+def test_superseded_writes_are_skipped(tmp_path, caplog):
+    journal = journal_movie_writes(tmp_path / 'write-op.jsonl', [
+        JournaledUpdateOne({'movieidentity':'1'}, {'$set':{'moviename':'old'}}, upsert=True),
+        JournaledUpdateOne({'movieidentity':'2'}, {'$set':{'moviename':'new'}}, upsert=True),
+    ])
+    collection = FakeCollection('movie', [{'index':0, 'code':11000, 'errmsg':'duplicate key'}])
+    crawlerprocess = SimpleNamespace(settings=Settings({'MOVIE_COLLECTION':'movie'}), spider_mongo=FakeSpiderMongo(collection))
+    replayer = JournalReplayer(crawlerprocess, journal)
+    with caplog.at_level(logging.INFO, logger='MovieCollect.custom.journal'):
+        asyncio.run(replayer.replay())
+    assert len(collection.requests) == 2
+    assert not [record for record in caplog.records if record.levelno >= logging.ERROR]
+    assert '1 journaled writes on movie are superseded' in caplog.text
+    assert 'replayed completely' in caplog.text
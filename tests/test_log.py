@@ -0,0 +1,20 @@
+import logging
+import queue
+
+from scrapy import Spider
+from scrapy.utils.test import get_crawler
+
+from MovieCollect.custom.utils.log import AsyncLogWriter, AsyncSpiderLogHandler
+
+
+def test_backlog_is_sampled_and_drops_counted():
+    crawler = get_crawler(Spider)
+    writer = AsyncLogWriter()
+    # No writer thread, every record stays queued
+    writer.queue = queue.Queue(150)
+    handler = AsyncSpiderLogHandler(crawler, logging.NullHandler(), writer)
+    for i in range(200):
+        handler.enqueue(logging.makeLogRecord({'msg':str(i)}))
+    assert crawler.stats.get_value('log_queue/backlog') == 150
+    assert crawler.stats.get_value('log_queue/backlog_max') == 150
+    assert crawler.stats.get_value('log_queue/dropped') == 50
@@ -0,0 +1,28 @@
+from MovieCollect.custom.utils.misc import LRUCache, hash_movie_identity
+
+
+def test_lru_cache_evicts_least_recently_used():
+    cache = LRUCache(2)
+    cache['a'] = 1
+    cache['b'] = 2
+    assert cache.get('a') == 1
+    cache['c'] = 3
+    assert list(cache) == ['a', 'c']
+    assert cache.get('b') is None
+
+
+def test_lru_cache_set_refreshes_key():
+    cache = LRUCache(2)
+    cache['a'] = 1
+    cache['b'] = 2
+    cache['a'] = 10
+    cache['c'] = 3
+    assert dict(cache) == {'a':10, 'c':3}
+
+
+def test_hash_movie_identity_is_deterministic():
+    identity = hash_movie_identity('spider', 'http://example.com/movie/1')
+    assert identity == hash_movie_identity('spider', 'http://example.com/movie/1')
+    assert identity != hash_movie_identity('other', 'http://example.com/movie/1')
+    assert identity != hash_movie_identity('spider', 'http://example.com/movie/2')
+    assert len(identity) == 40
@@ -0,0 +1,90 @@
+import asyncio
+from types import SimpleNamespace
+
+from scrapy.settings import Settings
+from scrapy.utils.misc import build_from_crawler, load_object
+from scrapy.utils.test import get_crawler
+
+from MovieCollect.custom.crud_error_catcher import crud_error_catcher
+from MovieCollect.custom.movieupdater import MovieUpdater
+from MovieCollect.custom.updateplanner import UpdatePlanner
+from MovieCollect.spiders._general_spider import _general_spider
+
+
+class UpdateSpider(_general_spider):
+    name = '_general_spider'
+
+
+class MovieSpider:
+    def parse_movie(self, response):
+        pass
+
+
+class FakeSpiderMongo:
+    """Spider collection whose reads break off after the first document when failing"""
+
+    def __init__(self, spidernames):
+        self.spidernames = spidernames
+        self.failing = False
+
+    async def coll_spider_find_iter(self, filter, projection=None):
+        for spidername in self.spidernames:
+            yield {'spidername':spidername}
+            if self.failing:
+                crud_error_catcher.error_count += 1
+                return
+
+
+class FakeSpiderLoader:
+    async def preload_many(self, spidernames):
+        pass
+
+    def load(self, spidername):
+        return lambda spider_mongo: MovieSpider()
+
+
+def make_updater(settings=None, spider_mongo=None):
+    crawlerprocess = SimpleNamespace(settings=Settings(settings or {}), spider_loader=FakeSpiderLoader(), spider_mongo=spider_mongo, search_cache=None, search_fanout=None)
+    updater = MovieUpdater(crawlerprocess)
+    updater._general_spidercls = UpdateSpider
+    return updater
+
+
+def plan_requests(moviename):
+    planner = UpdatePlanner({'a'}, {})
+    planner.add(moviename, [{'spidername':'a', 'movieidentity':'1', 'movieurl':'https://a.example.com/movie/1'}])
+    return list(planner.iter_requests([moviename], {'a':MovieSpider()}))
+
+
+def test_title_requested_again_is_fetched_again():
+    crawler = get_crawler(UpdateSpider, make_updater().crawler_settings())
+    dupefilter = build_from_crawler(load_object(crawler.settings['DUPEFILTER_CLASS']), crawler)
+    first, second = plan_requests('movie'), plan_requests('movie')
+    assert first[0].url == second[0].url
+    assert not any(dupefilter.request_seen(request) for request in first + second)
+
+
+def test_crawler_settings_keep_reserved_concurrency():
+    custom_settings = make_updater({'UPDATE_CONCURRENT_REQUESTS':8}).crawler_settings()
+    assert custom_settings['CONCURRENT_REQUESTS'] == 8
+    assert custom_settings['SPIDER_BLOOM_DUPEFILTER'] is False
+    assert custom_settings['SPIDER_MIDDLEWARES'] == UpdateSpider.custom_settings['SPIDER_MIDDLEWARES']
+
+
+def test_failed_spider_read_keeps_spiders():
+    spider_mongo = FakeSpiderMongo(['a', 'b'])
+    updater = make_updater(spider_mongo=spider_mongo)
+    asyncio.run(updater.refresh_spiders())
+    assert updater.finished_spiders == {'a', 'b'}
+    assert set(updater.searchable_spiders_cacher) == {'a', 'b'}
+
+    spider_mongo.failing = True
+    asyncio.run(updater.refresh_spiders())
+    assert updater.finished_spiders == {'a', 'b'}
+    assert set(updater.searchable_spiders_cacher) == {'a', 'b'}
+
+    spider_mongo.failing = False
+    spider_mongo.spidernames = ['a']
+    asyncio.run(updater.refresh_spiders())
+    assert updater.finished_spiders == {'a'}
+    assert set(updater.searchable_spiders_cacher) == {'a'}
@@ -0,0 +1,108 @@
+import asyncio
+from types import SimpleNamespace
+
+from scrapy.http import HtmlResponse, Request
+from scrapy.settings import Settings
+
+from MovieCollect.custom.searchcache import SearchCache, SearchCacheMiddleware
+from MovieCollect.custom.utils.misc import hash_movie_identity
+from MovieCollect.items import MovieItem
+
+
+class FakeSpiderMongo:
+    def __init__(self, movies=()):
+        self.movies = list(movies)
+        self.writes = []
+
+    async def coll_search_update_one(self, filter, update, upsert=False):
+        self.writes.append((filter, update))
+
+    async def coll_search_find_iter(self, query, projection=None):
+        return
+        yield
+
+    async def coll_movie_find_iter(self, query, projection=None):
+        identities = set(query['$or'][0]['movieidentity']['$in'])
+        urls = set(query['$or'][1]['movieurl']['$in'])
+        for movie in self.movies:
+            if movie['movieidentity'] in identities or movie['movieurl'] in urls:
+                yield movie
+
+
+class SearchSpider:
+    name = 'site'
+
+    def parse_results(self, response):
+        pass
+
+    def parse_movie(self, response):
+        pass
+
+    def get_search_request(self, moviename):
+        return Request(f'https://site.example.com/search?q={moviename}', callback=self.parse_results)
+
+
+def make_cache(movies=()):
+    spider_mongo = FakeSpiderMongo(movies)
+    return SearchCache(SimpleNamespace(settings=Settings(), spider_mongo=spider_mongo)), spider_mongo
+
+
+def response_for(request):
+    return HtmlResponse(request.url, request=request, body=b'')
+
+
+def run_middleware(response, output, search_cache):
+    spider = SimpleNamespace(search_cache=search_cache)
+    return list(SearchCacheMiddleware().process_spider_output(response, output, spider))
+
+
+def test_miss_builds_search_request():
+    cache, _ = make_cache()
+    request, = cache.get_requests('site', SearchSpider(), 'Movie')
+    assert request.meta['search_spider'] == 'site' and request.meta['search_title'] == 'Movie'
+
+
+def test_search_chain_records_movie_pages():
+    cache, spider_mongo = make_cache()
+    search_request, = cache.get_requests('site', SearchSpider(), 'Movie')
+    # Search results go through a results page before reaching the movie page
+    results_request, = run_middleware(response_for(search_request), [Request('https://site.example.com/results?page=1')], cache)
+    assert results_request.meta['search_cache_spider'] == 'site'
+    movie_request, = run_middleware(response_for(results_request), [Request('https://site.example.com/movie/1')], cache)
+    assert not spider_mongo.writes
+
+    item = MovieItem(moviename='Movie (2020)', spidername='site', movieurl='https://site.example.com/movie/1', movieidentity='identity-1')
+    run_middleware(response_for(movie_request), [item], cache)
+    assert spider_mongo.writes[0][1]['$addToSet'] == {'urls':'https://site.example.com/movie/1'}
+
+    request, = cache.get_requests('site', SearchSpider(), 'movie')
+    assert request.url == 'https://site.example.com/movie/1'
+    assert request.meta['movie_identity'] == 'identity-1'
+    assert 'search_spider' not in request.meta
+
+
+def test_empty_output_is_not_cached_as_negative():
+    cache, spider_mongo = make_cache()
+    search_request, = cache.get_requests('site', SearchSpider(), 'Movie')
+    run_middleware(response_for(search_request), [], cache)
+    assert not spider_mongo.writes
+    assert cache.get_requests('site', SearchSpider(), 'Movie')[0].meta['search_spider'] == 'site'
+
+
+def test_explicit_no_results_is_cached_as_negative():
+    cache, spider_mongo = make_cache()
+    search_request, = cache.get_requests('site', SearchSpider(), 'Movie')
+    response = response_for(search_request)
+    response.meta['search_no_results'] = True
+    run_middleware(response, [], cache)
+    assert spider_mongo.writes[0][1]['$set']['urls'] == []
+    assert cache.get_requests('site', SearchSpider(), 'Movie') == []
+
+
+def test_preload_resolves_stored_identities():
+    legacy = {'spidername':'site', 'movieurl':'https://site.example.com/movie/2', 'movieidentity':'random-identity'}
+    cache, _ = make_cache([legacy])
+    cache.cacher[('site', 'movie')] = (['https://site.example.com/movie/2', 'https://site.example.com/movie/3'], float('inf'))
+    asyncio.run(cache.preload(['Movie'], ['site']))
+    requests = cache.get_requests('site', SearchSpider(), 'Movie')
+    assert [request.meta['movie_identity'] for request in requests] == ['random-identity', hash_movie_identity('site', 'https://site.example.com/movie/3')]
@@ -0,0 +1,67 @@
+from scrapy.http import HtmlResponse, Request
+from scrapy.settings import Settings
+
+from MovieCollect.custom.searchfanout import SearchFanout
+from MovieCollect.items import MovieItem
+
+
+class SearchSpider:
+    def __init__(self, name):
+        self.name = name
+
+    def parse(self, response):
+        pass
+
+    def get_search_request(self, moviename):
+        return Request(f'https://{self.name}.example.com/search?q={moviename}', callback=self.parse)
+
+
+def make_fanout(**settings):
+    return SearchFanout(Settings(dict({'UPDATE_SEARCH_WAVE_SIZE':1, 'UPDATE_SEARCH_WAVE_DELAY':0}, **settings)))
+
+
+def response_for(request):
+    return HtmlResponse(request.url, request=request, body=b'')
+
+
+def test_waves_are_ranked_by_hit_rate():
+    fanout = make_fanout()
+    fanout.spider_stats = {'good':{'searches':10, 'hits':9, 'latency':1}, 'bad':{'searches':10, 'hits':0, 'latency':1}}
+    spiders = {name:SearchSpider(name) for name in ('bad', 'good', 'used')}
+    requests = fanout.start('Movie', {'used'}, spiders)
+    assert [request.meta['search_spider'] for request in requests] == ['good']
+    assert requests[0].meta['update_title'] == 'Movie'
+    assert fanout.has_pending('Movie')
+    assert [request.meta['search_spider'] for request in fanout.next_wave('Movie', spiders)] == ['bad']
+    assert not fanout.has_pending('Movie')
+
+
+def test_spider_no_longer_searchable_is_skipped():
+    fanout = make_fanout(UPDATE_SEARCH_WAVE_SIZE=2)
+    spiders = {name:SearchSpider(name) for name in ('a', 'b', 'c', 'd')}
+    fanout.start('Movie', set(), spiders)
+    # refresh_spiders drops spiders from the shared dict in place
+    del spiders['c'], spiders['d']
+    assert fanout.next_wave('Movie', spiders) == []
+    assert not fanout.has_pending('Movie')
+
+
+def test_enough_sources_matched_by_update_title():
+    fanout = make_fanout()
+    spiders = {name:SearchSpider(name) for name in ('a', 'b')}
+    request = fanout.start('The Movie', set(), spiders)[0]
+    item = MovieItem(moviename='The Movie (2020) HD', spidername=request.meta['search_spider'])
+    fanout.item_scraped(item, response_for(request), None)
+    assert 'The Movie' in fanout.satisfied
+    assert not fanout.has_pending('The Movie')
+    assert fanout.get_spider_stats(request.meta['search_spider'])['hits'] == 1
+
+
+def test_enough_sources_matched_by_normalized_title():
+    fanout = make_fanout()
+    spiders = {name:SearchSpider(name) for name in ('a', 'b')}
+    fanout.start('The Movie', set(), spiders)
+    fanout.item_scraped(MovieItem(moviename='the  movie!', spidername='x'), None, None)
+    assert 'The Movie' in fanout.satisfied
+    fanout.finish('The Movie')
+    assert not fanout.titles and not fanout.normalized_titles
@@ -0,0 +1,168 @@
+import asyncio
+import datetime
+import multiprocessing
+import os
+import uuid
+
+import pytest
+from pymongo import MongoClient
+from pymongo.errors import PyMongoError
+from scrapy.settings import Settings
+
+from MovieCollect.custom.spiderlease import SpiderLease
+from MovieCollect.custom.utils.exceptions import SpiderLeaseError
+
+MONGO_URI = os.environ.get('MONGO_TEST_URI', 'mongodb://localhost:27017')
+PROCESSES = 4
+SPIDERS = 20
+
+
+class SpiderCollection:
+    """coll_spider_<op> accessors of SpiderMongo on a plain motor collection, errors are not swallowed"""
+
+    def __init__(self, coll):
+        self.coll = coll
+
+    def __getattr__(self, name):
+        funcname = name[len('coll_spider_'):]
+        if funcname.endswith('_iter'):
+            func = getattr(self.coll, funcname[:-len('_iter')])
+            async def inner(*args, batch_size=None, projection=None, **kwargs):
+                async for document in func(*args, projection=projection, **kwargs):
+                    yield document
+            return inner
+        return getattr(self.coll, funcname)
+
+
+class FakeProcess:
+    def __init__(self, node_id, coll, ttl=60):
+        self.settings = Settings({'SPIDER_LEASE_ENABLED':True, 'SPIDER_LEASE_TTL':ttl, 'NODE_ID':node_id})
+        self.spider_mongo = SpiderCollection(coll)
+        self.running_crawlers = {}
+
+
+def mongo_available():
+    try:
+        MongoClient(MONGO_URI, serverSelectionTimeoutMS=500).admin.command('ping')
+    except PyMongoError:
+        return False
+    return True
+
+
+needs_mongod = pytest.mark.skipif(not mongo_available(), reason=f'no mongod reachable at {MONGO_URI}')
+
+
+@pytest.fixture
+def collection_name():
+    name = f'spiderlease_{uuid.uuid4().hex}'
+    yield name
+    MongoClient(MONGO_URI)['moviecollect_test'].drop_collection(name)
+
+
+def run(coro_func, collection_name):
+    async def main():
+        from motor.motor_asyncio import AsyncIOMotorClient
+        client = AsyncIOMotorClient(MONGO_URI)
+        try:
+            return await coro_func(client['moviecollect_test'][collection_name])
+        finally:
+            client.close()
+    return asyncio.run(main())
+
+
+class RecordingSpiderMongo:
+    def __init__(self):
+        self.calls = []
+
+    async def coll_spider_find_one_and_update(self, filter, update, **kwargs):
+        self.calls.append((filter, update))
+
+
+def test_take_over_keeps_paused_spiders_paused():
+    process = FakeProcess('node-a', None)
+    process.spider_mongo = RecordingSpiderMongo()
+    asyncio.run(SpiderLease(process).take_over())
+    (running_filter, running_update), (paused_filter, paused_update) = process.spider_mongo.calls
+    assert running_filter['status'] == 'running' and running_update['$set']['status'] == 'start'
+    assert paused_filter['status'] == 'has_paused' and paused_update == {'$unset':{'lease':''}}
+    # Expiry is decided by the clock of the mongo server
+    assert paused_filter['$expr'] == {'$lt':['$lease.expire', '$$NOW']}
+
+
+@needs_mongod
+def test_acquire_renew_and_release(collection_name):
+    async def scenario(coll):
+        await coll.insert_one({'spidername':'spider', 'status':'start'})
+        lease_a = SpiderLease(FakeProcess('node-a', coll))
+        lease_b = SpiderLease(FakeProcess('node-b', coll))
+        await lease_a.acquire('spider')
+        lease = (await coll.find_one({'spidername':'spider'}))['lease']
+        assert lease['owner'] == 'node-a'
+        assert isinstance(lease['expire'], datetime.datetime)
+        assert lease['expire'] - lease['heartbeat'] == datetime.timedelta(seconds=60)
+
+        with pytest.raises(SpiderLeaseError):
+            await lease_b.acquire('spider')
+        assert await lease_b.owned_by_other('spider')
+        assert not await lease_a.owned_by_other('spider')
+
+        await asyncio.sleep(0.05)
+        await lease_a.renew(['spider'])
+        renewed = (await coll.find_one({'spidername':'spider'}))['lease']
+        assert renewed['expire'] > lease['expire']
+
+        await lease_a.release('spider')
+        await lease_b.acquire('spider')
+        assert (await coll.find_one({'spidername':'spider'}))['lease']['owner'] == 'node-b'
+    run(scenario, collection_name)
+
+
+@needs_mongod
+def test_expired_lease_is_taken_over(collection_name):
+    async def scenario(coll):
+        expired = {'owner':'node-dead', 'expire':datetime.datetime(2000, 1, 1), 'heartbeat':datetime.datetime(2000, 1, 1)}
+        await coll.insert_many([
+            {'spidername':'running', 'status':'running', 'lease':expired},
+            {'spidername':'paused', 'status':'has_paused', 'lease':expired},
+            {'spidername':'unleased', 'status':'running'},
+        ])
+        lease_a = SpiderLease(FakeProcess('node-a', coll))
+        await lease_a.take_over()
+        spiders = {spider['spidername']:spider async for spider in coll.find({}, {'_id':0})}
+        assert spiders['running']['status'] == 'start' and 'lease' not in spiders['running']
+        assert spiders['paused']['status'] == 'has_paused' and 'lease' not in spiders['paused']
+        assert spiders['unleased']['status'] == 'running'
+
+        await coll.update_one({'spidername':'running'}, {'$set':{'lease':expired}})
+        await lease_a.acquire('running')
+        assert (await coll.find_one({'spidername':'running'}))['lease']['owner'] == 'node-a'
+    run(scenario, collection_name)
+
+
+def acquire_all(node_id, collection_name, barrier):
+    async def scenario(coll):
+        lease = SpiderLease(FakeProcess(node_id, coll))
+        barrier.wait()
+        acquired = []
+        for i in range(SPIDERS):
+            try:
+                await lease.acquire(f'spider{i}')
+            except SpiderLeaseError:
+                continue
+            acquired.append(f'spider{i}')
+        return acquired
+    return run(scenario, collection_name)
+
+
+@needs_mongod
+def test_leases_are_exclusive_between_processes(collection_name):
+    MongoClient(MONGO_URI)['moviecollect_test'][collection_name].insert_many([{'spidername':f'spider{i}', 'status':'start'} for i in range(SPIDERS)])
+    ctx = multiprocessing.get_context('spawn')
+    with ctx.Manager() as manager, ctx.Pool(PROCESSES) as pool:
+        barrier = manager.Barrier(PROCESSES)
+        results = pool.starmap(acquire_all, [(f'node-{i}', collection_name, barrier) for i in range(PROCESSES)])
+    acquired = [spidername for result in results for spidername in result]
+    assert sorted(acquired) == sorted(f'spider{i}' for i in range(SPIDERS))
+    owners = {spider['spidername']:spider['lease']['owner'] for spider in MongoClient(MONGO_URI)['moviecollect_test'][collection_name].find()}
+    for i, result in enumerate(results):
+        assert all(owners[spidername] == f'node-{i}' for spidername in result)
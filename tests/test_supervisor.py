@@ -0,0 +1,127 @@
+import json
+
+from MovieCollect.custom.supervisor import CrawlerWorker, ForwardingPerformer, REPORT_FD, Supervisor
+
+
+class FakeTransport:
+    pid = 1
+
+    def __init__(self):
+        self.lines = []
+
+    def write(self, data):
+        self.lines.extend(json.loads(line) for line in data.decode('utf8').splitlines())
+
+
+class FakeSpiderLease:
+    def __init__(self, owned_by_other=False):
+        self.owned = owned_by_other
+
+    async def owned_by_other(self, spidername):
+        return self.owned
+
+
+class FakeSpiderMongo:
+    def __init__(self):
+        self.updates = []
+
+    async def coll_spider_update_one(self, filter, update, upsert=False):
+        self.updates.append((filter, update))
+
+
+class FakeSupervisor:
+    route = Supervisor.route
+    broadcast = Supervisor.broadcast
+
+    def __init__(self, workers=2, owned_by_other=False):
+        self.spider_mongo = FakeSpiderMongo()
+        self.spider_lease = FakeSpiderLease(owned_by_other)
+        self.workers = [CrawlerWorker(self, index) for index in range(workers)]
+        for worker in self.workers:
+            worker.transport = FakeTransport()
+
+
+def report(worker, **message):
+    worker.childDataReceived(REPORT_FD, json.dumps(message).encode('utf8')+b'\n')
+
+
+def test_start_goes_to_least_loaded_worker():
+    supervisor = FakeSupervisor()
+    supervisor.workers[0].running = {'busy'}
+    performer = ForwardingPerformer(supervisor)
+    performer.perform([{'spidername':'spider', 'status':'start'}])
+    worker = supervisor.workers[1]
+    assert worker.transport.lines == [{'spidername':'spider', 'status':'start'}]
+    assert worker.assigned == {'spider'}
+    assert performer.spiders_in_processing == {'spider'}
+
+    report(worker, type='done', spidername='spider', status='start', ok=True, running=['spider'])
+    assert worker.running == {'spider'} and not worker.assigned
+    assert not performer.spiders_in_processing
+
+
+def test_pause_goes_to_worker_running_the_spider():
+    supervisor = FakeSupervisor()
+    supervisor.workers[1].running = {'spider'}
+    performer = ForwardingPerformer(supervisor)
+    performer.perform([{'spidername':'spider', 'status':'pause'}])
+    assert supervisor.workers[1].transport.lines == [{'spidername':'spider', 'status':'pause'}]
+    assert not supervisor.workers[0].transport.lines
+
+    report(supervisor.workers[1], type='done', spidername='spider', status='pause', ok=False)
+    assert not performer.spiders_in_processing
+
+
+def test_pause_of_spider_no_worker_owns_marks_it_error():
+    supervisor = FakeSupervisor()
+    performer = ForwardingPerformer(supervisor)
+    performer.perform([{'spidername':'spider', 'status':'pause'}])
+    assert not performer.spiders_in_processing
+    assert supervisor.spider_mongo.updates[0][1]['$set']['status'] == 'error'
+    assert not any(worker.transport.lines for worker in supervisor.workers)
+
+
+def test_pause_of_spider_owned_by_another_node_is_left_alone():
+    supervisor = FakeSupervisor(owned_by_other=True)
+    performer = ForwardingPerformer(supervisor)
+    performer.perform([{'spidername':'spider', 'status':'resume'}])
+    assert not performer.spiders_in_processing
+    assert not supervisor.spider_mongo.updates
+
+
+def test_delete_is_broadcast_to_other_workers():
+    supervisor = FakeSupervisor(workers=3)
+    supervisor.workers[2].running = {'spider'}
+    performer = ForwardingPerformer(supervisor)
+    performer.perform([{'spidername':'spider', 'status':'delete'}])
+    report(supervisor.workers[2], type='done', spidername='spider', status='delete', ok=True, running=[])
+    forget = {'command':'forget', 'spidername':'spider'}
+    assert supervisor.workers[0].transport.lines == [forget]
+    assert supervisor.workers[1].transport.lines == [forget]
+    assert supervisor.workers[2].transport.lines == [{'spidername':'spider', 'status':'delete'}]
+
+
+def test_reports_split_across_reads():
+    worker = CrawlerWorker(FakeSupervisor(), 0)
+    data = json.dumps({'type':'report', 'running':['a', 'b']}).encode('utf8')+b'\n'
+    worker.childDataReceived(REPORT_FD, data[:10])
+    assert worker.running == set()
+    worker.childDataReceived(REPORT_FD, data[10:])
+    assert worker.running == {'a', 'b'}
+
+
+def test_worker_exit_fails_pending_status_changes():
+    supervisor = FakeSupervisor()
+    performer = ForwardingPerformer(supervisor)
+    performer.perform([{'spidername':'spider', 'status':'start'}])
+    worker = next(worker for worker in supervisor.workers if worker.pending)
+    ended = []
+    worker.ended.addCallback(ended.append)
+
+    class Reason:
+        def getErrorMessage(self):
+            return 'killed'
+
+    worker.processEnded(Reason())
+    assert not performer.spiders_in_processing
+    assert ended == [set()]
@@ -0,0 +1,50 @@
+from scrapy.http import Request
+
+from MovieCollect.custom.updateplanner import UpdatePlanner
+
+
+class FakeSpider:
+    def __init__(self, name):
+        self.name = name
+
+    def parse_movie(self, response):
+        pass
+
+    def get_search_request(self, moviename):
+        return Request(f'https://{self.name}.example.com/search?q={moviename}', callback=self.parse_movie)
+
+
+def brief(spidername, movieidentity):
+    return {'spidername':spidername, 'movieidentity':movieidentity, 'movieurl':f'https://{spidername}.example.com/movie/{movieidentity}'}
+
+
+def test_requests_follow_movie_order_and_skip_unfinished_spiders():
+    spiders = {name:FakeSpider(name) for name in ('a', 'b', 'c')}
+    planner = UpdatePlanner({'a', 'b'}, {})
+    planner.add('second', [brief('b', '2')])
+    planner.add('first', [brief('a', '1'), brief('c', '3')])
+    assert planner.spidernames == {'a', 'b'}
+    requests = list(planner.iter_requests(['first', 'second', 'unknown'], spiders))
+    assert [r.url for r in requests] == ['https://a.example.com/movie/1', 'https://b.example.com/movie/2']
+    assert [r.meta['update_title'] for r in requests] == ['first', 'second']
+    assert requests[0].meta['movie_identity'] == '1'
+    assert requests[0].callback == spiders['a'].parse_movie
+
+
+def test_searches_skip_spiders_already_holding_the_movie():
+    spiders = {name:FakeSpider(name) for name in ('a', 'b')}
+    planner = UpdatePlanner({'a'}, spiders)
+    planner.add('movie', [brief('a', '1')])
+    requests = list(planner.iter_requests(['movie'], spiders))
+    assert [r.url for r in requests] == ['https://a.example.com/movie/1', 'https://b.example.com/search?q=movie']
+    assert all(r.meta['update_title'] == 'movie' for r in requests)
+
+
+def test_requests_are_built_lazily():
+    spiders = {'a':FakeSpider('a')}
+    planner = UpdatePlanner({'a'}, {})
+    for i in range(1000):
+        planner.add(f'movie {i}', [brief('a', str(i))])
+    requests = planner.iter_requests([f'movie {i}' for i in range(1000)], spiders)
+    assert next(requests).meta['update_title'] == 'movie 0'
+    assert sum(1 for _ in requests) == 999
@@ -0,0 +1,37 @@
+import asyncio
+from types import SimpleNamespace
+
+from scrapy.settings import Settings
+
+from MovieCollect.custom.updatequeue import UpdateQueue
+
+
+class FakeSpiderMongo:
+    def __init__(self):
+        self.legacy = []
+        self.queue = {}
+
+    async def coll_tool_find_one(self, filter, projection):
+        return {'funcfield':list(self.legacy)}
+
+    async def coll_tool_update_one(self, filter, update):
+        self.legacy = [movie for movie in self.legacy if movie not in update['$pullAll']['funcfield']]
+
+    async def coll_queue_bulk_write(self, operations, ordered=True):
+        for operation in operations:
+            self.queue.setdefault(operation._filter['moviename'], operation._doc['$setOnInsert'])
+        return True
+
+
+def test_legacy_document_is_drained_on_every_loop():
+    spider_mongo = FakeSpiderMongo()
+    update_queue = UpdateQueue(SimpleNamespace(settings=Settings(), spider_mongo=spider_mongo))
+    spider_mongo.legacy = ['first']
+    asyncio.run(update_queue.migrate_legacy())
+    assert list(spider_mongo.queue) == ['first'] and not spider_mongo.legacy
+
+    # Producers keep writing the legacy document after the first drain
+    spider_mongo.legacy = ['second', 'first']
+    asyncio.run(update_queue.migrate_legacy())
+    assert list(spider_mongo.queue) == ['first', 'second'] and not spider_mongo.legacy
+    assert spider_mongo.queue['second']['status'] == 'pending'
@@ -0,0 +1,58 @@
+from types import SimpleNamespace
+
+from scrapy import Request
+from scrapy.http import HtmlResponse
+from scrapy.settings import Settings
+
+from MovieCollect.custom.updatetracker import UpdateTitleMiddleware, UpdateTracker
+from MovieCollect.items import MovieItem
+
+
+def make_tracker(**settings):
+    return UpdateTracker(Settings(dict({'UPDATE_TITLE_GRACE':0}, **settings)))
+
+
+def receive(tracker, request, scheduled=False):
+    if not scheduled:
+        tracker.request_scheduled(request, None)
+    response = HtmlResponse(request.url, request=request)
+    tracker.response_received(response, request, None)
+    tracker.request_left(request)
+    return response
+
+
+def test_movie_finishes_after_follow_ups_and_items():
+    tracker = make_tracker()
+    spider = SimpleNamespace(update_tracker=tracker)
+    middleware = UpdateTitleMiddleware(100)
+    tracker.start(['movie'])
+    response = receive(tracker, Request('https://a.example.com/search', meta={'update_title':'movie'}))
+    assert tracker.pop_finished() == []
+
+    item = MovieItem(movieidentity='1', moviename='movie')
+    output = middleware.process_spider_output(response, iter([Request('https://a.example.com/movie/1'), item]), spider)
+    follow_up = next(output)
+    assert follow_up.meta['update_title'] == 'movie' and follow_up.priority == 100
+    tracker.request_scheduled(follow_up, None)
+    assert next(output) is item
+    assert list(output) == []
+    assert tracker.pending['movie'] == 2
+    tracker.item_left(item, response, None)
+    assert tracker.pop_finished() == []
+
+    follow_up_response = receive(tracker, follow_up, scheduled=True)
+    tracker.spider_error(None, follow_up_response, None)
+    # Closing the output after the error must not leave the response twice
+    tracker.response_scraped(follow_up_response)
+    assert tracker.pending['movie'] == 0
+    assert tracker.pop_finished() == ['movie']
+
+
+def test_unknown_titles_are_ignored_and_stuck_movies_time_out():
+    tracker = make_tracker(UPDATE_TITLE_TIMEOUT=0)
+    tracker.start(['movie'])
+    receive(tracker, Request('https://a.example.com/other', meta={'update_title':'other'}))
+    tracker.request_scheduled(Request('https://a.example.com/movie', meta={'update_title':'movie'}), None)
+    assert 'other' not in tracker.pending
+    assert tracker.pop_finished() == ['movie']
+    assert not tracker.pending and not tracker.started